@@ -0,0 +1,38 @@
+import json
+import os
+from fastapi import HTTPException, Response, status
+from ..database.db_session import get_db
+from ..database.db import DatabaseUnavailable
+
+db = get_db()
+
+# Above this number of rows (according to the planner estimate) the count is estimated
+COUNT_EXACT_THRESHOLD = int(os.environ.get("COUNT_EXACT_THRESHOLD", 100000))
+
+
+# Function to count the rows of a listing
+# from_where is the FROM ... WHERE ... part of the listing query, with the same joins and conditions, and args its parameters
+# It must come from the code, never from the request
+# Small results are counted with count(*), big ones use the planner estimate of the same query
+# Returns the count and whether it is an estimate
+async def count_rows(from_where: str, *args) -> tuple[int, bool]:
+    try:
+        plan = await db.fetch_val(f"EXPLAIN (FORMAT JSON) SELECT 1 {from_where};", *args)
+        estimate = json.loads(plan)[0]["Plan"]["Plan Rows"]
+        if estimate >= COUNT_EXACT_THRESHOLD:
+            return int(estimate), True
+        return await db.fetch_val(f"SELECT count(*) {from_where};", *args), False
+    except DatabaseUnavailable:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Failed to count rows. Please try again later. " + str(e),
+        )
+
+
+# Function to add a total count to the headers of a response
+# X-Total-Count holds the count, X-Total-Count-Estimated tells if it is an estimate
+def add_total_count_headers(response: Response, count: int, estimated: bool):
+    response.headers["X-Total-Count"] = str(count)
+    response.headers["X-Total-Count-Estimated"] = "true" if estimated else "false"
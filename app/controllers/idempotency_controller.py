@@ -0,0 +1,163 @@
+import asyncio
+import hashlib
+import json
+import os
+import time
+from fastapi import HTTPException, Response, status
+from fastapi.encoders import jsonable_encoder
+from ..database.db_session import get_db
+from ..database.db import CircuitOpen, ConnectionFailed, PoolOverloaded
+from ..utils.metrics import get_metrics
+
+db = get_db()
+
+# Hours a response is kept for the retries of a request with the same Idempotency-Key
+IDEMPOTENCY_TTL_HOURS = int(os.environ.get("IDEMPOTENCY_TTL_HOURS", 24))
+
+# Seconds after which a request that never completed (eg: its worker died) is reported as abandoned
+# instead of in progress. Its key is never taken over: the creation may have been committed
+IDEMPOTENCY_LOCK_TIMEOUT = int(os.environ.get("IDEMPOTENCY_LOCK_TIMEOUT", 60))
+
+# Seconds between two purges of the expired keys
+PURGE_INTERVAL = 600
+
+# Takes the key if it is new or expired, a key held by another request is never taken over
+CLAIM_QUERY = """
+INSERT INTO idempotency_keys (scope, idempotency_key, request_hash, expires_at)
+VALUES ($1, $2, $3, NOW() + make_interval(hours => $4))
+ON CONFLICT (scope, idempotency_key) DO UPDATE SET
+    request_hash = EXCLUDED.request_hash,
+    status_code = NULL,
+    response = NULL,
+    created_at = NOW(),
+    expires_at = EXCLUDED.expires_at
+WHERE idempotency_keys.expires_at < NOW()
+RETURNING true;
+"""
+SELECT_QUERY = "SELECT request_hash, status_code, response, created_at < NOW() - make_interval(secs => $3) AS abandoned FROM idempotency_keys WHERE scope = $1 AND idempotency_key = $2;"
+COMPLETE_QUERY = "UPDATE idempotency_keys SET status_code = $3, response = $4 WHERE scope = $1 AND idempotency_key = $2;"
+RELEASE_QUERY = "DELETE FROM idempotency_keys WHERE scope = $1 AND idempotency_key = $2 AND status_code IS NULL;"
+PURGE_QUERY = "DELETE FROM idempotency_keys WHERE expires_at < NOW();"
+
+last_purge = 0.0
+# Keep a reference on the running purge so that it is not garbage collected
+purge_tasks = set()
+
+
+# Function to get the fingerprint of a request body, a key cannot be reused for another body
+def request_fingerprint(payload) -> bytes:
+    return hashlib.sha256(json.dumps(jsonable_encoder(payload), sort_keys=True, separators=(",", ":")).encode()).digest()
+
+
+async def purge_expired_keys():
+    try:
+        await db.execute(PURGE_QUERY)
+    except Exception as e:
+        print("Idempotency ERROR while purging the expired keys: ", e)
+
+
+# Function to tell if a failed creation certainly wrote nothing, so that its key can be released
+# in_transaction tells if the creation ran in the transaction storing the response: it was rolled back,
+# unless the connection was lost while it was sent (the commit may have been applied)
+# Otherwise only the errors raised before anything could be written are sure: a 4xx, or the database not reached
+def nothing_written(error: Exception, in_transaction: bool) -> bool:
+    if isinstance(error, ConnectionFailed):
+        return not error.sent
+    if isinstance(error, (PoolOverloaded, CircuitOpen)):
+        return True
+    if in_transaction:
+        return True
+    return isinstance(error, HTTPException) and error.status_code < 500
+
+
+# Function to start a purge of the expired keys at most every PURGE_INTERVAL seconds
+def schedule_purge():
+    global last_purge
+    if time.monotonic() - last_purge < PURGE_INTERVAL:
+        return
+    last_purge = time.monotonic()
+    task = asyncio.create_task(purge_expired_keys())
+    purge_tasks.add(task)
+    task.add_done_callback(purge_tasks.discard)
+
+
+# Function to encode the response of a creation, as stored for the retries
+def encode_response(result) -> bytes:
+    return json.dumps(jsonable_encoder(result), separators=(",", ":")).encode()
+
+
+# Function to run a creation once per Idempotency-Key
+# scope separates the keys of the routes (and of the users), payload is the request body
+# and create the coroutine function doing the work
+# With in_transaction, create is called with the connection of a transaction on the main database,
+# its writes and the stored response are committed together (for the creations made on the main database)
+# The first request runs create and stores its response, the retries get the stored response
+# without running it again (Idempotent-Replayed: true). While the first request is running,
+# the retries get a 409. A key reused with another body is rejected with a 422.
+# Errors are not stored: when nothing was written (see nothing_written) the key is released
+# and the request can be retried
+# A request that never completed (error after a write, cancelled, worker died, response not stored) keeps its key:
+# it may have created its row, so the key is not taken over by a retry, which would create it twice.
+# After IDEMPOTENCY_LOCK_TIMEOUT its retries get a 409 telling to check the result and use a new key.
+# The key is stored in the main database and, with POSTGRES_SHARDS, the post on its shard:
+# no transaction covers both, so the response cannot be stored with the creation
+async def run_idempotent(scope: str, idempotency_key: str, payload, create, in_transaction: bool = False) -> Response:
+    metrics = get_metrics()
+    request_hash = request_fingerprint(payload)
+    schedule_purge()
+    claimed = await db.fetch_val(CLAIM_QUERY, scope, idempotency_key, request_hash, IDEMPOTENCY_TTL_HOURS)
+    if not claimed:
+        row = await db.fetch_row(SELECT_QUERY, scope, idempotency_key, IDEMPOTENCY_LOCK_TIMEOUT)
+        if row is not None and row["status_code"] is None and row["abandoned"]:
+            metrics.increment("idempotency_requests_total", result="abandoned")
+            raise HTTPException(
+                status_code=status.HTTP_409_CONFLICT,
+                detail="The request with this Idempotency-Key did not complete, it may have been applied. Check before sending it again with a new Idempotency-Key",
+            )
+        # The key expired and was purged meanwhile, the client can send the request again
+        if row is None or row["status_code"] is None:
+            metrics.increment("idempotency_requests_total", result="in_progress")
+            raise HTTPException(
+                status_code=status.HTTP_409_CONFLICT,
+                detail="A request with this Idempotency-Key is in progress",
+                headers={"Retry-After": "1"},
+            )
+        if bytes(row["request_hash"]) != request_hash:
+            metrics.increment("idempotency_requests_total", result="mismatch")
+            raise HTTPException(
+                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                detail="This Idempotency-Key was used with another request body",
+            )
+        metrics.increment("idempotency_requests_total", result="replayed")
+        return Response(
+            content=bytes(row["response"]),
+            status_code=row["status_code"],
+            media_type="application/json",
+            headers={"Idempotent-Replayed": "true"},
+        )
+
+    # On cancellation the creation may have been committed, the key is kept
+    try:
+        if in_transaction:
+            async with db.transaction() as con:
+                body = encode_response(await create(con))
+                await con.execute(COMPLETE_QUERY, scope, idempotency_key, status.HTTP_200_OK, body)
+        else:
+            body = encode_response(await create())
+    except Exception as e:
+        if nothing_written(e, in_transaction):
+            try:
+                await asyncio.shield(db.execute(RELEASE_QUERY, scope, idempotency_key))
+            except Exception as e2:
+                print("Idempotency ERROR while releasing the key: ", e2)
+        else:
+            metrics.increment("idempotency_requests_total", result="unknown")
+        raise
+    if not in_transaction:
+        try:
+            await db.execute(COMPLETE_QUERY, scope, idempotency_key, status.HTTP_200_OK, body)
+        except Exception as e:
+            # The creation is done, the key is kept: the retries get a 409 and never create again
+            print("Idempotency ERROR while storing the response: ", e)
+    metrics.increment("idempotency_requests_total", result="stored")
+    return Response(content=body, status_code=status.HTTP_200_OK, media_type="application/json")
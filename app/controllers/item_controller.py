@@ -1,10 +1,28 @@
+import asyncio
+import os
 from typing import List
+import asyncpg
 from fastapi import HTTPException, status
 from ..database.db_session import get_db
-from ..models.item import Item  
+from ..database.db import DatabaseUnavailable
+from ..models.item import Item, ItemBatch, ItemDeleteJob
+from .item_object_controller import remove_item_files, remove_orphan_files
 
 db = get_db()
 
+# Number of rows removed by each statement of a batched bulk delete
+ITEMS_DELETE_BATCH_SIZE = int(os.environ.get("ITEMS_DELETE_BATCH_SIZE", 5000))
+
+# Maximum time to wait for the lock needed by TRUNCATE, batches are used if it cannot be taken
+ITEMS_TRUNCATE_LOCK_TIMEOUT = os.environ.get("ITEMS_TRUNCATE_LOCK_TIMEOUT", "2s")
+
+# Seconds without progress after which a pending or running background deletion is considered orphaned
+# (its worker stopped or died), orphaned jobs are marked as failed when a worker starts
+ITEMS_DELETE_JOB_STALE_TIMEOUT = int(os.environ.get("ITEMS_DELETE_JOB_STALE_TIMEOUT", 300))
+
+# Keep a reference on the running background jobs so that they are not garbage collected
+background_jobs = set()
+
 # Custom exception
 class RecordNotFound(Exception):
     def __init__(self, message="Record not found"):
@@ -13,12 +31,18 @@ class RecordNotFound(Exception):
 
 
 # Function to create a new item
-async def create_item(item: Item) -> Item:
+# con is the connection of a transaction to create it in (see run_idempotent), by default the pool is used
+async def create_item(item: Item, con=None) -> Item:
     query = "INSERT INTO items (name, description) VALUES ($1, $2) RETURNING item_id;"
     try:
-        result = await db.fetch_val(query, item.name, item.description)
+        if con is not None:
+            result = await con.fetchval(query, item.name, item.description)
+        else:
+            result = await db.fetch_val(query, item.name, item.description)
         item.item_id = result
         return item
+    except DatabaseUnavailable:
+        raise
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -31,6 +55,8 @@ async def find_all_items() -> List[Item]:
     try: 
         result = await db.fetch_rows(query)
         return [Item(item_id=row["item_id"], name=row["name"], description=row["description"]) for row in result]
+    except DatabaseUnavailable:
+        raise
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -50,18 +76,39 @@ async def find_item_by_id(item_id: int) -> Item:
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Item not found"
         )
+    except DatabaseUnavailable:
+        raise
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail="Failed to retrieve item. Please try again later. " + str(e),
         )
 
+# Function to retrieve several items by ID in a single query
+# Items are returned in the requested order, the ids that do not exist are listed in missing
+async def find_items_by_ids(item_ids: List[int]) -> ItemBatch:
+    query = "SELECT item_id, name, description FROM items WHERE item_id = ANY($1::int[])"
+    try:
+        result = await db.fetch_rows(query, item_ids)
+        rows = {row["item_id"]: row for row in result}
+        items = [Item(item_id=rows[item_id]["item_id"], name=rows[item_id]["name"], description=rows[item_id]["description"]) for item_id in item_ids if item_id in rows]
+        missing = [item_id for item_id in item_ids if item_id not in rows]
+        return ItemBatch(items=items, missing=missing)
+    except DatabaseUnavailable:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Failed to retrieve items. Please try again later. " + str(e),
+        )
+
 # Function to delete an item by ID
 async def delete_item(item_id: int):
     query = "DELETE FROM items WHERE item_id = $1"
     try:
         deleted_rows = await db.execute(query, item_id)
         if deleted_rows == "DELETE 1":
+            await remove_item_files(item_id)
             return {"message": "Item deleted"}
         raise RecordNotFound
     except RecordNotFound:
@@ -69,27 +116,177 @@ async def delete_item(item_id: int):
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Item not found"
         )
+    except DatabaseUnavailable:
+        raise
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail="Failed to delete item. Please try again later. " + str(e),
         )
 
+# Function to check if TRUNCATE can be used on items (no other table references it)
+# item_objects is truncated with items
+async def can_truncate_items() -> bool:
+    query = "SELECT NOT EXISTS(SELECT 1 FROM pg_constraint WHERE contype = 'f' AND confrelid = 'items'::regclass AND conrelid <> 'item_objects'::regclass);"
+    return await db.fetch_val(query)
+
+# Function to empty items with TRUNCATE
+# Returns False if the table lock could not be taken in time (the table is busy)
+async def truncate_items() -> bool:
+    try:
+        async with db.transaction() as con:
+            await con.execute("SELECT set_config('lock_timeout', $1, true);", ITEMS_TRUNCATE_LOCK_TIMEOUT)
+            await con.execute("TRUNCATE items, item_objects;")
+        return True
+    except asyncpg.exceptions.LockNotAvailableError:
+        return False
+
+# Function to delete the items in batches, each batch is a short statement of its own
+# so locks are held briefly and the command timeout is never reached
+# on_progress is awaited with the number of rows deleted so far after each batch
+async def delete_items_in_batches(batch_size: int, on_progress=None) -> int:
+    query = "DELETE FROM items WHERE item_id IN (SELECT item_id FROM items LIMIT $1);"
+    deleted = 0
+    while True:
+        result = await db.execute(query, batch_size)
+        count = int(result.split()[-1])
+        deleted += count
+        if on_progress:
+            await on_progress(deleted)
+        if count < batch_size:
+            return deleted
+
+# Function to remove every item with the given mode
+# mode is "truncate", "batched" or "auto" (TRUNCATE when it is safe, batches otherwise)
+# Returns the mode used and the number of rows deleted (None with TRUNCATE)
+async def remove_all_items(mode: str, batch_size: int, on_progress=None) -> tuple[str, int | None]:
+    if mode in ("auto", "truncate"):
+        if await can_truncate_items() and await truncate_items():
+            await remove_orphan_files()
+            return "truncate", None
+        if mode == "truncate":
+            raise HTTPException(
+                status_code=status.HTTP_409_CONFLICT,
+                detail="Items cannot be truncated right now, use the batched mode"
+            )
+    deleted = await delete_items_in_batches(batch_size, on_progress)
+    await remove_orphan_files()
+    return "batched", deleted
+
 # Function to delete all items
-async def delete_all_items():
-    query = "DELETE FROM items"
+async def delete_all_items(mode: str = "auto", batch_size: int = ITEMS_DELETE_BATCH_SIZE):
+    query = "SELECT EXISTS(SELECT 1 FROM items);"
     try:
-        deleted_rows = await db.execute(query)
-        if deleted_rows != "DELETE 0":
-            return {"message": "All items deleted"}
-        raise RecordNotFound
+        has_items = await db.fetch_val(query)
+        if not has_items:
+            raise RecordNotFound
+        used_mode, deleted = await remove_all_items(mode, batch_size)
+        return {"message": "All items deleted", "mode": used_mode, "deleted": deleted}
     except RecordNotFound:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Item not found"
         )
+    except (HTTPException, DatabaseUnavailable):
+        raise
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail="Failed to delete items. Please try again later. " + str(e),
         )
+
+
+# Function to convert a row of item_delete_jobs to a job
+def job_from_row(row) -> ItemDeleteJob:
+    return ItemDeleteJob(
+        job_id=row["job_id"],
+        mode=row["mode"],
+        status=row["status"],
+        deleted=row["deleted"],
+        error=row["error"],
+        created_at=row["created_at"].strftime("%Y-%m-%d %H:%M:%S"),
+        finished_at=row["finished_at"].strftime("%Y-%m-%d %H:%M:%S") if row["finished_at"] else None,
+    )
+
+# Function to start deleting all items in the background
+# The job is stored in item_delete_jobs so that its status can be polled from any worker
+async def start_delete_all_items_job(mode: str = "auto", batch_size: int = ITEMS_DELETE_BATCH_SIZE) -> ItemDeleteJob:
+    query = "INSERT INTO item_delete_jobs (mode) VALUES ($1) RETURNING job_id, mode, status, deleted, error, created_at, finished_at;"
+    try:
+        row = await db.fetch_row(query, mode)
+    except DatabaseUnavailable:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Failed to start deleting items. Please try again later. " + str(e),
+        )
+    task = asyncio.create_task(run_delete_all_items_job(row["job_id"], mode, batch_size))
+    background_jobs.add(task)
+    task.add_done_callback(background_jobs.discard)
+    return job_from_row(row)
+
+# Function running a background deletion and recording its progress
+async def run_delete_all_items_job(job_id: int, mode: str, batch_size: int):
+    progress_query = "UPDATE item_delete_jobs SET status = 'running', deleted = $2, updated_at = NOW() WHERE job_id = $1;"
+    done_query = "UPDATE item_delete_jobs SET status = 'done', mode = $2, deleted = COALESCE($3, deleted), finished_at = NOW() WHERE job_id = $1;"
+    failed_query = "UPDATE item_delete_jobs SET status = 'failed', error = $2, finished_at = NOW() WHERE job_id = $1;"
+
+    async def on_progress(deleted: int):
+        await db.execute(progress_query, job_id, deleted)
+
+    try:
+        await on_progress(0)
+        used_mode, deleted = await remove_all_items(mode, batch_size, on_progress)
+        await db.execute(done_query, job_id, used_mode, deleted)
+    except (Exception, asyncio.CancelledError) as e:
+        error = "cancelled" if isinstance(e, asyncio.CancelledError) else str(getattr(e, "detail", e))
+        print("Item delete job ERROR: ", error)
+        try:
+            await db.execute(failed_query, job_id, error)
+        except Exception as e2:
+            print("Item delete job ERROR while saving the status: ", e2)
+        if isinstance(e, asyncio.CancelledError):
+            raise
+
+# Function to mark as failed the background deletions left pending or running by a worker that is gone
+# Called when a worker starts, the jobs of the other workers are still making progress and are kept
+async def fail_orphaned_delete_jobs():
+    query = "UPDATE item_delete_jobs SET status = 'failed', error = 'interrupted', finished_at = NOW() WHERE status IN ('pending', 'running') AND updated_at < NOW() - make_interval(secs => $1);"
+    try:
+        result = await db.execute(query, ITEMS_DELETE_JOB_STALE_TIMEOUT)
+        if int(result.split()[-1]):
+            print(f"Item delete job WARNING: {result.split()[-1]} orphaned job(s) marked as failed")
+    except Exception as e:
+        print("Item delete job ERROR while failing the orphaned jobs: ", e)
+
+# Function to stop the background deletions of the worker, at shutdown
+# They are cancelled and recorded as failed (see run_delete_all_items_job)
+async def stop_delete_jobs():
+    # Let the jobs just created start: a task cancelled before its first step could not record its failure
+    await asyncio.sleep(0)
+    tasks = list(background_jobs)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+# Function to retrieve a background deletion by ID
+async def find_delete_job_by_id(job_id: int) -> ItemDeleteJob:
+    query = "SELECT job_id, mode, status, deleted, error, created_at, finished_at FROM item_delete_jobs WHERE job_id = $1;"
+    try:
+        row = await db.fetch_row(query, job_id)
+        if row:
+            return job_from_row(row)
+        raise RecordNotFound
+    except RecordNotFound:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Job not found"
+        )
+    except DatabaseUnavailable:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Failed to retrieve job. Please try again later. " + str(e),
+        )
@@ -0,0 +1,355 @@
+import hashlib
+import os
+import time
+import uuid
+import asyncpg
+from fastapi import HTTPException, Request, status
+from multipart.multipart import MultipartParser, parse_options_header
+from starlette.concurrency import run_in_threadpool
+from ..database.db_session import get_db
+from ..database.db import DatabaseUnavailable
+from ..models.item import ItemObject
+from ..utils.file_response import RangeFileResponse
+
+db = get_db()
+
+# Directory of the files attached to the items, their metadata is in the item_objects table
+OBJECT_STORAGE_DIR = os.environ.get("OBJECT_STORAGE_DIR", "storage/objects")
+
+# Maximum size of a file (in bytes), 1 GiB by default
+OBJECT_MAX_SIZE = int(os.environ.get("OBJECT_MAX_SIZE", 1024 ** 3))
+
+# Files of the items that no longer exist are only removed once they are this old (in seconds),
+# so that an upload between the write of its file and of its metadata is left alone
+ORPHAN_MIN_AGE = 300
+
+# Suffix of the files being uploaded
+PART_SUFFIX = ".part"
+
+ITEM_EXISTS_QUERY = "SELECT EXISTS(SELECT 1 FROM items WHERE item_id = $1);"
+SELECT_OBJECT_QUERY = "SELECT item_id, filename, content_type, size, sha256, storage_key, created_at FROM item_objects WHERE item_id = $1;"
+DELETE_OBJECT_QUERY = "DELETE FROM item_objects WHERE item_id = $1 RETURNING storage_key;"
+EXISTING_KEYS_QUERY = "SELECT storage_key FROM item_objects WHERE storage_key = ANY($1::varchar[]);"
+# The previous file of the item is returned so that it can be removed
+# (locked, so two uploads for the same item each get the key that the other replaced)
+UPSERT_OBJECT_QUERY = """
+WITH previous AS (
+    SELECT storage_key FROM item_objects WHERE item_id = $1 FOR UPDATE
+)
+INSERT INTO item_objects (item_id, filename, content_type, size, sha256, storage_key)
+VALUES ($1, $2, $3, $4, $5, $6)
+ON CONFLICT (item_id) DO UPDATE SET
+    filename = EXCLUDED.filename,
+    content_type = EXCLUDED.content_type,
+    size = EXCLUDED.size,
+    sha256 = EXCLUDED.sha256,
+    storage_key = EXCLUDED.storage_key,
+    created_at = NOW()
+RETURNING (SELECT storage_key FROM previous) AS previous_key, created_at;
+"""
+
+
+# Custom exception
+class RecordNotFound(Exception):
+    def __init__(self, message="Record not found"):
+        self.message = message
+        super().__init__(self.message)
+
+
+# Function to get the path of a stored file
+def storage_path(storage_key: str) -> str:
+    return os.path.join(OBJECT_STORAGE_DIR, storage_key)
+
+
+def remove_file(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+# Function to convert a row of item_objects to an object
+def object_from_row(row) -> ItemObject:
+    return ItemObject(
+        item_id=row["item_id"],
+        filename=row["filename"],
+        content_type=row["content_type"],
+        size=row["size"],
+        sha256=row["sha256"],
+        created_at=row["created_at"].strftime("%Y-%m-%d %H:%M:%S"),
+    )
+
+
+# Receiver of the events of the multipart parser
+# The content of the first file of the "file" field is kept until take_data() is called,
+# the other fields are ignored
+class MultipartFileReceiver:
+
+    def __init__(self):
+        self.filename = None
+        self.content_type = None
+        self.found = False
+        self.finished = False
+        self._in_file = False
+        self._headers = {}
+        self._field = b""
+        self._value = b""
+        self._data = []
+
+    def callbacks(self) -> dict:
+        return {
+            "on_part_begin": self._on_part_begin,
+            "on_header_field": self._on_header_field,
+            "on_header_value": self._on_header_value,
+            "on_header_end": self._on_header_end,
+            "on_headers_finished": self._on_headers_finished,
+            "on_part_data": self._on_part_data,
+            "on_part_end": self._on_part_end,
+        }
+
+    # Function to get the file content received since the last call
+    def take_data(self) -> bytes:
+        data = b"".join(self._data)
+        self._data = []
+        return data
+
+    def _on_part_begin(self):
+        self._headers = {}
+
+    def _on_header_field(self, data: bytes, start: int, end: int):
+        self._field += data[start:end]
+
+    def _on_header_value(self, data: bytes, start: int, end: int):
+        self._value += data[start:end]
+
+    def _on_header_end(self):
+        self._headers[self._field.lower()] = self._value
+        self._field = b""
+        self._value = b""
+
+    def _on_headers_finished(self):
+        _, options = parse_options_header(self._headers.get(b"content-disposition", b""))
+        if self.found or options.get(b"name") != b"file" or b"filename" not in options:
+            return
+        self.found = True
+        self._in_file = True
+        self.filename = options[b"filename"].decode("utf-8", "replace")
+        self.content_type = self._headers.get(b"content-type", b"application/octet-stream").decode("latin-1")
+
+    def _on_part_data(self, data: bytes, start: int, end: int):
+        if self._in_file:
+            self._data.append(data[start:end])
+
+    def _on_part_end(self):
+        if self._in_file:
+            self._in_file = False
+            self.finished = True
+
+
+# Function to write a chunk of the upload and add it to the hash, run in a thread
+def write_chunk(file, hasher, data: bytes):
+    hasher.update(data)
+    file.write(data)
+
+
+# Function to close the uploaded file, once its content is on disk
+def close_upload(file):
+    file.flush()
+    os.fsync(file.fileno())
+    file.close()
+
+
+# Function to store the file sent in the "file" field of a multipart/form-data request
+# The body is parsed as it arrives: each chunk is written to disk and hashed, nothing else is kept
+# The file replaces the previous one of the item
+async def upload_item_object(item_id: int, request: Request) -> ItemObject:
+    content_type, options = parse_options_header(request.headers.get("content-type", ""))
+    if content_type != b"multipart/form-data" or b"boundary" not in options:
+        raise HTTPException(
+            status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+            detail="The file must be sent as multipart/form-data in the file field"
+        )
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > OBJECT_MAX_SIZE + 64 * 1024:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f"The file must not exceed {OBJECT_MAX_SIZE} bytes"
+        )
+    # Check the item before receiving the file
+    if not await db.fetch_val(ITEM_EXISTS_QUERY, item_id):
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Item not found"
+        )
+
+    storage_key = f"{item_id}-{uuid.uuid4().hex}"
+    path = storage_path(storage_key)
+    part_path = path + PART_SUFFIX
+    receiver = MultipartFileReceiver()
+    parser = MultipartParser(options[b"boundary"], receiver.callbacks())
+    hasher = hashlib.sha256()
+    size = 0
+    await run_in_threadpool(os.makedirs, OBJECT_STORAGE_DIR, exist_ok=True)
+    file = await run_in_threadpool(open, part_path, "wb")
+    try:
+        try:
+            async for chunk in request.stream():
+                parser.write(chunk)
+                data = receiver.take_data()
+                if not data:
+                    continue
+                size += len(data)
+                if size > OBJECT_MAX_SIZE:
+                    raise HTTPException(
+                        status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                        detail=f"The file must not exceed {OBJECT_MAX_SIZE} bytes"
+                    )
+                await run_in_threadpool(write_chunk, file, hasher, data)
+            parser.finalize()
+        finally:
+            await run_in_threadpool(close_upload, file)
+        if not receiver.finished:
+            raise HTTPException(
+                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                detail="No file was sent in the file field"
+            )
+        await run_in_threadpool(os.replace, part_path, path)
+    except BaseException:
+        await run_in_threadpool(remove_file, part_path)
+        raise
+
+    sha256 = hasher.hexdigest()
+    try:
+        try:
+            row = await db.fetch_row(UPSERT_OBJECT_QUERY, item_id, receiver.filename, receiver.content_type, size, sha256, storage_key)
+        except BaseException:
+            remove_file(path)
+            raise
+    except asyncpg.exceptions.ForeignKeyViolationError:
+        # The item was deleted during the upload
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Item not found"
+        )
+    except DatabaseUnavailable:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Failed to save the file. Please try again later. " + str(e),
+        )
+    if row["previous_key"]:
+        await run_in_threadpool(remove_file, storage_path(row["previous_key"]))
+    return ItemObject(item_id=item_id, filename=receiver.filename, content_type=receiver.content_type, size=size, sha256=sha256, created_at=row["created_at"].strftime("%Y-%m-%d %H:%M:%S"))
+
+
+# Function to retrieve the metadata of the file of an item
+async def find_item_object(item_id: int) -> ItemObject:
+    try:
+        row = await db.fetch_row(SELECT_OBJECT_QUERY, item_id)
+        if row:
+            return row
+        raise RecordNotFound
+    except RecordNotFound:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Item has no file"
+        )
+    except DatabaseUnavailable:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Failed to retrieve the file. Please try again later. " + str(e),
+        )
+
+
+# Function to get the metadata of the file of an item
+async def find_item_object_metadata(item_id: int) -> ItemObject:
+    return object_from_row(await find_item_object(item_id))
+
+
+# Function to build the response sending the file of an item, Range requests are supported
+# The ETag is the SHA-256 of the content
+async def download_item_object(item_id: int) -> RangeFileResponse:
+    row = await find_item_object(item_id)
+    path = storage_path(row["storage_key"])
+    try:
+        stat_result = await run_in_threadpool(os.stat, path)
+    except FileNotFoundError:
+        print(f"Item object ERROR: file {path} of item {item_id} is missing")
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Item has no file"
+        )
+    return RangeFileResponse(
+        path,
+        size=row["size"],
+        media_type=row["content_type"],
+        etag=f'"{row["sha256"]}"',
+        filename=row["filename"],
+        mtime=stat_result.st_mtime,
+    )
+
+
+# Function to delete the file of an item
+async def delete_item_object(item_id: int):
+    try:
+        storage_key = await db.fetch_val(DELETE_OBJECT_QUERY, item_id)
+        if storage_key is None:
+            raise RecordNotFound
+    except RecordNotFound:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Item has no file"
+        )
+    except DatabaseUnavailable:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Failed to delete the file. Please try again later. " + str(e),
+        )
+    await run_in_threadpool(remove_file, storage_path(storage_key))
+    return {"message": "File deleted"}
+
+
+# Function to list the stored files (not the uploads in progress)
+def list_stored_files(prefix: str = "") -> list[str]:
+    try:
+        names = os.listdir(OBJECT_STORAGE_DIR)
+    except FileNotFoundError:
+        return []
+    return [name for name in names if name.startswith(prefix) and not name.endswith(PART_SUFFIX)]
+
+
+# Function to remove the files of a deleted item (its metadata is removed by ON DELETE CASCADE)
+async def remove_item_files(item_id: int):
+    for name in await run_in_threadpool(list_stored_files, f"{item_id}-"):
+        await run_in_threadpool(remove_file, storage_path(name))
+
+
+# Function to remove the files that no longer have metadata, eg: after deleting all items
+# Returns the number of files removed
+async def remove_orphan_files(min_age: float = ORPHAN_MIN_AGE) -> int:
+    def old_files():
+        now = time.time()
+        files = []
+        for name in list_stored_files():
+            try:
+                if now - os.stat(storage_path(name)).st_mtime >= min_age:
+                    files.append(name)
+            except FileNotFoundError:
+                pass
+        return files
+
+    names = await run_in_threadpool(old_files)
+    removed = 0
+    for start in range(0, len(names), 1000):
+        batch = names[start:start + 1000]
+        existing = {row["storage_key"] for row in await db.fetch_rows(EXISTING_KEYS_QUERY, batch)}
+        for name in batch:
+            if name not in existing:
+                await run_in_threadpool(remove_file, storage_path(name))
+                removed += 1
+    return removed
@@ -1,11 +1,15 @@
 from typing import List
 from fastapi import HTTPException, status
-from ..database.db_session import get_db
-from ..models.post import Post
+from ..database.db_session import get_post_shards
+from ..database.db import DatabaseUnavailable
+from ..models.post import Post, PostBatch, PostSummary
 from ..models.user import UserIdAndUsername
+from ..utils.single_flight import single_flight
+from .post_shard_controller import find_posts, find_posts_by_ids as find_post_rows_by_ids
 from datetime import datetime
 
-db = get_db()
+# The posts are read and written on their database: the main one, or their shard (see database/shards.py)
+shards = get_post_shards()
 
 # Custom exception
 class RecordNotFound(Exception):
@@ -15,18 +19,17 @@ class RecordNotFound(Exception):
 
 # Function to create a new post
 async def create_post(post: Post, user: UserIdAndUsername) -> Post:
+    # The post is stored on the shard of its author
+    posts_db = shards.for_user(user.user_id)
     query = "INSERT INTO posts (title, content, created_at) VALUES ($1, $2, NOW()) RETURNING post_id;"
+    owner_query = "INSERT INTO post_user (post_id, user_id) VALUES ($1, $2);"
+    # A single transaction, so that a post is never left without its author
     try:
-        result = await db.fetch_val(query, post.title, post.content)
-        post.post_id = result
-    except Exception as e:
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail="Failed to create the post. Please try again later. " + str(e),
-        )
-    query = "INSERT INTO post_user (post_id, user_id) VALUES ($1, $2);"
-    try:
-        await db.execute(query, post.post_id, user.user_id)
+        async with posts_db.transaction() as con:
+            post.post_id = await con.fetchval(query, post.title, post.content)
+            await con.execute(owner_query, post.post_id, user.user_id)
+    except DatabaseUnavailable:
+        raise
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -38,14 +41,52 @@ async def create_post(post: Post, user: UserIdAndUsername) -> Post:
     return post
 
 
+# Columns that can be selected on the post listing, all of them by default as on the unprojected listing
+POST_FIELDS = ("post_id", "title", "content", "created_at", "user_id", "username", "views")
+
+# Function to parse the fields requested on the post listing
+# Example: "title,username" -> ["title", "username"]
+def parse_post_fields(fields: str) -> List[str]:
+    field_list = list(dict.fromkeys(field.strip() for field in fields.split(",") if field.strip()))
+    unknown = [field for field in field_list if field not in POST_FIELDS]
+    if unknown or not field_list:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail="fields must be a comma separated list of: " + ", ".join(POST_FIELDS)
+        )
+    return field_list
+
 # Function to retrieve all posts
+# With shards, the posts of every shard are merged by date
 async def find_all_posts() -> List[Post]:
-    query = "SELECT post_id, title, content, created_at, user_id, username FROM posts JOIN post_user USING (post_id) JOIN users USING (user_id) ORDER BY created_at DESC;"
     try: 
-        result = await db.fetch_rows(query)
+        result = await find_posts()
         if result is None:
             return [] 
-        return [Post(post_id=row["post_id"], title=row["title"], content=row["content"], created_at=row["created_at"].strftime("%Y-%m-%d %H:%M:%S"), user_id=row["user_id"], username=row["username"]) for row in result]
+        return [Post(post_id=row["post_id"], title=row["title"], content=row["content"], created_at=row["created_at"].strftime("%Y-%m-%d %H:%M:%S"), user_id=row["user_id"], username=row["username"], views=row["views"]) for row in result]
+    except DatabaseUnavailable:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Failed to retrieve posts. Please try again later. " + str(e),
+        )
+
+# Function to retrieve all posts with only the given fields
+# excerpt_len truncates the content in SQL, so only the excerpt leaves the database
+async def find_all_posts_projected(fields: List[str] | None = None, excerpt_len: int | None = None) -> List[PostSummary]:
+    fields = fields or list(POST_FIELDS)
+    try:
+        result = await find_posts(fields, excerpt_len=excerpt_len)
+        posts = []
+        for row in result:
+            post = dict(row)
+            if post.get("created_at") is not None:
+                post["created_at"] = post["created_at"].strftime("%Y-%m-%d %H:%M:%S")
+            posts.append(PostSummary(**post))
+        return posts
+    except DatabaseUnavailable:
+        raise
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -53,17 +94,21 @@ async def find_all_posts() -> List[Post]:
         )
 
 # Function to retrieve a single post
+# Concurrent calls share the same query
+@single_flight
 async def find_one_post() -> Post:
-    range = "LIMIT 1"
-    query = "SELECT post_id, title, content, created_at, user_id, username FROM posts JOIN post_user USING (post_id) JOIN users USING (user_id) ORDER BY created_at DESC " + range + ";"
     try:
-        result = await db.fetch_row(query)
+        # With shards, the latest post of each shard is read and the latest of them is kept
+        rows = await find_posts(limit=1)
+        result = rows[0] if rows else None
         if result:
-            return Post(post_id=result["post_id"], title=result["title"], content=result["content"], user_id=result["user_id"], username=result["username"], created_at=result["created_at"].strftime("%Y-%m-%d %H:%M:%S"))
+            return Post(post_id=result["post_id"], title=result["title"], content=result["content"], user_id=result["user_id"], username=result["username"], created_at=result["created_at"].strftime("%Y-%m-%d %H:%M:%S"), views=result["views"])
         else:
             # Create placeholder post
             return Post(post_id=0, title="Prendre soin de l'environement", content="C'est important", user_id=0, username="Mike", created_at="2023-12-08 1:00:00")
         
+    except DatabaseUnavailable:
+        raise
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -71,12 +116,14 @@ async def find_one_post() -> Post:
         )
 
 # Function to retrieve a post by ID
+# Concurrent calls for the same post share the same query
+@single_flight
 async def find_post_by_id(post_id: int) -> Post:
-    query = "SELECT post_id, title, content, created_at, user_id, username FROM posts JOIN post_user USING (post_id) JOIN users USING (user_id) WHERE post_id = $1;"
     try:
-        result = await db.fetch_row(query, post_id)
+        rows = await find_post_rows_by_ids([post_id])
+        result = rows[0] if rows else None
         if result:
-            return Post(post_id=result["post_id"], title=result["title"], content=result["content"], user_id=result["user_id"], username=result["username"], created_at=result["created_at"].strftime("%Y-%m-%d %H:%M:%S"))
+            return Post(post_id=result["post_id"], title=result["title"], content=result["content"], user_id=result["user_id"], username=result["username"], created_at=result["created_at"].strftime("%Y-%m-%d %H:%M:%S"), views=result["views"])
         else:
             raise RecordNotFound
     except RecordNotFound:
@@ -84,31 +131,73 @@ async def find_post_by_id(post_id: int) -> Post:
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Post not found"
         )
+    except DatabaseUnavailable:
+        raise
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail="Failed to retrieve post. Please try again later. " + str(e),
         )
 
-# Function to update a post by ID
-async def update_post(post_id: int, post: Post, user: UserIdAndUsername) -> Post:
-    is_owner = await is_post_owner(post_id, user.user_id)
-    if not is_owner:
+# Function to retrieve several posts by ID in a single query
+# Posts are returned in the requested order, the ids that do not exist are listed in missing
+async def find_posts_by_ids(post_ids: List[int]) -> PostBatch:
+    try:
+        result = await find_post_rows_by_ids(post_ids)
+        rows = {row["post_id"]: row for row in result}
+        posts = []
+        for post_id in post_ids:
+            row = rows.get(post_id)
+            if row:
+                posts.append(Post(post_id=row["post_id"], title=row["title"], content=row["content"], user_id=row["user_id"], username=row["username"], created_at=row["created_at"].strftime("%Y-%m-%d %H:%M:%S"), views=row["views"]))
+        missing = [post_id for post_id in post_ids if post_id not in rows]
+        return PostBatch(posts=posts, missing=missing)
+    except DatabaseUnavailable:
+        raise
+    except Exception as e:
         raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="You don't have permission to update this post",
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Failed to retrieve posts. Please try again later. " + str(e),
         )
-    query = "UPDATE posts SET title=$1, content=$2 WHERE post_id=$3;"
+
+# Function to update a post by ID
+# The ownership check and the update run in a single statement:
+# no row means the post does not exist, is_owner false means the user is not its owner
+async def update_post(post_id: int, post: Post, user: UserIdAndUsername) -> Post:
+    query = """
+    WITH target AS (
+        SELECT p.post_id, EXISTS(SELECT 1 FROM post_user pu WHERE pu.post_id = p.post_id AND pu.user_id = $4) AS is_owner
+        FROM posts p
+        WHERE p.post_id = $3
+    ), updated AS (
+        UPDATE posts p SET title = $1, content = $2
+        FROM target t
+        WHERE p.post_id = t.post_id AND t.is_owner
+        RETURNING p.post_id, p.title, p.content, p.created_at
+    )
+    SELECT t.is_owner, u.post_id, u.title, u.content, u.created_at
+    FROM target t LEFT JOIN updated u ON u.post_id = t.post_id;
+    """
     try:
-        result = await db.execute(query, post.title, post.content, post_id)
-        if result == "UPDATE 1":
-            return post
-        raise RecordNotFound
+        result = await shards.for_post(post_id).fetch_row(query, post.title, post.content, post_id, user.user_id)
+        if result is None:
+            raise RecordNotFound
+        if not result["is_owner"]:
+            raise HTTPException(
+                status_code=status.HTTP_401_UNAUTHORIZED,
+                detail="You don't have permission to update this post",
+            )
+        # The post was deleted between the check and the update
+        if result["post_id"] is None:
+            raise RecordNotFound
+        return Post(post_id=result["post_id"], title=result["title"], content=result["content"], user_id=user.user_id, username=user.username, created_at=result["created_at"].strftime("%Y-%m-%d %H:%M:%S"))
     except RecordNotFound:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
-            detail="Post not found or you don't have permission to update it"
+            detail="Post not found"
         )
+    except (HTTPException, DatabaseUnavailable):
+        raise
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -116,40 +205,44 @@ async def update_post(post_id: int, post: Post, user: UserIdAndUsername) -> Post
         )
 
 # Function to delete a post by ID
+# The ownership check and the delete run in a single statement, like update_post
 async def delete_post(post_id: int, user: UserIdAndUsername):
-    is_owner = await is_post_owner(post_id, user.user_id)
-    if not is_owner:
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="You don't have permission to delete this post",
-        )
-    query = "DELETE FROM posts WHERE post_id = $1;"
+    query = """
+    WITH target AS (
+        SELECT p.post_id, EXISTS(SELECT 1 FROM post_user pu WHERE pu.post_id = p.post_id AND pu.user_id = $2) AS is_owner
+        FROM posts p
+        WHERE p.post_id = $1
+    ), deleted AS (
+        DELETE FROM posts p
+        USING target t
+        WHERE p.post_id = t.post_id AND t.is_owner
+        RETURNING p.post_id
+    )
+    SELECT t.is_owner, d.post_id
+    FROM target t LEFT JOIN deleted d ON d.post_id = t.post_id;
+    """
     try:
-        deleted_rows = await db.execute(query, post_id)
-        if deleted_rows == "DELETE 1":
-            return {"message": "Post deleted"}
-        raise RecordNotFound
+        result = await shards.for_post(post_id).fetch_row(query, post_id, user.user_id)
+        if result is None:
+            raise RecordNotFound
+        if not result["is_owner"]:
+            raise HTTPException(
+                status_code=status.HTTP_401_UNAUTHORIZED,
+                detail="You don't have permission to delete this post",
+            )
+        if result["post_id"] is None:
+            raise RecordNotFound
+        return {"message": "Post deleted"}
     except RecordNotFound:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
-            detail="Post not found or you don't have permission to delete it"
+            detail="Post not found"
         )
+    except (HTTPException, DatabaseUnavailable):
+        raise
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail="Failed to delete post. Please try again later. " + str(e),
         )
 
-
-# Function that takes a post id and a user id and returns True if the user is the owner of the post
-async def is_post_owner(post_id: int, user_id: str) -> bool:
-    query = "SELECT EXISTS(SELECT 1 FROM post_user WHERE post_id = $1 AND user_id = $2);"
-    try:
-        result = await db.fetch_val(query, post_id, user_id)
-        return result
-    except Exception as e:
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail="Failed to check if user is owner of post. Please try again later. " + str(e),
-        )
-
@@ -0,0 +1,284 @@
+import asyncio
+import os
+import time
+from fastapi import HTTPException
+from ..database.db_session import get_db, get_post_shards
+from ..database.db import DatabaseUnavailable
+from ..utils.metrics import get_metrics
+
+db = get_db()
+shards = get_post_shards()
+
+# Channel of the notifications sent by the triggers of sql/post_events.sql
+POST_EVENTS_CHANNEL = "post_events"
+
+# Events waiting to be sent to a single client, a client falling further behind
+# is caught up from the post_events table instead of holding memory
+POST_STREAM_QUEUE_SIZE = int(os.environ.get("POST_STREAM_QUEUE_SIZE", 100))
+# Seconds between two keep-alive comments on an idle stream
+POST_STREAM_HEARTBEAT = float(os.environ.get("POST_STREAM_HEARTBEAT", 15))
+# Delay (in milliseconds) before the browser reconnects a closed stream
+POST_STREAM_RETRY_MS = int(os.environ.get("POST_STREAM_RETRY_MS", 3000))
+# Hours the events are kept, a client resuming from an older event is asked to reload the posts
+POST_EVENTS_RETENTION_HOURS = int(os.environ.get("POST_EVENTS_RETENTION_HOURS", 24))
+
+# Number of events read per query
+EVENTS_PAGE_SIZE = 500
+# Seconds between two purges of the old events
+PRUNE_INTERVAL = 3600
+# Delay before listening again after the listener connection was lost, doubled on each failure
+LISTEN_RETRY_DELAY = 1
+MAX_LISTEN_RETRY_DELAY = 30
+# Seconds between two reads while a notified event is not readable yet (an older transaction is still running)
+PENDING_EVENTS_POLL_INTERVAL = 0.2
+# Seconds after which a notified event that never became readable is given up
+PENDING_EVENTS_TIMEOUT = 60
+
+# The events are read in (tx_id, event_id) order, see sql/post_events.sql
+# A position is the (tx_id, event_id) of an event, START_POSITION is before every event
+START_POSITION = (0, 0)
+MAX_POSITION = (2 ** 63 - 1, 2 ** 63 - 1)
+
+# Only the events of the transactions older than every running one are read, no event can appear before them
+LAST_POSITION_QUERY = "SELECT tx_id, event_id FROM post_events WHERE tx_id < pg_snapshot_xmin(pg_current_snapshot())::text::bigint ORDER BY tx_id DESC, event_id DESC LIMIT 1;"
+EVENT_POSITION_QUERY = "SELECT tx_id, event_id FROM post_events WHERE event_id = $1;"
+EVENTS_QUERY = "SELECT event_id, tx_id, kind, data::text AS data FROM post_events WHERE (tx_id, event_id) > ($1, $2) AND (tx_id, event_id) <= ($3, $4) AND tx_id < pg_snapshot_xmin(pg_current_snapshot())::text::bigint ORDER BY tx_id, event_id LIMIT $5;"
+PRUNE_QUERY = "DELETE FROM post_events WHERE created_at < NOW() - make_interval(hours => $1);"
+
+
+# Function to get the position of an event
+def event_position(event) -> tuple[int, int]:
+    return (event["tx_id"], event["event_id"])
+
+
+# Function to get the position of the last event that can be read
+async def find_last_position() -> tuple[int, int]:
+    row = await db.fetch_row(LAST_POSITION_QUERY)
+    return event_position(row) if row else START_POSITION
+
+
+# Function to get the position of an event from its id, None if it does not exist (anymore)
+async def find_event_position(event_id: int) -> tuple[int, int] | None:
+    row = await db.fetch_row(EVENT_POSITION_QUERY, event_id)
+    return event_position(row) if row else None
+
+
+# Function to read the events after the position after, up to the position until, in pages
+async def read_events(after: tuple[int, int], until: tuple[int, int] = MAX_POSITION):
+    while True:
+        rows = await db.fetch_rows(EVENTS_QUERY, *after, *until, EVENTS_PAGE_SIZE)
+        for row in rows:
+            yield dict(row)
+        if len(rows) < EVENTS_PAGE_SIZE:
+            return
+        after = event_position(rows[-1])
+
+
+# Function to format an event for the text/event-stream response
+# data is the post as JSON (only post_id for a deleted post)
+def format_event(event: dict) -> str:
+    return f"id: {event['event_id']}\nevent: {event['kind']}\ndata: {event['data']}\n\n"
+
+
+# Function to format the reset event, sent to a client that missed events that have been purged
+def format_reset(position: tuple[int, int]) -> str:
+    event_id = f"id: {position[1]}\n" if position != START_POSITION else ""
+    return f"{event_id}event: reset\ndata: {{}}\n\n"
+
+
+# A client of the stream
+# start_position is the last event published when it subscribed, the next ones go to its queue
+# lagged is set when its queue was full: it no longer receives events and must catch up
+class Subscriber:
+
+    def __init__(self, start_position: tuple[int, int]):
+        self.start_position = start_position
+        self.queue = asyncio.Queue(maxsize=POST_STREAM_QUEUE_SIZE)
+        self.lagged = False
+        self.closed = False
+
+
+# Class that listens to the post events of the database with a single connection per worker
+# and fans them out to the streams
+# The notifications only wake it up: it reads the events after the last one it published,
+# so nothing is lost when notifications are merged or when the listener reconnects
+# A notified event can be unreadable for a while (an older transaction is still running),
+# the events are then read again every PENDING_EVENTS_POLL_INTERVAL seconds until it is published
+class PostEventBroker:
+
+    def __init__(self):
+        self.subscribers = set()
+        self.last_position = None
+        self._pending = {}
+        self._task = None
+        self._started = None
+        self._wakeup = asyncio.Event()
+        self._lost = False
+        self._last_prune = 0.0
+
+    # Function to add a stream, the listener is started with the first one
+    # Raises DatabaseUnavailable if the listener cannot be started
+    # The events are only written by the main database: when the posts are sharded (POSTGRES_SHARDS)
+    # the shards have neither the triggers nor the users table they read, so the stream is refused
+    async def subscribe(self) -> Subscriber:
+        if shards.enabled:
+            raise HTTPException(status_code=501, detail="The post event stream is not available when the posts are sharded")
+        if self._task is None:
+            self._started = asyncio.get_running_loop().create_future()
+            self._task = asyncio.create_task(self._run())
+        await asyncio.shield(self._started)
+        subscriber = Subscriber(self.last_position)
+        self.subscribers.add(subscriber)
+        get_metrics().set_gauge("post_stream_subscribers", len(self.subscribers))
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber):
+        self.subscribers.discard(subscriber)
+        get_metrics().set_gauge("post_stream_subscribers", len(self.subscribers))
+
+    # Function to stop the listener and end the streams (on shutdown)
+    async def stop(self):
+        if self._started and not self._started.done():
+            self._started.set_exception(DatabaseUnavailable("Shutting down", LISTEN_RETRY_DELAY))
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for subscriber in self.subscribers:
+            subscriber.closed = True
+            try:
+                subscriber.queue.put_nowait(None)
+            except asyncio.QueueFull:
+                pass
+        self.subscribers.clear()
+        self.last_position = None
+        self._pending = {}
+        self._wakeup = asyncio.Event()
+
+    # Called for each notification, the payload is the id of the new event
+    def _notified(self, payload: str):
+        self._pending[int(payload)] = time.monotonic()
+        self._wakeup.set()
+
+    def _connection_lost(self):
+        self._lost = True
+        self._wakeup.set()
+
+    # Function to send an event to every stream, without ever waiting for a slow one
+    def _publish(self, event: dict):
+        self.last_position = event_position(event)
+        self._pending.pop(event["event_id"], None)
+        for subscriber in list(self.subscribers):
+            try:
+                subscriber.queue.put_nowait(event)
+            except asyncio.QueueFull:
+                subscriber.lagged = True
+                self.unsubscribe(subscriber)
+                get_metrics().increment("post_stream_lagged_total")
+
+    async def _publish_new_events(self):
+        async for event in read_events(self.last_position):
+            self._publish(event)
+        given_up = [event_id for event_id, notified_at in self._pending.items() if time.monotonic() - notified_at > PENDING_EVENTS_TIMEOUT]
+        for event_id in given_up:
+            del self._pending[event_id]
+
+    # Seconds to wait for the next notification: short while a notified event is not readable yet
+    def _wait_timeout(self) -> float:
+        return PENDING_EVENTS_POLL_INTERVAL if self._pending else PRUNE_INTERVAL
+
+    async def _prune(self):
+        if time.monotonic() - self._last_prune < PRUNE_INTERVAL:
+            return
+        self._last_prune = time.monotonic()
+        await db.execute(PRUNE_QUERY, POST_EVENTS_RETENTION_HOURS)
+
+    async def _run(self):
+        delay = LISTEN_RETRY_DELAY
+        while True:
+            listener = None
+            try:
+                self._lost = False
+                listener = await db.listen(POST_EVENTS_CHANNEL, self._notified, self._connection_lost)
+                if self.last_position is None:
+                    self.last_position = await find_last_position()
+                    self._started.set_result(None)
+                # The events committed while the listener was down
+                await self._publish_new_events()
+                delay = LISTEN_RETRY_DELAY
+                while not self._lost:
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), self._wait_timeout())
+                    except asyncio.TimeoutError:
+                        pass
+                    self._wakeup.clear()
+                    await self._publish_new_events()
+                    await self._prune()
+                print("Post events WARNING: listener connection lost")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print("Post events ERROR: ", e)
+                if not self._started.done():
+                    self._started.set_exception(DatabaseUnavailable("Post events unavailable", LISTEN_RETRY_DELAY))
+                    self._task = None
+                    return
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, MAX_LISTEN_RETRY_DELAY)
+            finally:
+                if listener is not None:
+                    try:
+                        await listener.close()
+                    except Exception:
+                        pass
+
+
+post_event_broker = PostEventBroker()
+
+
+# Function to send the events of the missed range (after, until] to a client
+# Yields the text to send and the position of the last event sent
+async def catch_up(after: tuple[int, int], until: tuple[int, int]):
+    async for event in read_events(after, until):
+        yield format_event(event), event_position(event)
+
+
+# Function generating the text/event-stream of the post changes for a subscriber of post_event_broker
+# (subscribed before the response starts, so that an unavailable database gives a 503)
+# last_event_id is the Last-Event-ID sent by the browser when it reconnects
+# A client resuming from an event that has been purged gets a reset event: it must reload the posts
+async def stream_post_events(subscriber: Subscriber, last_event_id: int | None = None):
+    last_sent = subscriber.start_position
+    try:
+        yield f"retry: {POST_STREAM_RETRY_MS}\n\n"
+        if last_event_id is not None:
+            last_sent = await find_event_position(last_event_id)
+            if last_sent is None:
+                yield format_reset(subscriber.start_position)
+                last_sent = subscriber.start_position
+        while not subscriber.closed:
+            # Too slow: the events it missed are read again from the table
+            if subscriber.lagged and subscriber.queue.empty():
+                post_event_broker.unsubscribe(subscriber)
+                subscriber = await post_event_broker.subscribe()
+            if last_sent < subscriber.start_position:
+                async for text, position in catch_up(last_sent, subscriber.start_position):
+                    yield text
+                    last_sent = position
+                last_sent = max(last_sent, subscriber.start_position)
+            try:
+                event = await asyncio.wait_for(subscriber.queue.get(), POST_STREAM_HEARTBEAT)
+            except asyncio.TimeoutError:
+                yield ": keep-alive\n\n"
+                continue
+            if event is None:
+                return
+            if event_position(event) <= last_sent:
+                continue
+            yield format_event(event)
+            last_sent = event_position(event)
+    finally:
+        post_event_broker.unsubscribe(subscriber)
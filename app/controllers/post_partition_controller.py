@@ -0,0 +1,79 @@
+import asyncio
+import os
+from ..database.db_session import get_post_shards
+from ..utils.metrics import get_metrics
+
+shards = get_post_shards()
+
+# Months of partitions of posts created ahead of the current one (see sql/posts_partitions.sql)
+POST_PARTITIONS_AHEAD_MONTHS = int(os.environ.get("POST_PARTITIONS_AHEAD_MONTHS", 3))
+
+# Months of posts kept in posts, the older partitions are removed (0 keeps every partition)
+POST_PARTITIONS_RETENTION_MONTHS = int(os.environ.get("POST_PARTITIONS_RETENTION_MONTHS", 0))
+
+# What is done with the removed partitions: "archive" (moved to the posts_archive schema) or "drop"
+POST_PARTITIONS_ARCHIVE_MODE = os.environ.get("POST_PARTITIONS_ARCHIVE_MODE", "archive")
+
+# Seconds between two runs of the partition maintenance
+POST_PARTITIONS_MAINTENANCE_INTERVAL = float(os.environ.get("POST_PARTITIONS_MAINTENANCE_INTERVAL", 3600))
+
+CREATE_QUERY = "SELECT create_post_partitions(NOW(), NOW() + make_interval(months => $1)) AS partition;"
+# The current month is kept whole: the posts of the retention months and of the current one stay
+ARCHIVE_QUERY = "SELECT archive_post_partitions(date_trunc('month', NOW() AT TIME ZONE 'UTC') AT TIME ZONE 'UTC' - make_interval(months => $1), $2) AS partition;"
+
+
+# Function to create the partitions ahead and remove the old ones, on every shard when the posts are sharded
+# Returns the names of the created and of the removed partitions
+async def maintain_post_partitions() -> tuple[list[str], list[str]]:
+    created = []
+    removed = []
+    for database in shards.databases:
+        created += [row["partition"] for row in await database.fetch_rows(CREATE_QUERY, POST_PARTITIONS_AHEAD_MONTHS)]
+        if POST_PARTITIONS_RETENTION_MONTHS > 0:
+            removed += [row["partition"] for row in await database.fetch_rows(ARCHIVE_QUERY, POST_PARTITIONS_RETENTION_MONTHS, POST_PARTITIONS_ARCHIVE_MODE)]
+    metrics = get_metrics()
+    metrics.increment("post_partitions_created_total", len(created))
+    metrics.increment("post_partitions_removed_total", len(removed), mode=POST_PARTITIONS_ARCHIVE_MODE)
+    return created, removed
+
+
+# Class running the partition maintenance on startup, then every POST_PARTITIONS_MAINTENANCE_INTERVAL seconds
+# Every worker runs it, the SQL functions take a lock so only one of them changes the partitions at a time
+class PartitionMaintainer:
+
+    def __init__(self):
+        self._task = None
+
+    async def run_once(self):
+        try:
+            created, removed = await maintain_post_partitions()
+        except Exception as e:
+            print("Post partitions ERROR during the maintenance: ", e)
+            return
+        if created:
+            print("Post partitions created: ", ", ".join(created))
+        if removed:
+            print(f"Post partitions removed ({POST_PARTITIONS_ARCHIVE_MODE}): ", ", ".join(removed))
+
+    async def _run(self):
+        while True:
+            await self.run_once()
+            await asyncio.sleep(POST_PARTITIONS_MAINTENANCE_INTERVAL)
+
+    # Function to start the periodic maintenance
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    # Function to stop the periodic maintenance (on shutdown)
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+partition_maintainer = PartitionMaintainer()
@@ -0,0 +1,87 @@
+import asyncio
+import heapq
+from itertools import islice
+from typing import List
+from ..database.db_session import get_db, get_post_shards
+
+db = get_db()
+shards = get_post_shards()
+
+# Read path of the posts, on the main database or on the shards (see database/shards.py)
+# The controllers ask for fields, the queries are built here for where the posts are:
+# the main database joins users for the username, the shards have no users table,
+# so the username is added afterwards from user_id with a query on the main database
+
+# Column of each field of the posts
+POST_COLUMNS = {
+    "post_id": "post_id",
+    "title": "title",
+    "content": "content",
+    "created_at": "created_at",
+    "user_id": "user_id",
+    "username": "username",
+    "views": "COALESCE(views, 0) AS views",
+}
+ALL_POST_FIELDS = list(POST_COLUMNS)
+
+USERNAMES_QUERY = "SELECT user_id, username FROM users WHERE user_id = ANY($1::int[]);"
+
+
+# Function to build the query reading the given fields of the posts
+# excerpt cuts the content to $1 characters, by_ids keeps the posts whose id is in $1 (they are not used together)
+# On the shards, created_at (to merge them) and user_id (for the usernames) are always read
+def build_posts_query(fields: List[str], excerpt: bool = False, by_ids: bool = False, limit: int | None = None) -> str:
+    fields = list(fields)
+    if shards.enabled:
+        fields = [field for field in fields if field != "username"]
+        fields += [field for field in ("created_at", "user_id") if field not in fields]
+    columns = ["left(content, $1) AS content" if field == "content" and excerpt else POST_COLUMNS[field] for field in fields]
+    # post_user is always joined so that the same posts are listed, users and post_views only when needed
+    joins = "JOIN post_user USING (post_id)"
+    if "username" in fields:
+        joins += " JOIN users USING (user_id)"
+    if "views" in fields:
+        joins += " LEFT JOIN post_views USING (post_id)"
+    query = f"SELECT {', '.join(columns)} FROM posts {joins}"
+    if by_ids:
+        query += " WHERE post_id = ANY($1::int[])"
+    else:
+        query += " ORDER BY created_at DESC"
+    if limit is not None:
+        query += f" LIMIT {int(limit)}"
+    return query + ";"
+
+
+# Function to add the username of their author to posts read on the shards
+# The posts whose author is not in users are removed, as the join on users does without shards
+async def add_usernames(rows) -> List[dict]:
+    user_ids = list({row["user_id"] for row in rows})
+    if not user_ids:
+        return []
+    usernames = {row["user_id"]: row["username"] for row in await db.fetch_rows(USERNAMES_QUERY, user_ids)}
+    return [dict(row, username=usernames[row["user_id"]]) for row in rows if row["user_id"] in usernames]
+
+
+# Function to finish the rows read: usernames added on the shards, only the requested fields kept
+async def finish_rows(rows, fields: List[str]) -> List[dict]:
+    if shards.enabled and "username" in fields:
+        rows = await add_usernames(rows)
+    return [{field: row[field] for field in fields} for row in rows]
+
+
+# Function to list the posts, newest first, with the given fields
+# With shards, each shard is already sorted and their results are merged by created_at
+async def find_posts(fields: List[str] = ALL_POST_FIELDS, excerpt_len: int | None = None, limit: int | None = None) -> List[dict]:
+    query = build_posts_query(fields, excerpt=bool(excerpt_len), limit=limit)
+    args = [excerpt_len] if excerpt_len else []
+    results = await shards.gather("fetch_rows", query, *args)
+    rows = results[0] if len(results) == 1 else heapq.merge(*results, key=lambda row: row["created_at"], reverse=True)
+    return await finish_rows(list(islice(rows, limit)), fields)
+
+
+# Function to read posts by id, on the database of each post
+# The order of the result is not the order of post_ids
+async def find_posts_by_ids(post_ids: List[int], fields: List[str] = ALL_POST_FIELDS) -> List[dict]:
+    query = build_posts_query(fields, by_ids=True)
+    results = await asyncio.gather(*(database.fetch_rows(query, ids) for database, ids in shards.group_posts(post_ids)))
+    return await finish_rows([row for rows in results for row in rows], fields)
@@ -2,50 +2,50 @@ from typing import List
 from fastapi import HTTPException, status
 from ..database.db_session import get_db
 from ..models.user import User, UserIdAndUsername
+from ..utils.single_flight import single_flight
+from .count_controller import count_rows
 
 db = get_db()
 
 
 # Function to create a new user in the database
+# The user and its roles are inserted in a single transaction,
+# the trigger on user_roles fills users.roles before the commit
+# Raises a 400 if one of the roles does not exist
 async def create_user(user: User):
     db = get_db()
-    query = """
+    user_query = """
     INSERT INTO users (username, email, password, disabled)
     VALUES ($1, $2, $3, $4)
     RETURNING user_id;
     """
-    user_id = await db.fetch_val(query, user.username, user.email, user.password, user.disabled)
-    query = """
+    roles_query = """
     INSERT INTO user_roles (user_id, role_id)
-    VALUES ($1, $2);
+    SELECT $1, role_id FROM roles WHERE role_name = ANY($2::varchar[]);
     """
-    for role in user.roles:
-        role_id = await get_role_id(role)
-        await db.execute(query, user_id, role_id)
+    async with db.transaction() as con:
+        user_id = await con.fetchval(user_query, user.username, user.email, user.password, user.disabled)
+        result = await con.execute(roles_query, user_id, user.roles)
+        # An unknown role name inserts nothing: the transaction is rolled back, the user is not created
+        if int(result.split()[-1]) != len(set(user.roles)):
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Unknown role"
+            )
     return { "message": "User successfully created" }
 
 
 # Function to get the user from the database using the username
+# Concurrent calls for the same username share the same query
+@single_flight
 async def find_user_by_username(username: str) -> User:
     db = get_db()
+    # users.roles is maintained by triggers on user_roles (see sql/user_roles_cache.sql)
+    # Users without any role are not returned, as with the join on user_roles
     query = """
-    SELECT
-        u.user_id,
-        u.username,
-        u.email,
-        u.password,
-        u.disabled,
-        array_agg(r.role_name) AS roles
-    FROM
-        users u
-    JOIN
-        user_roles ur ON u.user_id = ur.user_id
-    JOIN
-        roles r ON ur.role_id = r.role_id
-    WHERE
-        u.username = $1
-    GROUP BY
-        u.user_id, u.username, u.email;
+    SELECT user_id, username, email, password, disabled, roles
+    FROM users
+    WHERE username = $1 AND cardinality(roles) > 0;
     """
     result = await db.fetch_row(query, username)
     if result is None:
@@ -66,23 +66,9 @@ async def find_user_by_username(username: str) -> User:
 async def find_user_by_email(email: str) -> User:
     db = get_db()
     query = """
-    SELECT
-        u.user_id,
-        u.username,
-        u.email,
-        u.password,
-        u.disabled,
-        array_agg(r.role_name) AS roles
-    FROM
-        users u
-    JOIN
-        user_roles ur ON u.user_id = ur.user_id
-    JOIN
-        roles r ON ur.role_id = r.role_id
-    WHERE
-        u.email = $1
-    GROUP BY
-        u.user_id, u.username, u.email;
+    SELECT user_id, username, email, password, disabled, roles
+    FROM users
+    WHERE email = $1 AND cardinality(roles) > 0;
     """
     result = await db.fetch_row(query, email)
     if result is None:
@@ -122,20 +108,9 @@ async def get_user_id(username: str) -> UserIdAndUsername:
 async def find_all_users() -> List[User]:
     db = get_db()
     query = """
-    SELECT
-        u.user_id,
-        u.username,
-        u.email,
-        u.disabled,
-        array_agg(r.role_name) AS roles
-    FROM
-        users u
-    JOIN
-        user_roles ur ON u.user_id = ur.user_id
-    JOIN
-        roles r ON ur.role_id = r.role_id
-    GROUP BY
-        u.user_id, u.username, u.email;
+    SELECT user_id, username, email, disabled, roles
+    FROM users
+    WHERE cardinality(roles) > 0;
     """
     result = await db.fetch_rows(query)
     if result is None:
@@ -154,6 +129,91 @@ async def find_all_users() -> List[User]:
         users.append(user)
     return users
 
+# Maximum number of users returned by a page of search_users
+USER_SEARCH_MAX_LIMIT = 200
+
+# Function to escape the wildcards of LIKE in a search term
+def escape_like(term: str) -> str:
+    return term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+# Function to build the conditions of search_users (joined with AND) and their arguments
+# Without any filter they are the ones of find_all_users
+def user_search_conditions(
+    q: str | None = None,
+    match: str = "substring",
+    roles: List[str] | None = None,
+    disabled: bool | None = None,
+) -> tuple[List[str], list]:
+    conditions = ["cardinality(roles) > 0"]
+    args = []
+    if q:
+        pattern = escape_like(q.lower()) + "%"
+        if match == "substring":
+            pattern = "%" + pattern
+        args.append(pattern)
+        conditions.append(f"(lower(username) LIKE ${len(args)} OR lower(email) LIKE ${len(args)})")
+    if roles:
+        args.append(roles)
+        conditions.append(f"roles && ${len(args)}::varchar[]")
+    if disabled is not None:
+        args.append(disabled)
+        conditions.append(f"COALESCE(disabled, false) = ${len(args)}")
+    return conditions, args
+
+# Function to count the users of a search (every page), or of find_all_users without filter
+# Returns the count and whether it is an estimate (see count_controller.py)
+async def count_users(
+    q: str | None = None,
+    match: str = "substring",
+    roles: List[str] | None = None,
+    disabled: bool | None = None,
+) -> tuple[int, bool]:
+    conditions, args = user_search_conditions(q, match, roles, disabled)
+    return await count_rows(f"FROM users WHERE {' AND '.join(conditions)}", *args)
+
+# Function to search users, one page at a time
+# q matches the start (match="prefix") or any part (match="substring") of the username or the email,
+# case insensitive, with the trigram indexes of sql/users_search.sql
+# roles keeps the users having at least one of the roles, disabled filters on the ban state
+# Pages are ordered by username: after is the last username of the previous page
+# Returns the users and the cursor of the next page (None on the last page)
+async def search_users(
+    q: str | None = None,
+    match: str = "substring",
+    roles: List[str] | None = None,
+    disabled: bool | None = None,
+    limit: int = 50,
+    after: str | None = None,
+) -> tuple[List[User], str | None]:
+    db = get_db()
+    conditions, args = user_search_conditions(q, match, roles, disabled)
+    if after is not None:
+        args.append(after)
+        conditions.append(f"username > ${len(args)}")
+    # One more row tells if there is a next page
+    args.append(limit + 1)
+    query = f"""
+    SELECT user_id, username, email, disabled, roles
+    FROM users
+    WHERE {" AND ".join(conditions)}
+    ORDER BY username
+    LIMIT ${len(args)};
+    """
+    result = await db.fetch_rows(query, *args)
+    users = [
+        User(
+            username=row["username"],
+            email=row["email"],
+            name=row["username"],
+            disabled=row["disabled"],
+            password="Placeholder",
+            roles=row["roles"]
+        )
+        for row in result[:limit]
+    ]
+    next_cursor = users[-1].username if len(result) > limit else None
+    return users, next_cursor
+
 # Ban user by username
 async def ban_user_by_username(username: str):
     db = get_db()
@@ -0,0 +1,118 @@
+import asyncio
+import os
+import asyncpg
+from ..database.db_session import get_post_shards
+from ..database.db import CircuitOpen, ConnectionFailed, PoolOverloaded
+from ..utils.metrics import get_metrics
+
+shards = get_post_shards()
+
+# Seconds between two writes of the view counts
+VIEW_COUNTS_FLUSH_INTERVAL = float(os.environ.get("VIEW_COUNTS_FLUSH_INTERVAL", 5))
+
+# Maximum number of posts with views waiting to be written, the views of other posts are dropped
+# beyond it (only reached when the database keeps failing)
+VIEW_COUNTS_MAX_PENDING = int(os.environ.get("VIEW_COUNTS_MAX_PENDING", 100000))
+
+# Add the views of several posts in one statement (one per shard when the posts are sharded)
+# The posts are sorted so that the workers lock the rows in the same order,
+# the posts deleted meanwhile are skipped
+FLUSH_QUERY = """
+INSERT INTO post_views (post_id, views)
+SELECT v.post_id, v.views
+FROM unnest($1::int[], $2::bigint[]) AS v(post_id, views)
+JOIN posts p ON p.post_id = v.post_id
+ORDER BY v.post_id
+ON CONFLICT (post_id) DO UPDATE SET views = post_views.views + EXCLUDED.views;
+"""
+
+
+# Function to tell if a failed write certainly did not apply: the database was not reached,
+# or it answered with an error (the statement was rolled back)
+# After a lost connection or a timeout the write may have been committed
+def write_not_applied(error: BaseException) -> bool:
+    if isinstance(error, ConnectionFailed):
+        return not error.sent
+    return isinstance(error, (PoolOverloaded, CircuitOpen, asyncpg.exceptions.PostgresError))
+
+
+# Class counting the views of the posts in memory and writing them in batches
+# Counting a view is a dictionary update, the database is written every VIEW_COUNTS_FLUSH_INTERVAL
+# seconds with one statement for all the posts viewed meanwhile, and once more on shutdown
+class ViewCounter:
+
+    def __init__(self):
+        self.pending = {}
+        self._task = None
+        self._flush_lock = asyncio.Lock()
+
+    # Function to count a view
+    def record(self, post_id: int):
+        if post_id in self.pending:
+            self.pending[post_id] += 1
+        elif len(self.pending) < VIEW_COUNTS_MAX_PENDING:
+            self.pending[post_id] = 1
+        else:
+            get_metrics().increment("view_counts_dropped_total")
+
+    # Function to get the views of a post not written yet by this worker
+    def pending_views(self, post_id: int) -> int:
+        return self.pending.get(post_id, 0)
+
+    # Function to write the pending views, they are kept for the next flush if the write did not apply
+    # When it may have applied (connection lost, timeout, cancelled) they are dropped rather than counted twice
+    async def flush(self):
+        async with self._flush_lock:
+            if not self.pending:
+                return
+            batch, self.pending = self.pending, {}
+            post_ids = sorted(batch)
+            groups = shards.group_posts(post_ids)
+            flushed = 0
+            for index, (database, ids) in enumerate(groups):
+                try:
+                    await database.execute(FLUSH_QUERY, ids, [batch[post_id] for post_id in ids])
+                    flushed += len(ids)
+                except BaseException as e:
+                    cancelled = not isinstance(e, Exception)
+                    # Kept for the next flush when not applied, the views of the next shards too when cancelled
+                    # The ones that may have been applied are dropped
+                    if cancelled or not write_not_applied(e):
+                        unwritten = []
+                        get_metrics().increment("view_counts_dropped_total", sum(batch[post_id] for post_id in ids))
+                    else:
+                        unwritten = list(ids)
+                    if cancelled:
+                        unwritten += [post_id for _, rest in groups[index + 1:] for post_id in rest]
+                    for post_id in unwritten:
+                        self.pending[post_id] = self.pending.get(post_id, 0) + batch[post_id]
+                    print("View counter ERROR while writing the views: ", e)
+                    if cancelled:
+                        raise
+            metrics = get_metrics()
+            metrics.increment("view_counts_flushed_total", flushed)
+            metrics.set_gauge("view_counts_pending", len(self.pending))
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(VIEW_COUNTS_FLUSH_INTERVAL)
+            await self.flush()
+
+    # Function to start the periodic writes
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    # Function to stop the periodic writes and write what is left (on shutdown)
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+
+view_counter = ViewCounter()
@@ -0,0 +1,47 @@
+# Interface shared by the database backends
+# The controllers only use these functions, so any backend implementing them can be plugged in
+# with the DB_BACKEND environment variable (see db_session.py)
+#   - postgres: Database (db.py), the real database
+#   - memory: MemoryDatabase (memory_backend.py), in-process tables for benchmarks and tests
+
+class DatabaseBackend:
+
+    # Function to open the connection(s)
+    async def connect(self):
+        raise NotImplementedError
+
+    # Function to close the connection(s), waiting up to timeout seconds for the queries in progress
+    async def close(self, timeout: float | None = None):
+        raise NotImplementedError
+
+    # Function to tell if the backend is ready to run queries
+    def is_connected(self) -> bool:
+        raise NotImplementedError
+
+    # Function to fetch multiple rows
+    async def fetch_rows(self, query: str, *args):
+        raise NotImplementedError
+
+    # Function to fetch a single row (None if there is none)
+    async def fetch_row(self, query: str, *args):
+        raise NotImplementedError
+
+    # Function to fetch the first value of the first row
+    async def fetch_val(self, query: str, *args):
+        raise NotImplementedError
+
+    # Function to execute any query, returns the status (eg: "DELETE 3")
+    async def execute(self, query: str, *args):
+        raise NotImplementedError
+
+    # Function to run several queries in a single transaction
+    # Used as: async with db.transaction() as con: await con.execute(query, *args)
+    # con has the asyncpg methods fetch, fetchrow, fetchval and execute
+    def transaction(self):
+        raise NotImplementedError
+
+    # Function to receive the notifications sent on a channel
+    # callback is called with the payload of each notification, on_lost if the listener stops receiving them
+    # Returns an object whose async close() stops listening
+    async def listen(self, channel: str, callback, on_lost=None):
+        raise NotImplementedError
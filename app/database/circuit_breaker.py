@@ -0,0 +1,66 @@
+import time
+
+from ..utils.metrics import get_metrics
+
+# States of the circuit breaker, the value is the one of the db_circuit_state gauge
+CLOSED = 0
+HALF_OPEN = 1
+OPEN = 2
+
+
+# Class that stops sending queries to a database that keeps failing
+# closed: queries go through, consecutive connection failures are counted
+# open: after failure_threshold failures, queries fail fast for reset_timeout seconds
+# half-open: then a single query is let through to probe the database,
+#            it closes the circuit if it succeeds and opens it again if it fails
+class CircuitBreaker:
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 5):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probe_started_at = None
+
+    def _set_state(self, state: int):
+        self.state = state
+        get_metrics().set_gauge("db_circuit_state", state)
+
+    # Function to tell if a query can be sent to the database
+    def allow_request(self) -> bool:
+        if self.state == CLOSED:
+            return True
+        now = time.monotonic()
+        if self.state == OPEN:
+            if now - self.opened_at < self.reset_timeout:
+                return False
+            self._set_state(HALF_OPEN)
+        # Half-open: a single probe at a time, a probe that never reported back expires
+        if self.probe_started_at is None or now - self.probe_started_at >= self.reset_timeout:
+            self.probe_started_at = now
+            return True
+        return False
+
+    # Function to get the number of seconds before the next probe
+    def retry_after(self) -> float:
+        if self.state == OPEN:
+            return max(self.reset_timeout - (time.monotonic() - self.opened_at), 0)
+        return self.reset_timeout
+
+    # Function to call when the database answered (even with an SQL error)
+    def record_success(self):
+        self.failures = 0
+        self.probe_started_at = None
+        if self.state != CLOSED:
+            print("Database INFO: connection recovered, closing the circuit")
+            self._set_state(CLOSED)
+
+    # Function to call when the database could not be reached
+    def record_failure(self):
+        self.failures += 1
+        self.probe_started_at = None
+        if self.state == HALF_OPEN or (self.state == CLOSED and self.failures >= self.failure_threshold):
+            print(f"Database WARNING: {self.failures} connection failure(s), opening the circuit for {self.reset_timeout}s")
+            self.opened_at = time.monotonic()
+            self._set_state(OPEN)
@@ -0,0 +1,648 @@
+import json
+import re
+import time
+import asyncpg
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from datetime import datetime, timedelta, timezone
+from itertools import islice
+
+from .backend import DatabaseBackend
+from .db import QueryTimeout, query_timeout
+
+
+# Function to normalize the whitespace of a query, so that it can be matched whatever its layout
+def normalize_query(query: str) -> str:
+    return " ".join(query.split()).replace("( ", "(").replace(" )", ")")
+
+
+# Undo journal of the transaction of the current task: (container, key, previous value) of each write
+# None outside of MemoryDatabase.transaction()
+undo_journal: ContextVar[list | None] = ContextVar("undo_journal", default=None)
+
+# Value of a key that was not in its container before a write
+MISSING = object()
+
+
+# Class giving the asyncpg connection methods to the queries run in MemoryDatabase.transaction()
+# As with Database, the queries have the timeout of the current request (query_timeout):
+# a query that took longer raises QueryTimeout (it cannot be stopped, it is checked afterwards)
+class MemoryConnection:
+
+    def __init__(self, database):
+        self._database = database
+
+    def _run(self, query: str, args, timeout):
+        timeout = timeout if timeout is not None else query_timeout.get()
+        start = time.perf_counter()
+        result = self._database.run(query, args)
+        if timeout is not None and time.perf_counter() - start > timeout:
+            raise QueryTimeout(f"Query did not complete within {timeout}s")
+        return result
+
+    async def fetch(self, query: str, *args, timeout=None):
+        return self._run(query, args, timeout)[0]
+
+    async def fetchrow(self, query: str, *args, timeout=None):
+        rows = self._run(query, args, timeout)[0]
+        return rows[0] if rows else None
+
+    async def fetchval(self, query: str, *args, timeout=None):
+        rows = self._run(query, args, timeout)[0]
+        return next(iter(rows[0].values())) if rows else None
+
+    async def execute(self, query: str, *args, timeout=None):
+        return self._run(query, args, timeout)[1]
+
+
+# Listener returned by MemoryDatabase.listen()
+class MemoryListener:
+
+    def __init__(self, callbacks: list, callback):
+        self._callbacks = callbacks
+        self._callback = callback
+
+    async def close(self):
+        if self._callback in self._callbacks:
+            self._callbacks.remove(self._callback)
+
+
+# In-memory database answering the queries of the controllers, without Postgres
+# It is meant for benchmarks and tests of the application itself (auth, serialization...):
+# the cost of the database is taken out. Each worker has its own data, lost on restart.
+# Queries are recognized by their text, a query that is not handled raises NotImplementedError
+class MemoryDatabase(DatabaseBackend):
+
+    # Foreign keys of the tables, referencing table: referenced table (as in the sql scripts)
+    FOREIGN_KEYS = {"item_objects": "items"}
+
+    # shard_index and shard_count number the post ids as the sequence of a shard (see sql/posts_shard.sql)
+    def __init__(self, shard_index: int = 0, shard_count: int = 1):
+        self.shard_index = shard_index
+        self.shard_count = shard_count
+        self._connected = False
+        # Callbacks of listen() by channel
+        self._listeners = {}
+        self.reset()
+        # (regex on the normalized query, handler), the handlers return (rows, status)
+        self._handlers = [
+            # Users
+            (r"INSERT INTO users \(username, email, password, disabled\) VALUES \(\$1, \$2, \$3, \$4\) RETURNING user_id;", self._insert_user),
+            (r"INSERT INTO user_roles \(user_id, role_id\) SELECT \$1, role_id FROM roles WHERE role_name = ANY\(\$2::varchar\[\]\);", self._insert_user_roles),
+            (r"SELECT user_id, username, email, password, disabled, roles FROM users WHERE (?P<column>username|email) = \$1 AND cardinality\(roles\) > 0;", self._select_user),
+            (r"SELECT user_id, username, email, disabled, roles FROM users WHERE cardinality\(roles\) > 0;", self._select_users),
+            (r"SELECT user_id, username, email, disabled, roles FROM users WHERE (?P<conditions>.+) ORDER BY username LIMIT \$(?P<limit>\d+);", self._search_users),
+            (r"SELECT role_id FROM roles WHERE role_name = \$1;", self._select_role_id),
+            (r"SELECT user_id FROM users WHERE username = \$1;", self._select_user_id),
+            (r"UPDATE users SET disabled = true WHERE username = \$1;", self._ban_user),
+            (r"SELECT user_id, username FROM users WHERE user_id = ANY\(\$1::int\[\]\);", self._select_usernames),
+            # Posts
+            (r"INSERT INTO posts \(title, content, created_at\) VALUES \(\$1, \$2, NOW\(\)\) RETURNING post_id;", self._insert_post),
+            (r"INSERT INTO post_user \(post_id, user_id\) VALUES \(\$1, \$2\);", self._insert_post_user),
+            (r"SELECT (?P<columns>.+?) FROM posts JOIN post_user USING \(post_id\)(?P<users> JOIN users USING \(user_id\))?(?P<views> LEFT JOIN post_views USING \(post_id\))?(?: WHERE post_id = (?P<where>\$1|ANY\(\$1::int\[\]\)))?(?P<order> ORDER BY created_at DESC)?(?: LIMIT (?P<limit>\d+))? ?;", self._select_posts),
+            (r"WITH target AS .*UPDATE posts p SET title = \$1, content = \$2 .*", self._update_post),
+            (r"WITH target AS .*DELETE FROM posts p .*", self._delete_post),
+            (r"INSERT INTO post_views \(post_id, views\) SELECT .* FROM unnest\(\$1::int\[\], \$2::bigint\[\]\) .*", self._add_post_views),
+            # Items
+            (r"INSERT INTO items \(name, description\) VALUES \(\$1, \$2\) RETURNING item_id;", self._insert_item),
+            (r"SELECT item_id, name, description FROM items(?: WHERE item_id = (?P<where>\$1|ANY\(\$1::int\[\]\)))?", self._select_items),
+            (r"DELETE FROM items WHERE item_id = \$1", self._delete_item),
+            (r"DELETE FROM items WHERE item_id IN \(SELECT item_id FROM items LIMIT \$1\);", self._delete_items_batch),
+            (r"SELECT EXISTS\(SELECT 1 FROM items\);", self._items_exist),
+            (r"SELECT NOT EXISTS\(SELECT 1 FROM pg_constraint WHERE contype = 'f' AND confrelid = '(?P<table>\w+)'::regclass AND conrelid <> '(?P<allowed>\w+)'::regclass\);", self._can_truncate),
+            (r"SELECT set_config\(.*\);", self._set_config),
+            (r"TRUNCATE items, item_objects;", self._truncate_items),
+            (r"INSERT INTO item_delete_jobs \(mode\) VALUES \(\$1\) RETURNING .*", self._insert_job),
+            (r"UPDATE item_delete_jobs SET status = '(?P<status>\w+)', (?P<rest>.*) WHERE job_id = \$1;", self._update_job),
+            (r"UPDATE item_delete_jobs SET status = 'failed', error = 'interrupted', finished_at = NOW\(\) WHERE status IN \('pending', 'running'\) AND updated_at < .*;", self._fail_orphaned_jobs),
+            (r"SELECT job_id, mode, status, deleted, error, created_at, finished_at FROM item_delete_jobs WHERE job_id = \$1;", self._select_job),
+            # Item objects
+            (r"SELECT EXISTS\(SELECT 1 FROM items WHERE item_id = \$1\);", self._item_exists),
+            (r"WITH previous AS \(SELECT storage_key FROM item_objects WHERE item_id = \$1 FOR UPDATE\) INSERT INTO item_objects .*", self._upsert_item_object),
+            (r"SELECT item_id, filename, content_type, size, sha256, storage_key, created_at FROM item_objects WHERE item_id = \$1;", self._select_item_object),
+            (r"DELETE FROM item_objects WHERE item_id = \$1 RETURNING storage_key;", self._delete_item_object),
+            (r"SELECT storage_key FROM item_objects WHERE storage_key = ANY\(\$1::varchar\[\]\);", self._existing_storage_keys),
+            # Idempotency keys
+            (r"INSERT INTO idempotency_keys .* RETURNING true;", self._claim_idempotency_key),
+            (r"SELECT request_hash, status_code, response, created_at < NOW\(\) - make_interval\(secs => \$3\) AS abandoned FROM idempotency_keys WHERE scope = \$1 AND idempotency_key = \$2;", self._select_idempotency_key),
+            (r"UPDATE idempotency_keys SET status_code = \$3, response = \$4 WHERE scope = \$1 AND idempotency_key = \$2;", self._complete_idempotency_key),
+            (r"DELETE FROM idempotency_keys WHERE scope = \$1 AND idempotency_key = \$2 AND status_code IS NULL;", self._release_idempotency_key),
+            (r"DELETE FROM idempotency_keys WHERE expires_at < NOW\(\);", self._purge_idempotency_keys),
+            # Post events
+            (r"SELECT tx_id, event_id FROM post_events WHERE tx_id < .* ORDER BY tx_id DESC, event_id DESC LIMIT 1;", self._last_event_position),
+            (r"SELECT tx_id, event_id FROM post_events WHERE event_id = \$1;", self._event_position),
+            (r"SELECT event_id, tx_id, kind, data::text AS data FROM post_events WHERE \(tx_id, event_id\) > \(\$1, \$2\) AND \(tx_id, event_id\) <= \(\$3, \$4\) .* LIMIT \$5;", self._select_events),
+            (r"DELETE FROM post_events WHERE created_at < NOW\(\) - make_interval\(hours => \$1\);", self._prune_events),
+            # Post partitions, the posts are not partitioned here
+            (r"SELECT create_post_partitions\(.*\) AS partition;", self._create_post_partitions),
+            (r"SELECT archive_post_partitions\(.*\) AS partition;", self._archive_post_partitions),
+            # Counts
+            (r"EXPLAIN \(FORMAT JSON\) SELECT 1 FROM users WHERE (?P<conditions>.+);", self._explain_count_users),
+            (r"SELECT count\(\*\) FROM users WHERE (?P<conditions>.+);", self._count_users),
+        ]
+        self._handlers = [(re.compile(pattern, re.DOTALL), handler) for pattern, handler in self._handlers]
+
+    # Function to empty every table, the roles of auth.sql are created again
+    def reset(self):
+        self.tables = {
+            "roles": {},
+            "users": {},
+            "user_roles": {},
+            "posts": {},
+            "post_user": {},
+            "items": {},
+            "item_delete_jobs": {},
+            "post_events": {},
+            "item_objects": {},
+            "post_views": {},
+            "idempotency_keys": {},
+        }
+        self.sequences = {}
+        # Unique indexes of users: username / email -> user_id
+        self.indexes = {"username": {}, "email": {}}
+        for role_name in ("Admin", "Referent", "User", "Super"):
+            role_id = self._next_id("roles")
+            self.tables["roles"][role_id] = {"role_id": role_id, "role_name": role_name}
+
+    # Function to set container[key], the previous value is logged in the undo journal of the transaction
+    # Rows are never changed in place: a changed row is a new dict written here
+    def _write(self, container: dict, key, value):
+        journal = undo_journal.get()
+        if journal is not None:
+            journal.append((container, key, container.get(key, MISSING)))
+        container[key] = value
+
+    # Function to remove container[key], logged as _write, returns the removed value or None
+    def _remove(self, container: dict, key):
+        if key not in container:
+            return None
+        journal = undo_journal.get()
+        if journal is not None:
+            journal.append((container, key, container[key]))
+        return container.pop(key)
+
+    # Function to put back the values logged in an undo journal, the last write first
+    def _undo(self, journal: list):
+        for container, key, previous in reversed(journal):
+            if previous is MISSING:
+                container.pop(key, None)
+            else:
+                container[key] = previous
+
+    def _next_id(self, table: str) -> int:
+        self.sequences[table] = self.sequences.get(table, 0) + 1
+        return self.sequences[table]
+
+    async def connect(self):
+        self._connected = True
+
+    async def close(self, timeout: float | None = None):
+        self._connected = False
+
+    def is_connected(self) -> bool:
+        return self._connected
+
+    # The notifications are sent right away, there is no commit to wait for
+    async def listen(self, channel: str, callback, on_lost=None):
+        callbacks = self._listeners.setdefault(channel, [])
+        callbacks.append(callback)
+        return MemoryListener(callbacks, callback)
+
+    # Function to run a query, returns the rows and the status
+    def run(self, query: str, args):
+        normalized = normalize_query(query)
+        for pattern, handler in self._handlers:
+            match = pattern.fullmatch(normalized)
+            if match:
+                return handler(match, args)
+        raise NotImplementedError(f"MemoryDatabase does not handle the query: {normalized}")
+
+    async def fetch_rows(self, query: str, *args):
+        return await MemoryConnection(self).fetch(query, *args)
+
+    async def fetch_row(self, query: str, *args):
+        return await MemoryConnection(self).fetchrow(query, *args)
+
+    async def fetch_val(self, query: str, *args):
+        return await MemoryConnection(self).fetchval(query, *args)
+
+    async def execute(self, query: str, *args):
+        return await MemoryConnection(self).execute(query, *args)
+
+    # The writes of the transaction are logged in an undo journal and undone if it fails
+    # The sequences are small, they are copied and put back
+    @asynccontextmanager
+    async def transaction(self):
+        journal, sequences = [], dict(self.sequences)
+        token = undo_journal.set(journal)
+        try:
+            yield MemoryConnection(self)
+        except BaseException:
+            self._undo(journal)
+            self.sequences = sequences
+            raise
+        finally:
+            undo_journal.reset(token)
+        # In a transaction still open, the writes are undone with it
+        outer = undo_journal.get()
+        if outer is not None:
+            outer.extend(journal)
+
+    # Users
+
+    def _refresh_user_roles(self, user_id: int):
+        roles = self.tables["roles"]
+        names = sorted(roles[role_id]["role_name"] for uid, role_id in self.tables["user_roles"] if uid == user_id)
+        self._write(self.tables["users"], user_id, dict(self.tables["users"][user_id], roles=names))
+
+    # Function to find a user by username or email, with the unique indexes
+    def _find_user(self, column: str, value):
+        user_id = self.indexes[column].get(value)
+        return self.tables["users"].get(user_id) if user_id is not None else None
+
+    def _insert_user(self, match, args):
+        username, email, password, disabled = args
+        for column, value in (("username", username), ("email", email)):
+            if value in self.indexes[column]:
+                raise asyncpg.exceptions.UniqueViolationError(f"duplicate key value violates unique constraint \"users_{column}_key\"")
+        user_id = self._next_id("users")
+        self._write(self.tables["users"], user_id, {"user_id": user_id, "username": username, "password": password, "email": email, "disabled": bool(disabled), "roles": []})
+        self._write(self.indexes["username"], username, user_id)
+        self._write(self.indexes["email"], email, user_id)
+        return [{"user_id": user_id}], "INSERT 0 1"
+
+    def _insert_user_roles(self, match, args):
+        user_id, role_names = args
+        role_ids = [role["role_id"] for role in self.tables["roles"].values() if role["role_name"] in role_names]
+        for role_id in role_ids:
+            self._write(self.tables["user_roles"], (user_id, role_id), {"user_id": user_id, "role_id": role_id})
+        self._refresh_user_roles(user_id)
+        return [], f"INSERT 0 {len(role_ids)}"
+
+    def _select_user(self, match, args):
+        user = self._find_user(match["column"], args[0])
+        if user is None or not user["roles"]:
+            return [], "SELECT 0"
+        return [dict(user)], "SELECT 1"
+
+    def _select_users(self, match, args):
+        rows = [{key: user[key] for key in ("user_id", "username", "email", "disabled", "roles")} for user in self.tables["users"].values() if user["roles"]]
+        return rows, f"SELECT {len(rows)}"
+
+    # Function to keep the users matching the conditions built by search_users, joined with AND
+    def _filter_users(self, conditions: str, args) -> list:
+        def like(value: str, pattern: str) -> bool:
+            regex = "".join(".*" if part == "%" else "." if part == "_" else re.escape(part[-1]) for part in re.findall(r"\\.|.", pattern, re.DOTALL))
+            return re.fullmatch(regex, value, re.DOTALL) is not None
+
+        def arg(number: str):
+            return args[int(number) - 1]
+
+        users = list(self.tables["users"].values())
+        for condition in conditions.split(" AND "):
+            if condition == "cardinality(roles) > 0":
+                users = [user for user in users if user["roles"]]
+            elif found := re.fullmatch(r"\(lower\(username\) LIKE \$(\d+) OR lower\(email\) LIKE \$\d+\)", condition):
+                pattern = arg(found[1])
+                users = [user for user in users if like(user["username"].lower(), pattern) or like(user["email"].lower(), pattern)]
+            elif found := re.fullmatch(r"roles && \$(\d+)::varchar\[\]", condition):
+                users = [user for user in users if set(user["roles"]) & set(arg(found[1]))]
+            elif found := re.fullmatch(r"COALESCE\(disabled, false\) = \$(\d+)", condition):
+                users = [user for user in users if bool(user["disabled"]) == arg(found[1])]
+            elif found := re.fullmatch(r"username > \$(\d+)", condition):
+                users = [user for user in users if user["username"] > arg(found[1])]
+            else:
+                raise NotImplementedError(f"MemoryDatabase does not handle the condition: {condition}")
+        return users
+
+    def _search_users(self, match, args):
+        users = sorted(self._filter_users(match["conditions"], args), key=lambda user: user["username"])
+        rows = [{key: user[key] for key in ("user_id", "username", "email", "disabled", "roles")} for user in users[:args[int(match["limit"]) - 1]]]
+        return rows, f"SELECT {len(rows)}"
+
+    # The estimate is the exact count here
+    def _explain_count_users(self, match, args):
+        plan = [{"Plan": {"Node Type": "Seq Scan", "Relation Name": "users", "Plan Rows": len(self._filter_users(match["conditions"], args))}}]
+        return [{"QUERY PLAN": json.dumps(plan)}], "EXPLAIN"
+
+    def _count_users(self, match, args):
+        return [{"count": len(self._filter_users(match["conditions"], args))}], "SELECT 1"
+
+    def _select_role_id(self, match, args):
+        rows = [{"role_id": role["role_id"]} for role in self.tables["roles"].values() if role["role_name"] == args[0]]
+        return rows, f"SELECT {len(rows)}"
+
+    def _select_user_id(self, match, args):
+        user = self._find_user("username", args[0])
+        rows = [{"user_id": user["user_id"]}] if user else []
+        return rows, f"SELECT {len(rows)}"
+
+    def _select_usernames(self, match, args):
+        users = self.tables["users"]
+        rows = [{"user_id": user_id, "username": users[user_id]["username"]} for user_id in args[0] if user_id in users]
+        return rows, f"SELECT {len(rows)}"
+
+    def _ban_user(self, match, args):
+        user = self._find_user("username", args[0])
+        if user:
+            self._write(self.tables["users"], user["user_id"], dict(user, disabled=True))
+        return [], f"UPDATE {1 if user else 0}"
+
+    # Posts
+
+    def _insert_post(self, match, args):
+        post_id = self.shard_index + 1 + (self._next_id("posts") - 1) * self.shard_count
+        self._write(self.tables["posts"], post_id, {"post_id": post_id, "title": args[0], "content": args[1], "created_at": datetime.now(timezone.utc)})
+        return [{"post_id": post_id}], "INSERT 0 1"
+
+    def _insert_post_user(self, match, args):
+        post_id, user_id = args
+        self._write(self.tables["post_user"], post_id, user_id)
+        self._record_post_event(post_id, "created")
+        return [], "INSERT 0 1"
+
+    # Function to get a post joined with post_user and users (with_users), as in the controllers
+    # Returns None if the post, its author or (with_users) its user does not exist
+    # The shards of the posts have no users, their queries do not join it
+    def _joined_post(self, post_id: int, with_users: bool = True):
+        post = self.tables["posts"].get(post_id)
+        user_id = self.tables["post_user"].get(post_id)
+        if post is None or user_id is None or (with_users and user_id not in self.tables["users"]):
+            return None
+        username = self.tables["users"][user_id]["username"] if with_users else None
+        return dict(post, user_id=user_id, username=username, views=self.tables["post_views"].get(post_id, 0))
+
+    def _select_posts(self, match, args):
+        # The posts are kept in the order of their creation, the newest are the last ones
+        if match["where"] == "$1":
+            post_ids = [args[0]]
+        elif match["where"]:
+            post_ids = list(dict.fromkeys(args[0]))
+        elif match["order"]:
+            post_ids = reversed(self.tables["posts"])
+        else:
+            post_ids = iter(self.tables["posts"])
+        joined = (self._joined_post(post_id, with_users=bool(match["users"])) for post_id in post_ids)
+        rows = (row for row in joined if row is not None)
+        rows = list(islice(rows, int(match["limit"])) if match["limit"] else rows)
+        # Select list: plain columns, left(content, $n) AS content for the excerpts,
+        # or any expression with an alias (its value is the column of the same name)
+        columns = []
+        for column in re.split(r", (?![^(]*\))", match["columns"]):
+            excerpt = re.fullmatch(r"left\(content, \$(\d+)\) AS content", column)
+            alias = re.fullmatch(r".+ AS (\w+)", column)
+            if excerpt:
+                columns.append(("content", args[int(excerpt[1]) - 1]))
+            else:
+                columns.append((alias[1] if alias else column, None))
+        result = []
+        for row in rows:
+            result.append({name: row[name][:length] if length else row[name] for name, length in columns})
+        return result, f"SELECT {len(result)}"
+
+    def _post_target(self, post_id: int, user_id: int):
+        post = self.tables["posts"].get(post_id)
+        if post is None:
+            return None, False
+        return post, self.tables["post_user"].get(post_id) == user_id
+
+    def _update_post(self, match, args):
+        title, content, post_id, user_id = args
+        post, is_owner = self._post_target(post_id, user_id)
+        if post is None:
+            return [], "SELECT 0"
+        if not is_owner:
+            return [{"is_owner": False, "post_id": None, "title": None, "content": None, "created_at": None}], "SELECT 1"
+        post = dict(post, title=title, content=content)
+        self._write(self.tables["posts"], post_id, post)
+        self._record_post_event(post_id, "updated")
+        return [dict(post, is_owner=True)], "SELECT 1"
+
+    def _delete_post(self, match, args):
+        post_id, user_id = args
+        post, is_owner = self._post_target(post_id, user_id)
+        if post is None:
+            return [], "SELECT 0"
+        if not is_owner:
+            return [{"is_owner": False, "post_id": None}], "SELECT 1"
+        self._remove(self.tables["posts"], post_id)
+        self._remove(self.tables["post_user"], post_id)
+        self._remove(self.tables["post_views"], post_id)
+        self._record_post_event(post_id, "deleted")
+        return [{"is_owner": True, "post_id": post_id}], "SELECT 1"
+
+    def _add_post_views(self, match, args):
+        post_views = self.tables["post_views"]
+        post_ids = [post_id for post_id in args[0] if post_id in self.tables["posts"]]
+        for post_id, views in zip(args[0], args[1]):
+            if post_id in self.tables["posts"]:
+                self._write(post_views, post_id, post_views.get(post_id, 0) + views)
+        return [], f"INSERT 0 {len(post_ids)}"
+
+    # Items
+
+    def _insert_item(self, match, args):
+        item_id = self._next_id("items")
+        self._write(self.tables["items"], item_id, {"item_id": item_id, "name": args[0], "description": args[1]})
+        return [{"item_id": item_id}], "INSERT 0 1"
+
+    def _select_items(self, match, args):
+        items = self.tables["items"]
+        if match["where"] == "$1":
+            rows = [dict(items[args[0]])] if args[0] in items else []
+        elif match["where"]:
+            rows = [dict(items[item_id]) for item_id in args[0] if item_id in items]
+        else:
+            rows = [dict(item) for item in items.values()]
+        return rows, f"SELECT {len(rows)}"
+
+    def _delete_item(self, match, args):
+        deleted = self._remove(self.tables["items"], args[0])
+        self._remove(self.tables["item_objects"], args[0])
+        return [], f"DELETE {1 if deleted else 0}"
+
+    def _delete_items_batch(self, match, args):
+        item_ids = list(islice(self.tables["items"], args[0]))
+        for item_id in item_ids:
+            self._remove(self.tables["items"], item_id)
+            self._remove(self.tables["item_objects"], item_id)
+        return [], f"DELETE {len(item_ids)}"
+
+    def _items_exist(self, match, args):
+        return [{"exists": bool(self.tables["items"])}], "SELECT 1"
+
+    # No foreign key to the table but the allowed one, from FOREIGN_KEYS
+    def _can_truncate(self, match, args):
+        referencing = [table for table, referenced in self.FOREIGN_KEYS.items() if referenced == match["table"]]
+        return [{"?column?": all(table == match["allowed"] for table in referencing)}], "SELECT 1"
+
+    def _set_config(self, match, args):
+        return [{"set_config": args[0] if args else None}], "SELECT 1"
+
+    # The tables are replaced by empty ones, the undo journal keeps the previous ones
+    def _truncate_items(self, match, args):
+        self._write(self.tables, "items", {})
+        self._write(self.tables, "item_objects", {})
+        return [], "TRUNCATE TABLE"
+
+    # Item objects
+
+    def _item_exists(self, match, args):
+        return [{"exists": args[0] in self.tables["items"]}], "SELECT 1"
+
+    def _upsert_item_object(self, match, args):
+        item_id, filename, content_type, size, sha256, storage_key = args
+        if item_id not in self.tables[self.FOREIGN_KEYS["item_objects"]]:
+            raise asyncpg.exceptions.ForeignKeyViolationError("insert or update on table \"item_objects\" violates foreign key constraint")
+        previous = self.tables["item_objects"].get(item_id)
+        created_at = datetime.now(timezone.utc)
+        self._write(self.tables["item_objects"], item_id, {"item_id": item_id, "filename": filename, "content_type": content_type, "size": size, "sha256": sha256, "storage_key": storage_key, "created_at": created_at})
+        return [{"previous_key": previous["storage_key"] if previous else None, "created_at": created_at}], "INSERT 0 1"
+
+    def _select_item_object(self, match, args):
+        item_object = self.tables["item_objects"].get(args[0])
+        return ([dict(item_object)], "SELECT 1") if item_object else ([], "SELECT 0")
+
+    def _delete_item_object(self, match, args):
+        item_object = self._remove(self.tables["item_objects"], args[0])
+        return ([{"storage_key": item_object["storage_key"]}], "DELETE 1") if item_object else ([], "DELETE 0")
+
+    def _existing_storage_keys(self, match, args):
+        keys = {item_object["storage_key"] for item_object in self.tables["item_objects"].values()}
+        rows = [{"storage_key": key} for key in args[0] if key in keys]
+        return rows, f"SELECT {len(rows)}"
+
+    def _insert_job(self, match, args):
+        job_id = self._next_id("item_delete_jobs")
+        now = datetime.now(timezone.utc)
+        job = {"job_id": job_id, "mode": args[0], "status": "pending", "deleted": 0, "error": None, "created_at": now, "updated_at": now, "finished_at": None}
+        self._write(self.tables["item_delete_jobs"], job_id, job)
+        return [dict(job)], "INSERT 0 1"
+
+    def _update_job(self, match, args):
+        job = self.tables["item_delete_jobs"].get(args[0])
+        if job is None:
+            return [], "UPDATE 0"
+        job = dict(job, status=match["status"])
+        if match["status"] == "running":
+            job["deleted"] = args[1]
+            job["updated_at"] = datetime.now(timezone.utc)
+        elif match["status"] == "done":
+            job["mode"] = args[1]
+            if args[2] is not None:
+                job["deleted"] = args[2]
+        else:
+            job["error"] = args[1]
+        if match["status"] in ("done", "failed"):
+            job["finished_at"] = datetime.now(timezone.utc)
+        self._write(self.tables["item_delete_jobs"], args[0], job)
+        return [], "UPDATE 1"
+
+    def _fail_orphaned_jobs(self, match, args):
+        now = datetime.now(timezone.utc)
+        jobs = self.tables["item_delete_jobs"]
+        job_ids = [job_id for job_id, job in jobs.items() if job["status"] in ("pending", "running") and job["updated_at"] < now - timedelta(seconds=args[0])]
+        for job_id in job_ids:
+            self._write(jobs, job_id, dict(jobs[job_id], status="failed", error="interrupted", finished_at=now))
+        return [], f"UPDATE {len(job_ids)}"
+
+    def _select_job(self, match, args):
+        job = self.tables["item_delete_jobs"].get(args[0])
+        return ([dict(job)], "SELECT 1") if job else ([], "SELECT 0")
+
+    # Idempotency keys
+
+    def _claim_idempotency_key(self, match, args):
+        scope, key, request_hash, ttl_hours = args
+        now = datetime.now(timezone.utc)
+        row = self.tables["idempotency_keys"].get((scope, key))
+        if row and row["expires_at"] >= now:
+            return [], "INSERT 0 0"
+        self._write(self.tables["idempotency_keys"], (scope, key), {"request_hash": request_hash, "status_code": None, "response": None, "created_at": now, "expires_at": now + timedelta(hours=ttl_hours)})
+        return [{"bool": True}], "INSERT 0 1"
+
+    def _select_idempotency_key(self, match, args):
+        scope, key, lock_timeout = args
+        row = self.tables["idempotency_keys"].get((scope, key))
+        if row is None:
+            return [], "SELECT 0"
+        abandoned = row["created_at"] < datetime.now(timezone.utc) - timedelta(seconds=lock_timeout)
+        return [{"request_hash": row["request_hash"], "status_code": row["status_code"], "response": row["response"], "abandoned": abandoned}], "SELECT 1"
+
+    def _complete_idempotency_key(self, match, args):
+        row = self.tables["idempotency_keys"].get((args[0], args[1]))
+        if row:
+            self._write(self.tables["idempotency_keys"], (args[0], args[1]), dict(row, status_code=args[2], response=args[3]))
+        return [], f"UPDATE {1 if row else 0}"
+
+    def _release_idempotency_key(self, match, args):
+        row = self.tables["idempotency_keys"].get(tuple(args))
+        if row and row["status_code"] is None:
+            self._remove(self.tables["idempotency_keys"], tuple(args))
+            return [], "DELETE 1"
+        return [], "DELETE 0"
+
+    def _purge_idempotency_keys(self, match, args):
+        now = datetime.now(timezone.utc)
+        keys = [key for key, row in self.tables["idempotency_keys"].items() if row["expires_at"] < now]
+        for key in keys:
+            self._remove(self.tables["idempotency_keys"], key)
+        return [], f"DELETE {len(keys)}"
+
+    # Post events, written as the triggers of post_events.sql do
+
+    def _record_post_event(self, post_id: int, kind: str):
+        if kind == "deleted":
+            data = {"post_id": post_id}
+        else:
+            post = self._joined_post(post_id)
+            if post is None:
+                return
+            data = dict(post, created_at=post["created_at"].strftime("%Y-%m-%d %H:%M:%S"))
+            del data["views"]
+        # Every transaction is committed at once here, its events are readable right away
+        event_id = self._next_id("post_events")
+        self._write(self.tables["post_events"], event_id, {"event_id": event_id, "tx_id": event_id, "kind": kind, "data": json.dumps(data), "created_at": datetime.now(timezone.utc)})
+        for callback in list(self._listeners.get("post_events", [])):
+            callback(str(event_id))
+
+    def _last_event_position(self, match, args):
+        events = self.tables["post_events"]
+        return ([{"tx_id": events[event_id]["tx_id"], "event_id": event_id} for event_id in [max(events)]] if events else []), "SELECT 1"
+
+    def _event_position(self, match, args):
+        event = self.tables["post_events"].get(args[0])
+        return ([{"tx_id": event["tx_id"], "event_id": event["event_id"]}] if event else []), "SELECT 1"
+
+    def _select_events(self, match, args):
+        after_tx_id, after_id, until_tx_id, until_id, limit = args
+        events = sorted(
+            (event for event in self.tables["post_events"].values() if (after_tx_id, after_id) < (event["tx_id"], event["event_id"]) <= (until_tx_id, until_id)),
+            key=lambda event: (event["tx_id"], event["event_id"]),
+        )[:limit]
+        rows = [{key: event[key] for key in ("event_id", "tx_id", "kind", "data")} for event in events]
+        return rows, f"SELECT {len(rows)}"
+
+    def _prune_events(self, match, args):
+        limit = datetime.now(timezone.utc) - timedelta(hours=args[0])
+        event_ids = [event_id for event_id, event in self.tables["post_events"].items() if event["created_at"] < limit]
+        for event_id in event_ids:
+            self._remove(self.tables["post_events"], event_id)
+        return [], f"DELETE {len(event_ids)}"
+
+    # Post partitions
+
+    def _create_post_partitions(self, match, args):
+        return [], "SELECT 0"
+
+    # The posts of the months removed by archive_post_partitions are deleted, with their author and views
+    def _archive_post_partitions(self, match, args):
+        now = datetime.now(timezone.utc)
+        months = now.year * 12 + now.month - 1 - args[0]
+        limit = datetime(months // 12, months % 12 + 1, 1, tzinfo=timezone.utc)
+        post_ids = [post_id for post_id, post in self.tables["posts"].items() if post["created_at"] < limit]
+        for post_id in post_ids:
+            self._remove(self.tables["posts"], post_id)
+            self._remove(self.tables["post_user"], post_id)
+            self._remove(self.tables["post_views"], post_id)
+        return [], "SELECT 0"
@@ -0,0 +1,60 @@
+import asyncio
+from .backend import DatabaseBackend
+
+# Sharding of the posts by author (POSTGRES_SHARDS, see db_session.py)
+# The posts of a user, their authors (post_user) and their view counts (post_views) are stored
+# on the shard user_id % N. The sequence of the post ids of shard k gives k + 1, k + 1 + N, ...
+# (see sql/posts_shard.sql), so the shard of a post is also known from its id alone.
+# Users and every other table stay in the main database.
+# Without shards every method routes to the main database, so the callers have a single code path.
+
+
+class PostShards:
+
+    def __init__(self, shards: list[DatabaseBackend], main: DatabaseBackend):
+        self.shards = shards
+        self.main = main
+
+    # Function to tell if the posts are sharded, without shards they are in the main database
+    @property
+    def enabled(self) -> bool:
+        return len(self.shards) > 0
+
+    # The databases holding the posts: the shards, or the main database
+    @property
+    def databases(self) -> list[DatabaseBackend]:
+        return self.shards if self.shards else [self.main]
+
+    # Function to get the database of the posts of a user
+    def for_user(self, user_id: int) -> DatabaseBackend:
+        return self.shards[user_id % len(self.shards)] if self.shards else self.main
+
+    # Function to get the database of a post
+    def for_post(self, post_id: int) -> DatabaseBackend:
+        return self.shards[(post_id - 1) % len(self.shards)] if self.shards else self.main
+
+    # Function to split post ids by database
+    # Returns (database, post ids) for each database having some of the posts, the ids keep their order
+    def group_posts(self, post_ids: list[int]) -> list[tuple[DatabaseBackend, list[int]]]:
+        if not self.shards:
+            return [(self.main, list(post_ids))] if post_ids else []
+        groups = {}
+        for post_id in post_ids:
+            groups.setdefault((post_id - 1) % len(self.shards), []).append(post_id)
+        return [(self.shards[index], ids) for index, ids in sorted(groups.items())]
+
+    # Function to run a query on every database of the posts at the same time (scatter)
+    # method is one of fetch_rows, fetch_row, fetch_val or execute
+    # Returns the result of each database, in the order of the shards
+    async def gather(self, method: str, query: str, *args) -> list:
+        return await asyncio.gather(*(getattr(database, method)(query, *args) for database in self.databases))
+
+    # The main database is connected and closed on its own, only the shards are here
+    async def connect(self):
+        await asyncio.gather(*(shard.connect() for shard in self.shards))
+
+    async def close(self, timeout: float | None = None):
+        await asyncio.gather(*(shard.close(timeout) for shard in self.shards))
+
+    def is_connected(self) -> bool:
+        return all(shard.is_connected() for shard in self.shards)
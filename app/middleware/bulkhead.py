@@ -0,0 +1,127 @@
+import asyncio
+import os
+
+from starlette.responses import JSONResponse
+
+from ..utils.metrics import get_metrics
+
+
+# Raised when a request cannot enter a bulkhead: its queue is full, or it waited too long
+class BulkheadFull(Exception):
+    def __init__(self, reason: str):
+        self.reason = reason
+        super().__init__(reason)
+
+
+# Class limiting the number of requests served at the same time by a group of routes
+# Up to max_concurrent requests run, up to max_queue more wait (at most queue_timeout seconds)
+# for one of them to finish, the next ones are rejected at once
+class Bulkhead:
+
+    def __init__(self, name: str, max_concurrent: int, max_queue: int, queue_timeout: float):
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self.waiting = 0
+        self._semaphore = asyncio.Semaphore(max_concurrent)
+
+    # Function to create the bulkhead of a router from the BULKHEAD_<NAME>_* environment variables
+    # Returns None when its concurrency is 0 (no limit)
+    @classmethod
+    def from_env(cls, name: str, concurrency: int, queue: int, timeout: float):
+        prefix = f"BULKHEAD_{name.upper()}_"
+        max_concurrent = int(os.environ.get(prefix + "CONCURRENCY", concurrency))
+        if max_concurrent <= 0:
+            return None
+        return cls(
+            name,
+            max_concurrent,
+            int(os.environ.get(prefix + "QUEUE", queue)),
+            float(os.environ.get(prefix + "TIMEOUT", timeout)),
+        )
+
+    def _record_usage(self):
+        metrics = get_metrics()
+        metrics.set_gauge("bulkhead_active", self.active, bulkhead=self.name)
+        metrics.set_gauge("bulkhead_waiting", self.waiting, bulkhead=self.name)
+
+    # Function to take a place in the bulkhead, waiting in its queue if it is busy
+    # Raises BulkheadFull when the queue is full or the wait exceeds queue_timeout
+    async def acquire(self):
+        metrics = get_metrics()
+        if self._semaphore.locked() and self.waiting >= self.max_queue:
+            metrics.increment("bulkhead_rejected_total", bulkhead=self.name, reason="queue_full")
+            raise BulkheadFull("queue_full")
+        self.waiting += 1
+        self._record_usage()
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), self.queue_timeout)
+        except asyncio.TimeoutError:
+            metrics.increment("bulkhead_rejected_total", bulkhead=self.name, reason="queue_timeout")
+            raise BulkheadFull("queue_timeout")
+        finally:
+            self.waiting -= 1
+        self.active += 1
+        self._record_usage()
+
+    # Function to give the place back
+    def release(self):
+        self.active -= 1
+        self._semaphore.release()
+        self._record_usage()
+
+
+# Middleware putting the requests of each router in its own bulkhead
+# bulkheads maps a path prefix (eg: "/users") to the Bulkhead of its routes, the other paths are not limited
+# The place is given back once the response starts: streamed bodies (file downloads, event streams)
+# do not hold it while they are sent
+class BulkheadMiddleware:
+
+    def __init__(self, app, bulkheads: dict, retry_after: float = 1):
+        self.app = app
+        self.bulkheads = {prefix: bulkhead for prefix, bulkhead in bulkheads.items() if bulkhead is not None}
+        self.retry_after = retry_after
+
+    # Function to find the bulkhead of a path, the longest matching prefix wins
+    def find_bulkhead(self, path: str):
+        for prefix in sorted(self.bulkheads, key=len, reverse=True):
+            if path == prefix or path.startswith(prefix + "/"):
+                return self.bulkheads[prefix]
+        return None
+
+    async def __call__(self, scope, receive, send):
+        bulkhead = self.find_bulkhead(scope["path"]) if scope["type"] == "http" else None
+        if bulkhead is None:
+            await self.app(scope, receive, send)
+            return
+
+        try:
+            await bulkhead.acquire()
+        except BulkheadFull:
+            response = JSONResponse(
+                content={"detail": "Too many requests in progress, please try again later"},
+                status_code=503,
+                headers={"Retry-After": str(max(1, round(self.retry_after)))},
+            )
+            await response(scope, receive, send)
+            return
+
+        released = False
+
+        def release():
+            nonlocal released
+            if not released:
+                released = True
+                bulkhead.release()
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                release()
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            release()
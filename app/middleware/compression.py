@@ -0,0 +1,227 @@
+import time
+import zlib
+
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import Headers, MutableHeaders
+
+from ..utils.metrics import get_metrics
+
+# Brotli and Zstandard are optional, the encodings are only offered when installed
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# Encodings in order of preference when the client accepts several of them
+PREFERRED_ENCODINGS = ("zstd", "br", "gzip")
+
+# Only these content types are worth compressing (JSON, text, ...)
+# Event streams are left alone so that events are not held back by the compressor
+COMPRESSIBLE_TYPES = ("application/json", "application/xml", "application/javascript", "text/html", "text/plain", "text/csv", "image/svg+xml")
+
+# Levels from which compression is considered CPU heavy and is run in the threadpool
+HEAVY_LEVELS = {"gzip": 7, "br": 6, "zstd": 10}
+
+# Chunks bigger than this are compressed in the threadpool whatever the level
+OFFLOAD_MIN_SIZE = 256 * 1024
+
+
+# Function to get the available encodings
+def available_encodings() -> list[str]:
+    encodings = ["gzip"]
+    if brotli is not None:
+        encodings.append("br")
+    if zstandard is not None:
+        encodings.append("zstd")
+    return encodings
+
+
+# Function to pick the encoding to use from the Accept-Encoding header
+# Example: "gzip;q=0.5, br" -> "br"
+def negotiate_encoding(accept_encoding: str) -> str | None:
+    weights = {}
+    for part in accept_encoding.split(","):
+        token, _, params = part.strip().partition(";")
+        token = token.strip().lower()
+        if not token:
+            continue
+        weight = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                weight = float(params[2:])
+            except ValueError:
+                weight = 0.0
+        weights[token] = weight
+    available = available_encodings()
+    best, best_weight = None, 0.0
+    for encoding in PREFERRED_ENCODINGS:
+        if encoding not in available:
+            continue
+        weight = weights.get(encoding, weights.get("*", 0.0))
+        if weight > best_weight:
+            best, best_weight = encoding, weight
+    return best
+
+
+# Class wrapping an incremental compressor for one of the supported encodings
+# It also accumulates the CPU time spent compressing
+class StreamCompressor:
+
+    def __init__(self, encoding: str, level: int):
+        self.encoding = encoding
+        self.cpu_time = 0.0
+        if encoding == "gzip":
+            self._compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+        elif encoding == "br":
+            self._compressor = brotli.Compressor(quality=level)
+        elif encoding == "zstd":
+            self._compressor = zstandard.ZstdCompressor(level=level).compressobj()
+        else:
+            raise ValueError(f"Unsupported encoding: {encoding}")
+
+    # Function to compress a chunk, returns whatever output is ready
+    def compress(self, data: bytes) -> bytes:
+        start = time.thread_time()
+        if self.encoding == "br":
+            result = self._compressor.process(data)
+        else:
+            result = self._compressor.compress(data)
+        self.cpu_time += time.thread_time() - start
+        return result
+
+    # Function to compress the last chunk and flush the compressor
+    def finish(self, data: bytes = b"") -> bytes:
+        result = self.compress(data) if data else b""
+        start = time.thread_time()
+        if self.encoding == "br":
+            result += self._compressor.finish()
+        else:
+            result += self._compressor.flush()
+        self.cpu_time += time.thread_time() - start
+        return result
+
+
+# Middleware that compresses responses above a size threshold
+# Small responses are sent untouched, big or streaming ones are compressed chunk by chunk
+class CompressionMiddleware:
+
+    def __init__(self, app, minimum_size: int = 1024, gzip_level: int = 6, brotli_quality: int = 4, zstd_level: int = 3):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.levels = {"gzip": gzip_level, "br": brotli_quality, "zstd": zstd_level}
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        encoding = negotiate_encoding(Headers(scope=scope).get("accept-encoding", ""))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+        responder = CompressionResponder(send, encoding, self.levels[encoding], self.minimum_size)
+        await self.app(scope, receive, responder.send)
+
+
+# Class handling the compression of a single response
+class CompressionResponder:
+
+    def __init__(self, send, encoding: str, level: int, minimum_size: int):
+        self._send = send
+        self.encoding = encoding
+        self.level = level
+        self.minimum_size = minimum_size
+        self.offload = level >= HEAVY_LEVELS[encoding]
+        self.start_message = None
+        self.passthrough = False
+        self.started = False
+        self.buffer = b""
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.compressor = None
+
+    async def send(self, message):
+        message_type = message["type"]
+        if message_type == "http.response.start":
+            self.start_message = message
+            headers = Headers(raw=message["headers"])
+            content_type = headers.get("content-type", "").split(";")[0].strip()
+            content_length = headers.get("content-length")
+            # Files served with ranges are left as is, the ranges refer to the stored bytes
+            if "content-encoding" in headers or "accept-ranges" in headers or content_type not in COMPRESSIBLE_TYPES or message["status"] in (204, 206, 304):
+                self.passthrough = True
+            elif content_length is not None and int(content_length) < self.minimum_size:
+                self.passthrough = True
+                get_metrics().increment("compression_skipped_total", reason="too_small")
+            if self.passthrough:
+                self.started = True
+                await self._send(message)
+            return
+
+        if message_type != "http.response.body" or self.passthrough:
+            await self._send(message)
+            return
+
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+
+        # Nothing sent yet, buffer until we know if the response is big enough
+        if not self.started:
+            self.buffer += body
+            if more_body and len(self.buffer) < self.minimum_size:
+                return
+            if not more_body and len(self.buffer) < self.minimum_size:
+                # Small response, send it as is
+                get_metrics().increment("compression_skipped_total", reason="too_small")
+                self.started = True
+                await self._send(self.start_message)
+                await self._send({"type": "http.response.body", "body": self.buffer, "more_body": False})
+                return
+            body, self.buffer = self.buffer, b""
+            self.compressor = StreamCompressor(self.encoding, self.level)
+            compressed = await self._compress(body, finish=not more_body)
+            headers = MutableHeaders(raw=self.start_message["headers"])
+            headers["Content-Encoding"] = self.encoding
+            headers.add_vary_header("Accept-Encoding")
+            if more_body:
+                del headers["Content-Length"]
+            else:
+                headers["Content-Length"] = str(len(compressed))
+            self.started = True
+            await self._send(self.start_message)
+            await self._send({"type": "http.response.body", "body": compressed, "more_body": more_body})
+        else:
+            # Streaming response already started, compress the chunk
+            compressed = await self._compress(body, finish=not more_body)
+            if compressed or not more_body:
+                await self._send({"type": "http.response.body", "body": compressed, "more_body": more_body})
+
+        if not more_body:
+            self._record_metrics()
+
+    # Function to compress a chunk, in the threadpool when it is CPU heavy
+    async def _compress(self, data: bytes, finish: bool) -> bytes:
+        self.bytes_in += len(data)
+        compress = self.compressor.finish if finish else self.compressor.compress
+        if self.offload or len(data) >= OFFLOAD_MIN_SIZE:
+            result = await run_in_threadpool(compress, data)
+        else:
+            result = compress(data)
+        self.bytes_out += len(result)
+        return result
+
+    # Function to record the metrics of the compressed response
+    def _record_metrics(self):
+        metrics = get_metrics()
+        metrics.increment("compression_responses_total", encoding=self.encoding)
+        metrics.increment("compression_bytes_in_total", self.bytes_in, encoding=self.encoding)
+        metrics.increment("compression_bytes_out_total", self.bytes_out, encoding=self.encoding)
+        metrics.increment("compression_cpu_seconds_total", self.compressor.cpu_time, encoding=self.encoding)
+        if self.bytes_out:
+            metrics.observe("compression_ratio", self.bytes_in / self.bytes_out, encoding=self.encoding)
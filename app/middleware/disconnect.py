@@ -0,0 +1,63 @@
+import asyncio
+
+from ..utils.metrics import get_metrics
+
+# Methods whose handlers are cancelled when the client disconnects
+# They only read: the writes run to the end, a write cut in the middle could be half done
+CANCELLABLE_METHODS = ("GET", "HEAD")
+
+
+# Middleware that cancels the request handler when the client disconnects before the response is sent
+# The running query is then cancelled on the server and its connection goes back to the pool
+# Only the reads (CANCELLABLE_METHODS) are cancelled
+class CancelOnDisconnectMiddleware:
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        # Messages from the client are read here and handed to the application through a queue
+        # The queue holds a single message so that request bodies are not buffered in memory
+        messages = asyncio.Queue(maxsize=1)
+        cancellable = scope["method"] in CANCELLABLE_METHODS
+        response_complete = False
+        disconnected = False
+
+        async def send_wrapper(message):
+            nonlocal response_complete
+            if message["type"] == "http.response.body" and not message.get("more_body", False):
+                response_complete = True
+            await send(message)
+
+        app_task = asyncio.create_task(self.app(scope, messages.get, send_wrapper))
+
+        async def listen_for_disconnect():
+            nonlocal disconnected
+            while True:
+                message = await receive()
+                if message["type"] == "http.disconnect":
+                    disconnected = True
+                    if cancellable and not response_complete and not app_task.done():
+                        get_metrics().increment("requests_cancelled_on_disconnect_total")
+                        app_task.cancel()
+                    if not messages.full():
+                        messages.put_nowait(message)
+                    return
+                await messages.put(message)
+
+        listener = asyncio.create_task(listen_for_disconnect())
+        try:
+            await app_task
+        except asyncio.CancelledError:
+            # Cancelled because the client left, nobody is waiting for a response
+            if disconnected:
+                return
+            # Cancelled by the server (shutdown), cancel the handler too
+            app_task.cancel()
+            raise
+        finally:
+            listener.cancel()
@@ -0,0 +1,139 @@
+import asyncio
+import os
+import time
+
+from starlette.responses import JSONResponse
+from uvicorn import Server
+
+# Maximum time (in seconds) given to in-flight requests to finish once the drain has started
+SHUTDOWN_DRAIN_TIMEOUT = float(os.environ.get("SHUTDOWN_DRAIN_TIMEOUT", 30))
+
+# Maximum time (in seconds) given to the view counts and the database connections in the lifespan shutdown,
+# once uvicorn has stopped serving (see main.py)
+SHUTDOWN_CLOSE_TIMEOUT = float(os.environ.get("SHUTDOWN_CLOSE_TIMEOUT", 10))
+
+# Seconds after the first signal during which the other signals are ignored by the drain
+# A whole process group is signalled at once (Ctrl+C, systemd), and serve.py forwards the signal too
+SIGNAL_REPEAT_GRACE = 1
+
+# Paths answered while draining: the process is still alive, the liveness probe must not fail
+DRAIN_EXEMPT_PATHS = ("/health/live",)
+
+
+# Class that keeps track of the requests currently being served
+# and of whether the application is draining (shutting down)
+class DrainState:
+
+    def __init__(self):
+        self.draining = False
+        self.in_flight = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._hooks = []
+
+    # Function to register the start of a request
+    def request_started(self):
+        self.in_flight += 1
+        self._idle.clear()
+
+    # Function to register the end of a request
+    def request_finished(self):
+        self.in_flight -= 1
+        if self.in_flight <= 0:
+            self.in_flight = 0
+            self._idle.set()
+
+    # Function to register a coroutine function called when the drain starts
+    # Used for the requests that would never finish by themselves (eg: the event streams)
+    def on_drain(self, hook):
+        self._hooks.append(hook)
+
+    # Function to enter drain mode, new requests will be refused from now on
+    def start_drain(self):
+        self.draining = True
+
+    # Function to wait until every in-flight request is done
+    # Returns True if the application became idle before the timeout
+    async def wait_idle(self, timeout: float) -> bool:
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    # Function to drain the application: refuse new requests, run the drain hooks
+    # and wait for the in-flight requests, at most timeout seconds
+    # Returns True if the application became idle before the timeout
+    async def drain(self, timeout: float) -> bool:
+        self.start_drain()
+        for hook in self._hooks:
+            try:
+                await hook()
+            except Exception as e:
+                print("Drain ERROR in a drain hook: ", e)
+        return await self.wait_idle(timeout)
+
+
+# Single drain state of the worker, shared by the middleware, the readiness probe and DrainingServer
+drain_state = DrainState()
+
+
+# Middleware that counts in-flight requests and refuses new ones while draining
+class DrainMiddleware:
+
+    def __init__(self, app, state: DrainState):
+        self.app = app
+        self.state = state
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        # Refuse new work while draining, the load balancer will retry elsewhere
+        if self.state.draining and scope["path"] not in DRAIN_EXEMPT_PATHS:
+            response = JSONResponse(
+                content={"detail": "Server is shutting down"},
+                status_code=503,
+                headers={"Connection": "close", "Retry-After": "1"},
+            )
+            await response(scope, receive, send)
+            return
+
+        self.state.request_started()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.state.request_finished()
+
+
+# uvicorn server draining the application when it receives SIGINT / SIGTERM
+# uvicorn stops listening and waits for the open connections before the lifespan shutdown runs,
+# so the drain must happen before: the server keeps serving (the readiness probe fails,
+# new requests get a 503) until the in-flight requests are done or SHUTDOWN_DRAIN_TIMEOUT has passed,
+# then the usual uvicorn shutdown follows. While the drain runs, only a second signal of the same kind
+# sent SIGNAL_REPEAT_GRACE seconds after the first ends it (eg: Ctrl+C twice): the copies of the signal
+# sent to the whole process group or forwarded by serve.py are ignored. A third SIGINT quits at once.
+class DrainingServer(Server):
+
+    def __init__(self, config):
+        super().__init__(config)
+        self._drain_task = None
+        self._first_signal = None
+        self._first_signal_time = 0.0
+
+    def handle_exit(self, sig, frame):
+        if self._drain_task is None and not self.should_exit:
+            self._first_signal, self._first_signal_time = sig, time.monotonic()
+            self._drain_task = asyncio.get_event_loop().create_task(self._drain())
+        elif self._drain_task is not None and not self._drain_task.done() and not self.should_exit and (
+            sig != self._first_signal or time.monotonic() - self._first_signal_time < SIGNAL_REPEAT_GRACE
+        ):
+            print(f"Drain: signal {sig} ignored, the drain is running")
+        else:
+            super().handle_exit(sig, frame)
+
+    async def _drain(self):
+        if not await drain_state.drain(SHUTDOWN_DRAIN_TIMEOUT):
+            print(f"Drain WARNING: {drain_state.in_flight} request(s) still in flight after {SHUTDOWN_DRAIN_TIMEOUT}s")
+        self.should_exit = True
@@ -1,7 +1,28 @@
-from typing import Optional
+from typing import List, Optional
 from pydantic import BaseModel
 
 class Item (BaseModel):
     item_id: Optional[int] = None
     name: str
-    description: str
\ No newline at end of file
+    description: str
+
+class ItemBatch(BaseModel):
+    items: List[Item]
+    missing: List[int] = []
+
+class ItemDeleteJob(BaseModel):
+    job_id: int
+    mode: str
+    status: str
+    deleted: int = 0
+    error: Optional[str] = None
+    created_at: Optional[str] = None
+    finished_at: Optional[str] = None
+
+class ItemObject(BaseModel):
+    item_id: int
+    filename: str
+    content_type: str
+    size: int
+    sha256: str
+    created_at: Optional[str] = None
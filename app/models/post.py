@@ -1,7 +1,7 @@
 # models/post.py
 
 from pydantic import BaseModel
-from typing import Optional
+from typing import List, Optional
 
 class Post(BaseModel):
     post_id: Optional[int] = None
@@ -10,4 +10,19 @@ class Post(BaseModel):
     user_id: Optional[int] = None
     username: Optional[str] = None
     created_at: Optional[str] = None
+    # Number of views of GET /posts/{post_id}, a few seconds behind (see view_counter_controller.py)
+    views: Optional[int] = None
 
+class PostBatch(BaseModel):
+    posts: List[Post]
+    missing: List[int] = []
+
+# Post with only some of its fields, used by the listing with ?fields=
+class PostSummary(BaseModel):
+    post_id: Optional[int] = None
+    title: Optional[str] = None
+    content: Optional[str] = None
+    user_id: Optional[int] = None
+    username: Optional[str] = None
+    created_at: Optional[str] = None
+    views: Optional[int] = None
@@ -15,14 +15,16 @@ from ..controllers.auth_controller import login_check_user_and_password, check_r
 # Import models
 from ..models.user import User, NewUser
 from ..models.auth import UserAndToken
+from ..utils.deadline import query_deadline, use_reserved_connections, INTERACTIVE_QUERY_TIMEOUT
 
 auth_router = APIRouter(
      prefix="/auth",
-     tags=["auth"]
+     tags=["auth"],
+     dependencies=[Depends(use_reserved_connections)]
 ) 
 
 # Route to get the access token, equivalent to login
-@auth_router.post("/token", response_model=UserAndToken)
+@auth_router.post("/token", response_model=UserAndToken, dependencies=[Depends(query_deadline(INTERACTIVE_QUERY_TIMEOUT))])
 async def login_for_tokens(
     form_data: Annotated[OAuth2PasswordRequestForm, Depends()],
     response: JSONResponse
@@ -32,7 +34,7 @@ async def login_for_tokens(
 
 
 # Route to get a new access token using the refresh token
-@auth_router.post("/refresh-token", response_model=UserAndToken)
+@auth_router.post("/refresh-token", response_model=UserAndToken, dependencies=[Depends(query_deadline(INTERACTIVE_QUERY_TIMEOUT))])
 async def refresh_access_token(
     refresh_token: Annotated[str | None , Cookie()] = None
 ):
@@ -0,0 +1,24 @@
+from fastapi import APIRouter, Request
+from fastapi.responses import JSONResponse
+
+from ..database.db_session import get_db, get_post_shards
+
+
+health_router = APIRouter(
+    prefix="/health",
+    tags=["health"]
+)
+
+# Route for the liveness probe, the process is up and serving
+@health_router.get("/live", response_model=dict, description="Liveness probe")
+async def liveness():
+    return {"status": "ok"}
+
+# Route for the readiness probe, fails while draining or without a database pool
+@health_router.get("/ready", response_model=dict, description="Readiness probe")
+async def readiness(request: Request):
+    if request.app.state.drain.draining:
+        return JSONResponse(content={"status": "draining"}, status_code=503)
+    if not get_db().is_connected() or not get_post_shards().is_connected():
+        return JSONResponse(content={"status": "database unavailable"}, status_code=503)
+    return {"status": "ok"}
@@ -1,14 +1,29 @@
-from fastapi import APIRouter, Depends, Security
-from typing import Annotated
+from fastapi import APIRouter, Depends, Header, Request, Security, Query, Response, status
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from typing import Annotated, Literal
 from ..controllers.auth_controller import verify_token
 from app.controllers.item_controller import (
     create_item,
     find_all_items,
     find_item_by_id,
+    find_items_by_ids,
     delete_item,
     delete_all_items,
+    start_delete_all_items_job,
+    find_delete_job_by_id,
+    ITEMS_DELETE_BATCH_SIZE,
 )
-from ..models.item import Item
+from app.controllers.item_object_controller import (
+    upload_item_object,
+    find_item_object_metadata,
+    download_item_object,
+    delete_item_object,
+)
+from ..controllers.idempotency_controller import run_idempotent
+from ..models.item import Item, ItemBatch, ItemDeleteJob, ItemObject
+from ..utils.batch import parse_id_list
+from ..utils.deadline import query_deadline, INTERACTIVE_QUERY_TIMEOUT, LIST_QUERY_TIMEOUT
 
 
 item_router = APIRouter(
@@ -18,22 +33,65 @@ item_router = APIRouter(
 # Note it is possible to put dependencies on the router itself
 # eg: dependencies=[Security(verify_token, scopes=["Admin"])]
 
-@item_router.post("", response_model=Item, description="Create a new item")
-async def create_item_route(item: Item, token: Annotated[None, Security(verify_token, scopes=["Admin"])]):
-    return await create_item(item)
+# A retry with the same Idempotency-Key gets the response of the first request, the item is created once
+@item_router.post("", response_model=Item, description="Create a new item, send an Idempotency-Key header to retry safely")
+async def create_item_route(
+    item: Item,
+    token: Annotated[None, Security(verify_token, scopes=["Admin"])],
+    idempotency_key: Annotated[str | None, Header(min_length=1, max_length=255)] = None,
+):
+    if idempotency_key is None:
+        return await create_item(item)
+    # The items are in the main database, with the idempotency keys: the item and the response are committed together
+    return await run_idempotent("items", idempotency_key, item, lambda con: create_item(item, con), in_transaction=True)
 
-@item_router.get("", response_model=list[Item], description="Get all items")
+@item_router.get("", response_model=list[Item], dependencies=[Depends(query_deadline(LIST_QUERY_TIMEOUT))], description="Get all items")
 async def get_all_items_route(token: Annotated[None, Security(verify_token, scopes=["Admin"])]):
     return await find_all_items()
 
-@item_router.get("/{id}", response_model=Item, description="Get an item by ID")
+# Must be declared before /{id}
+@item_router.get("/batch", response_model=ItemBatch, dependencies=[Depends(query_deadline(INTERACTIVE_QUERY_TIMEOUT))], description="Get several items by ID, eg: /items/batch?ids=3,1,2")
+async def get_items_batch_route(token: Annotated[None, Security(verify_token, scopes=["Admin"])], ids: str = Query(..., description="Comma separated list of item ids")):
+    return await find_items_by_ids(parse_id_list(ids))
+
+# Must be declared before /{id}
+@item_router.get("/jobs/{job_id}", response_model=ItemDeleteJob, description="Get the status of a background deletion")
+async def get_delete_job_route(job_id: int, token: Annotated[None, Security(verify_token, scopes=["Admin"])]):
+    return await find_delete_job_by_id(job_id)
+
+@item_router.get("/{id}", response_model=Item, dependencies=[Depends(query_deadline(INTERACTIVE_QUERY_TIMEOUT))], description="Get an item by ID")
 async def get_item_route(id: int, token: Annotated[None, Security(verify_token, scopes=["Admin"])]):
     return await find_item_by_id(id)
 
+# The body is read by upload_item_object as it arrives, it must not be declared as a form here
+@item_router.put("/{id}/object", response_model=ItemObject, description="Upload the file of an item (multipart/form-data, field file), it replaces the previous one")
+async def upload_item_object_route(id: int, request: Request, token: Annotated[None, Security(verify_token, scopes=["Admin"])]):
+    return await upload_item_object(id, request)
+
+@item_router.api_route("/{id}/object", methods=["GET", "HEAD"], response_class=Response, description="Download the file of an item, Range requests are supported")
+async def download_item_object_route(id: int, token: Annotated[None, Security(verify_token, scopes=["Admin"])]):
+    return await download_item_object(id)
+
+@item_router.get("/{id}/object/metadata", response_model=ItemObject, dependencies=[Depends(query_deadline(INTERACTIVE_QUERY_TIMEOUT))], description="Get the name, type, size and SHA-256 of the file of an item")
+async def get_item_object_metadata_route(id: int, token: Annotated[None, Security(verify_token, scopes=["Admin"])]):
+    return await find_item_object_metadata(id)
+
+@item_router.delete("/{id}/object", response_model=dict, description="Delete the file of an item")
+async def delete_item_object_route(id: int, token: Annotated[None, Security(verify_token, scopes=["Admin"])]):
+    return await delete_item_object(id)
+
 @item_router.delete("/{id}", response_model=dict, description="Delete an item by ID")
 async def delete_item_route(id: int, token: Annotated[None, Security(verify_token, scopes=["Admin"])]):
     return await delete_item(id)
 
-@item_router.delete("", response_model=dict, description="Delete all items")
-async def delete_all_items_route(token: Annotated[None, Security(verify_token, scopes=["Admin"])]):
-    return await delete_all_items()
+@item_router.delete("", response_model=dict, description="Delete all items, with background=true a job is started and can be polled on /items/jobs/{job_id}")
+async def delete_all_items_route(
+    token: Annotated[None, Security(verify_token, scopes=["Admin"])],
+    mode: Literal["auto", "batched", "truncate"] = "auto",
+    batch_size: int = Query(ITEMS_DELETE_BATCH_SIZE, ge=1, le=100000),
+    background: bool = False,
+):
+    if background:
+        job = await start_delete_all_items_job(mode, batch_size)
+        return JSONResponse(content=jsonable_encoder(job), status_code=status.HTTP_202_ACCEPTED)
+    return await delete_all_items(mode, batch_size)
@@ -0,0 +1,14 @@
+from fastapi import APIRouter
+
+from ..utils.metrics import get_metrics
+
+
+metrics_router = APIRouter(
+    prefix="/metrics",
+    tags=["metrics"]
+)
+
+# Route to get the metrics of this worker
+@metrics_router.get("", response_model=dict, description="Get the metrics of this worker")
+async def get_all_metrics():
+    return get_metrics().snapshot()
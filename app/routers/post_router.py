@@ -1,39 +1,84 @@
 # routers/post_router.py
 
-from fastapi import APIRouter, Depends, Security
+from fastapi import APIRouter, Depends, Header, Security, Query
+from fastapi.responses import StreamingResponse
 from typing import List, Annotated
 from ..controllers.auth_controller import verify_and_get_current_user_id
 from app.controllers.post_controller import (
     create_post,
     find_all_posts,
+    find_all_posts_projected,
+    parse_post_fields,
     find_one_post,
     find_post_by_id,
+    find_posts_by_ids,
     update_post,
     delete_post,
 )
-from ..models.post import Post
+from ..controllers.post_event_controller import post_event_broker, stream_post_events
+from ..controllers.view_counter_controller import view_counter
+from ..controllers.idempotency_controller import run_idempotent
+from ..models.post import Post, PostBatch, PostSummary
 from ..models.user import User, UserIdAndUsername
+from ..utils.batch import parse_id_list
+from ..utils.deadline import query_deadline, INTERACTIVE_QUERY_TIMEOUT, LIST_QUERY_TIMEOUT
 
 post_router = APIRouter(
     prefix="/posts",
     tags=["post"],
 )
 
-@post_router.post("", response_model=Post, description="Create a new post")
-async def create_post_route(post: Post, user: Annotated[UserIdAndUsername, Security(verify_and_get_current_user_id, scopes=["User"])]):
-    return await create_post(post, user)
+# A retry with the same Idempotency-Key gets the response of the first request, the post is created once
+@post_router.post("", response_model=Post, description="Create a new post, send an Idempotency-Key header to retry safely")
+async def create_post_route(
+    post: Post,
+    user: Annotated[UserIdAndUsername, Security(verify_and_get_current_user_id, scopes=["User"])],
+    idempotency_key: Annotated[str | None, Header(min_length=1, max_length=255)] = None,
+):
+    if idempotency_key is None:
+        return await create_post(post, user)
+    return await run_idempotent(f"posts:{user.user_id}", idempotency_key, post, lambda: create_post(post, user))
 
-@post_router.get("", response_model=List[Post], description="Get all posts")
-async def get_all_posts_route():
+# Fields that are not selected with ?fields= are left out of the response
+@post_router.get("", response_model=List[PostSummary], response_model_exclude_unset=True, dependencies=[Depends(query_deadline(LIST_QUERY_TIMEOUT))], description="Get all posts, eg: /posts?fields=post_id,title,username,content&excerpt_len=200")
+async def get_all_posts_route(
+    fields: str | None = Query(None, description="Comma separated list of the fields to return"),
+    excerpt_len: int | None = Query(None, ge=1, le=10000, description="Maximum number of characters of content"),
+):
+    if fields or excerpt_len:
+        field_list = parse_post_fields(fields) if fields else None
+        return await find_all_posts_projected(field_list, excerpt_len)
     return await find_all_posts()
 
-@post_router.get("/one", response_model=Post, description="Get one post")
+@post_router.get("/one", response_model=Post, dependencies=[Depends(query_deadline(INTERACTIVE_QUERY_TIMEOUT))], description="Get one post")
 async def get_post_route():
     return await find_one_post()
 
-@post_router.get("/{post_id}", response_model=Post, description="Get a post by ID")
+# Must be declared before /{post_id}
+# The browser sends the id of the last event received in Last-Event-ID when it reconnects
+@post_router.get("/stream", response_class=StreamingResponse, description="Server-Sent Events stream of the created, updated and deleted posts. A reset event means that events were missed and the posts must be reloaded")
+async def stream_posts_route(
+    last_event_id: Annotated[int | None, Header()] = None,
+    from_event_id: int | None = Query(None, ge=0, description="Id of the last event received, when Last-Event-ID cannot be sent"),
+):
+    subscriber = await post_event_broker.subscribe()
+    return StreamingResponse(
+        stream_post_events(subscriber, last_event_id if last_event_id is not None else from_event_id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+# Must be declared before /{post_id}
+@post_router.get("/batch", response_model=PostBatch, dependencies=[Depends(query_deadline(INTERACTIVE_QUERY_TIMEOUT))], description="Get several posts by ID, eg: /posts/batch?ids=3,1,2")
+async def get_posts_batch_route(ids: str = Query(..., description="Comma separated list of post ids")):
+    return await find_posts_by_ids(parse_id_list(ids))
+
+@post_router.get("/{post_id}", response_model=Post, dependencies=[Depends(query_deadline(INTERACTIVE_QUERY_TIMEOUT))], description="Get a post by ID")
 async def get_post_by_id_route(post_id: int):
-    return await find_post_by_id(post_id)
+    post = await find_post_by_id(post_id)
+    # The post may be shared with concurrent requests, it is copied to add the views of this worker
+    view_counter.record(post_id)
+    return post.model_copy(update={"views": post.views + view_counter.pending_views(post_id)})
 
 @post_router.put("/{post_id}", response_model=Post, description="Update a post by ID")
 async def update_post_route(post_id: int, post: Post, user: Annotated[UserIdAndUsername, Security(verify_and_get_current_user_id, scopes=["User"])]):
@@ -1,10 +1,13 @@
-from fastapi import APIRouter, Security
+import asyncio
+from fastapi import APIRouter, Depends, Query, Security, Response
 from fastapi.responses import JSONResponse
-from typing import Annotated
+from typing import Annotated, Literal
 
 from ..controllers.auth_controller import verify_token
-from ..controllers.user_controller import find_user_by_username, find_all_users, ban_user_by_username
+from ..controllers.user_controller import find_user_by_username, find_all_users, search_users, count_users, ban_user_by_username, USER_SEARCH_MAX_LIMIT
+from ..controllers.count_controller import add_total_count_headers
 from ..models.user import User
+from ..utils.deadline import query_deadline, INTERACTIVE_QUERY_TIMEOUT, LIST_QUERY_TIMEOUT
 
 
 user_router = APIRouter(
@@ -12,13 +15,38 @@ user_router = APIRouter(
     tags=["user"]
 )
 
-@user_router.get("/{username}", response_model=User, description="Get a user by username")
+@user_router.get("/{username}", response_model=User, dependencies=[Depends(query_deadline(INTERACTIVE_QUERY_TIMEOUT))], description="Get a user by username")
 async def get_user(username: str, token: Annotated[None, Security(verify_token, scopes=["Admin"])]):
     return await find_user_by_username(username)
 
-@user_router.get("", response_model=list[User], description="Get all users")
-async def get_all_users(token: Annotated[None, Security(verify_token, scopes=["Admin"])]):
-    return await find_all_users()
+# Without any search parameter every user is returned, as before
+# With one of them the users are paginated, the next page is requested with after=<X-Next-Cursor>
+@user_router.get("", response_model=list[User], dependencies=[Depends(query_deadline(LIST_QUERY_TIMEOUT))], description="Get all users, or search them: /users?q=ali&role=Admin&disabled=false&limit=50. The X-Next-Cursor header holds the after value of the next page. With with_count=true the total is sent in the X-Total-Count header")
+async def get_all_users(
+    token: Annotated[None, Security(verify_token, scopes=["Admin"])],
+    response: Response,
+    with_count: bool = False,
+    q: str | None = Query(None, min_length=1, max_length=255, description="Part of the username or of the email"),
+    match: Literal["prefix", "substring"] = "substring",
+    role: list[str] | None = Query(None, description="Keep the users having one of these roles"),
+    disabled: bool | None = None,
+    limit: int | None = Query(None, ge=1, le=USER_SEARCH_MAX_LIMIT, description="Users per page (50 by default when searching)"),
+    after: str | None = Query(None, description="Username after which the page starts"),
+):
+    search = not (q is None and role is None and disabled is None and limit is None and after is None)
+    users_query = search_users(q, match, role, disabled, limit or 50, after) if search else find_all_users()
+    if with_count:
+        # The total of the search, every page included
+        result, count = await asyncio.gather(users_query, count_users(q, match, role, disabled))
+        add_total_count_headers(response, *count)
+    else:
+        result = await users_query
+    if not search:
+        return result
+    users, next_cursor = result
+    if next_cursor is not None:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return users
 
 @user_router.put("/ban/{username}", response_model=dict, description="Ban a user by username")
 async def ban_user(username: str, token: Annotated[None, Security(verify_token, scopes=["Admin"])]):
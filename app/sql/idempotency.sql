@@ -0,0 +1,18 @@
+-- Responses of the requests sent with an Idempotency-Key (POST /posts, POST /items)
+-- A row is inserted when the request starts (status_code NULL: the key is locked)
+-- and completed with the response, the retries get it back until expires_at
+-- The script can be run again
+
+CREATE TABLE IF NOT EXISTS idempotency_keys (
+    scope VARCHAR(64) NOT NULL, -- Route and user, eg: posts:12
+    idempotency_key VARCHAR(255) NOT NULL,
+    request_hash BYTEA NOT NULL, -- SHA-256 of the request body
+    status_code SMALLINT,
+    response BYTEA, -- JSON body of the response
+    created_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    expires_at TIMESTAMPTZ NOT NULL,
+    PRIMARY KEY (scope, idempotency_key)
+);
+
+-- Purge of the expired keys
+CREATE INDEX IF NOT EXISTS idempotency_keys_expires_at_idx ON idempotency_keys (expires_at);
@@ -0,0 +1,18 @@
+-- Bulk deletions of the items run in the background (DELETE /items?background=true)
+-- Each worker records the progress of its jobs, the jobs of a worker that is gone are marked
+-- as failed when a worker starts (see app/controllers/item_controller.py)
+-- Run after items.sql, the script can be run again
+
+CREATE TABLE IF NOT EXISTS item_delete_jobs (
+    job_id serial PRIMARY KEY,
+    mode VARCHAR (16) NOT NULL,
+    status VARCHAR (16) NOT NULL DEFAULT 'pending', -- pending, running, done or failed
+    deleted BIGINT NOT NULL DEFAULT 0, -- Number of rows deleted so far (unknown with TRUNCATE)
+    error TEXT,
+    created_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP, -- Last progress, to find the jobs of a worker that is gone
+    finished_at TIMESTAMPTZ
+);
+
+-- Databases created before updated_at was added
+ALTER TABLE item_delete_jobs ADD COLUMN IF NOT EXISTS updated_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP;
@@ -0,0 +1,13 @@
+-- Metadata of the file attached to an item
+-- The content is stored on disk, in OBJECT_STORAGE_DIR/<storage_key>
+-- Run after items.sql, the script can be run again
+
+CREATE TABLE IF NOT EXISTS item_objects (
+    item_id INTEGER PRIMARY KEY REFERENCES items(item_id) ON DELETE CASCADE,
+    filename VARCHAR (255) NOT NULL,
+    content_type VARCHAR (255) NOT NULL,
+    size BIGINT NOT NULL,
+    sha256 CHAR (64) NOT NULL, -- Hex digest of the content, used as ETag
+    storage_key VARCHAR (64) NOT NULL UNIQUE,
+    created_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP
+);
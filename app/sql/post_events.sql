@@ -0,0 +1,89 @@
+-- Log of the changes made to the posts, streamed by GET /posts/stream
+-- Each change is written by a trigger in the transaction that makes it, then announced with
+-- pg_notify('post_events', event_id): the notification is only delivered once the change is committed
+-- Run after posts.sql (dropping posts drops its triggers), the script can be run again
+
+-- The event ids are not in commit order: a transaction can commit an event after the one of a later
+-- transaction. The events are read in (tx_id, event_id) order, and only those of the transactions older
+-- than the oldest one still running (pg_snapshot_xmin): no event can appear before them anymore,
+-- so a reader going forward in this order never skips one, without serializing the writers
+CREATE TABLE IF NOT EXISTS post_events (
+    event_id BIGSERIAL PRIMARY KEY,
+    tx_id BIGINT NOT NULL DEFAULT pg_current_xact_id()::text::bigint,
+    post_id INTEGER NOT NULL,
+    kind VARCHAR(10) NOT NULL,
+    data JSONB NOT NULL,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Tables created before tx_id (their events keep the transaction of the migration, so their event_id order)
+ALTER TABLE post_events ADD COLUMN IF NOT EXISTS tx_id BIGINT NOT NULL DEFAULT pg_current_xact_id()::text::bigint;
+
+-- Events are read in (tx_id, event_id) order
+CREATE INDEX IF NOT EXISTS post_events_tx_id_idx ON post_events (tx_id, event_id);
+
+-- Old events are removed by date
+CREATE INDEX IF NOT EXISTS post_events_created_at_idx ON post_events (created_at);
+
+-- Record an event for a post, data holds the post as returned by the API (only post_id when deleted)
+CREATE OR REPLACE FUNCTION record_post_event(target_post_id INT, event_kind VARCHAR) RETURNS VOID AS $$
+DECLARE
+    event_data JSONB;
+    new_event_id BIGINT;
+BEGIN
+    IF event_kind = 'deleted' THEN
+        event_data := jsonb_build_object('post_id', target_post_id);
+    ELSE
+        SELECT jsonb_build_object(
+            'post_id', p.post_id,
+            'title', p.title,
+            'content', p.content,
+            'created_at', to_char(p.created_at, 'YYYY-MM-DD HH24:MI:SS'),
+            'user_id', u.user_id,
+            'username', u.username
+        )
+        INTO event_data
+        FROM posts p
+        JOIN post_user pu ON pu.post_id = p.post_id
+        JOIN users u ON u.user_id = pu.user_id
+        WHERE p.post_id = target_post_id;
+        -- A post without author is not listed, its creation is announced when post_user is filled
+        IF event_data IS NULL THEN
+            RETURN;
+        END IF;
+    END IF;
+    INSERT INTO post_events (post_id, kind, data)
+    VALUES (target_post_id, event_kind, event_data)
+    RETURNING event_id INTO new_event_id;
+    PERFORM pg_notify('post_events', new_event_id::text);
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION post_changed() RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        PERFORM record_post_event(OLD.post_id, 'deleted');
+    ELSE
+        PERFORM record_post_event(NEW.post_id, 'updated');
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- create_post inserts the post then its author, the post is complete once post_user is filled
+CREATE OR REPLACE FUNCTION post_author_added() RETURNS TRIGGER AS $$
+BEGIN
+    PERFORM record_post_event(NEW.post_id, 'created');
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS post_events_changes ON posts;
+CREATE TRIGGER post_events_changes
+    AFTER UPDATE OR DELETE ON posts
+    FOR EACH ROW EXECUTE FUNCTION post_changed();
+
+DROP TRIGGER IF EXISTS post_events_created ON post_user;
+CREATE TRIGGER post_events_created
+    AFTER INSERT ON post_user
+    FOR EACH ROW EXECUTE FUNCTION post_author_added();
@@ -0,0 +1,9 @@
+-- View counts of the posts, kept out of posts so that counting a view does not
+-- rewrite the post row (nor fire the post_events triggers)
+-- The counts are written in batches by the workers (see app/controllers/view_counter_controller.py)
+-- Run after posts.sql, the script can be run again
+
+CREATE TABLE IF NOT EXISTS post_views (
+    post_id INTEGER PRIMARY KEY REFERENCES posts(post_id) ON DELETE CASCADE,
+    views BIGINT NOT NULL DEFAULT 0
+);
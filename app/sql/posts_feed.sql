@@ -0,0 +1,5 @@
+-- Index of the post feed (ORDER BY created_at DESC), see find_one_post in post_controller.py
+-- Without it, the latest post is found by sorting the whole table
+-- Run after posts.sql, the script can be run again
+
+CREATE INDEX IF NOT EXISTS posts_created_at_idx ON posts (created_at DESC);
@@ -0,0 +1,151 @@
+-- Range partitioning of posts by created_at, one partition per month (posts_pYYYY_MM, months in UTC)
+-- The feed (ORDER BY created_at DESC LIMIT n) only reads the latest partitions, whatever the history,
+-- and old months are detached in one statement instead of being deleted row by row
+-- The partitions ahead are created by the application (see post_partition_controller.py) with
+-- create_post_partitions, the old ones are removed with archive_post_partitions
+-- Run after posts.sql, posts_feed.sql, post_events.sql and post_views.sql (or after posts_shard.sql on a shard),
+-- the script can be run again:
+-- on an existing database it moves the posts into the partitioned table (the table is locked meanwhile)
+
+CREATE SCHEMA IF NOT EXISTS posts_archive;
+
+-- Authors of the archived posts, the archived partitions are tables of posts_archive
+CREATE TABLE IF NOT EXISTS posts_archive.post_user (
+    post_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    PRIMARY KEY (post_id, user_id)
+);
+
+-- Create the monthly partitions of posts covering [from_date, until_date]
+-- The partitions that already exist are kept, a month having posts in posts_default
+-- (inserted while its partition did not exist) is skipped with a warning, move them by hand
+-- Returns the names of the created partitions
+CREATE OR REPLACE FUNCTION create_post_partitions(from_date TIMESTAMPTZ, until_date TIMESTAMPTZ) RETURNS SETOF TEXT AS $$
+DECLARE
+    month_start TIMESTAMPTZ := date_trunc('month', from_date AT TIME ZONE 'UTC') AT TIME ZONE 'UTC';
+    partition_name TEXT;
+BEGIN
+    -- The workers run this at the same time
+    PERFORM pg_advisory_xact_lock(hashtext('posts_partitions'));
+    WHILE month_start <= until_date LOOP
+        partition_name := 'posts_p' || to_char(month_start AT TIME ZONE 'UTC', 'YYYY_MM');
+        IF to_regclass(partition_name) IS NULL THEN
+            IF EXISTS (SELECT 1 FROM posts_default WHERE created_at >= month_start AND created_at < month_start + interval '1 month') THEN
+                RAISE WARNING 'posts_default has posts of %, partition % not created', to_char(month_start AT TIME ZONE 'UTC', 'YYYY-MM'), partition_name;
+            ELSE
+                EXECUTE format(
+                    'CREATE TABLE %I PARTITION OF posts FOR VALUES FROM (%L) TO (%L)',
+                    partition_name, month_start, month_start + interval '1 month'
+                );
+                RETURN NEXT partition_name;
+            END IF;
+        END IF;
+        month_start := month_start + interval '1 month';
+    END LOOP;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Remove the partitions of the months ending before before_date
+--   - mode 'archive': the partition is detached and moved to the posts_archive schema,
+--     with the authors of its posts (posts_archive.post_user)
+--   - mode 'drop': the partition is dropped
+-- The view counts of the removed posts are deleted, no post event is sent for them
+-- Returns the names of the removed partitions
+CREATE OR REPLACE FUNCTION archive_post_partitions(before_date TIMESTAMPTZ, mode TEXT) RETURNS SETOF TEXT AS $$
+DECLARE
+    partition_name TEXT;
+BEGIN
+    IF mode NOT IN ('archive', 'drop') THEN
+        RAISE EXCEPTION 'Unknown archive mode: %', mode;
+    END IF;
+    PERFORM pg_advisory_xact_lock(hashtext('posts_partitions'));
+    FOR partition_name IN
+        SELECT c.relname
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'posts'::regclass
+            AND c.relname ~ '^posts_p\d{4}_\d{2}$'
+            AND (to_date(substr(c.relname, 8), 'YYYY_MM') + interval '1 month') AT TIME ZONE 'UTC' <= before_date
+        ORDER BY c.relname
+    LOOP
+        IF mode = 'archive' THEN
+            EXECUTE format(
+                'INSERT INTO posts_archive.post_user SELECT pu.post_id, pu.user_id FROM post_user pu JOIN %I p USING (post_id) ON CONFLICT DO NOTHING',
+                partition_name
+            );
+        END IF;
+        EXECUTE format('DELETE FROM post_user WHERE post_id IN (SELECT post_id FROM %I)', partition_name);
+        EXECUTE format('DELETE FROM post_views WHERE post_id IN (SELECT post_id FROM %I)', partition_name);
+        EXECUTE format('ALTER TABLE posts DETACH PARTITION %I', partition_name);
+        IF mode = 'archive' THEN
+            EXECUTE format('ALTER TABLE %I SET SCHEMA posts_archive', partition_name);
+        ELSE
+            EXECUTE format('DROP TABLE %I', partition_name);
+        END IF;
+        RETURN NEXT partition_name;
+    END LOOP;
+END;
+$$ LANGUAGE plpgsql;
+
+-- The primary key of a partitioned table must hold the partition key, post_id alone is no longer
+-- unique for Postgres (it still is, from the sequence): the foreign keys to posts(post_id) are
+-- replaced by this trigger, which removes the author and the view count of a deleted post
+CREATE OR REPLACE FUNCTION post_deleted() RETURNS TRIGGER AS $$
+BEGIN
+    DELETE FROM post_user WHERE post_id = OLD.post_id;
+    DELETE FROM post_views WHERE post_id = OLD.post_id;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Move an existing posts table into the partitioned one
+DO $$
+BEGIN
+    IF (SELECT relkind FROM pg_class WHERE oid = 'posts'::regclass) = 'p' THEN
+        RETURN;
+    END IF;
+    LOCK TABLE posts, post_user, post_views IN ACCESS EXCLUSIVE MODE;
+    ALTER TABLE post_user DROP CONSTRAINT IF EXISTS post_user_post_id_fkey;
+    ALTER TABLE post_views DROP CONSTRAINT IF EXISTS post_views_post_id_fkey;
+    -- The sequence would be dropped with the old table
+    ALTER SEQUENCE posts_post_id_seq OWNED BY NONE;
+    ALTER TABLE posts RENAME TO posts_unpartitioned;
+    ALTER INDEX posts_pkey RENAME TO posts_unpartitioned_pkey;
+    ALTER INDEX IF EXISTS posts_created_at_idx RENAME TO posts_unpartitioned_created_at_idx;
+
+    CREATE TABLE posts (
+        post_id INTEGER NOT NULL DEFAULT nextval('posts_post_id_seq'),
+        title VARCHAR(255) NOT NULL,
+        content TEXT,
+        created_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (post_id, created_at)
+    ) PARTITION BY RANGE (created_at);
+    ALTER SEQUENCE posts_post_id_seq OWNED BY posts.post_id;
+    CREATE INDEX posts_created_at_idx ON posts (created_at DESC);
+    -- Posts outside of every partition, empty as long as the partitions ahead are created
+    CREATE TABLE posts_default PARTITION OF posts DEFAULT;
+
+    PERFORM create_post_partitions(COALESCE((SELECT min(created_at) FROM posts_unpartitioned), NOW()), NOW() + interval '3 months');
+    INSERT INTO posts (post_id, title, content, created_at)
+    SELECT post_id, title, content, COALESCE(created_at, NOW()) FROM posts_unpartitioned;
+    -- Its triggers (post_events_changes) are dropped with it, they are created again below
+    DROP TABLE posts_unpartitioned;
+END;
+$$;
+
+-- The shards of the posts have no post events (see posts_shard.sql)
+DO $$
+BEGIN
+    IF to_regproc('post_changed') IS NOT NULL THEN
+        DROP TRIGGER IF EXISTS post_events_changes ON posts;
+        CREATE TRIGGER post_events_changes
+            AFTER UPDATE OR DELETE ON posts
+            FOR EACH ROW EXECUTE FUNCTION post_changed();
+    END IF;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS posts_deleted ON posts;
+CREATE TRIGGER posts_deleted
+    AFTER DELETE ON posts
+    FOR EACH ROW EXECUTE FUNCTION post_deleted();
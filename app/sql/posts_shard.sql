@@ -0,0 +1,31 @@
+-- Schema of a shard of the posts (POSTGRES_SHARDS, see app/database/shards.py)
+-- A shard holds the posts of the users whose user_id % shard_count = shard_index, with their
+-- authors and view counts. The users stay in the main database: post_user has no foreign key to users
+-- Run on each shard, then posts_partitions.sql to partition its posts:
+--   psql -v shard_index=0 -v shard_count=2 -f posts_shard.sql
+
+CREATE TABLE IF NOT EXISTS posts (
+    post_id SERIAL PRIMARY KEY,
+    title VARCHAR(255) NOT NULL,
+    content TEXT,
+    created_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS post_user (
+    post_id INTEGER REFERENCES posts(post_id) ON DELETE CASCADE,
+    user_id INTEGER NOT NULL,
+    PRIMARY KEY (post_id, user_id)
+);
+
+CREATE TABLE IF NOT EXISTS post_views (
+    post_id INTEGER PRIMARY KEY REFERENCES posts(post_id) ON DELETE CASCADE,
+    views BIGINT NOT NULL DEFAULT 0
+);
+
+CREATE INDEX IF NOT EXISTS posts_created_at_idx ON posts (created_at DESC);
+
+-- The post ids of the shard are shard_index + 1 + k * shard_count: the ids of the shards never
+-- collide and the application finds the shard of a post from its id
+-- Run again, the sequence continues after the posts of the shard
+SELECT COALESCE(max(post_id) + :shard_count, :shard_index + 1) AS next_post_id FROM posts \gset
+ALTER SEQUENCE posts_post_id_seq INCREMENT BY :shard_count MINVALUE 1 RESTART WITH :next_post_id;
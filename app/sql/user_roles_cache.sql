@@ -0,0 +1,62 @@
+-- Denormalized copy of the role names of each user, in users.roles
+-- It is kept up to date by triggers on user_roles and roles, in the same transaction as the change,
+-- so that the auth lookup (find_user_by_username) is a single-row probe on the username index
+-- Run after auth.sql, the script can be run again on an existing database
+
+ALTER TABLE users ADD COLUMN IF NOT EXISTS roles VARCHAR(255)[] NOT NULL DEFAULT '{}';
+
+-- Recompute users.roles for one user from user_roles
+CREATE OR REPLACE FUNCTION refresh_user_roles(target_user_id INT) RETURNS VOID AS $$
+BEGIN
+    -- Lock the user first, the next statement then sees the role changes committed meanwhile
+    -- (two concurrent role changes for the same user cannot overwrite each other)
+    PERFORM 1 FROM users WHERE user_id = target_user_id FOR UPDATE;
+    UPDATE users SET roles = COALESCE((
+        SELECT array_agg(r.role_name ORDER BY r.role_name)
+        FROM user_roles ur
+        JOIN roles r ON ur.role_id = r.role_id
+        WHERE ur.user_id = target_user_id
+    ), '{}')
+    WHERE user_id = target_user_id;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION user_roles_changed() RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        PERFORM refresh_user_roles(OLD.user_id);
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') AND (TG_OP = 'INSERT' OR NEW.user_id IS DISTINCT FROM OLD.user_id OR NEW.role_id IS DISTINCT FROM OLD.role_id) THEN
+        PERFORM refresh_user_roles(NEW.user_id);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS user_roles_cache ON user_roles;
+CREATE TRIGGER user_roles_cache
+    AFTER INSERT OR UPDATE OR DELETE ON user_roles
+    FOR EACH ROW EXECUTE FUNCTION user_roles_changed();
+
+-- Renaming a role renames it in every users.roles
+CREATE OR REPLACE FUNCTION role_renamed() RETURNS TRIGGER AS $$
+BEGIN
+    UPDATE users SET roles = array_replace(roles, OLD.role_name, NEW.role_name)
+    WHERE OLD.role_name = ANY(roles);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS roles_cache ON roles;
+CREATE TRIGGER roles_cache
+    AFTER UPDATE OF role_name ON roles
+    FOR EACH ROW WHEN (OLD.role_name IS DISTINCT FROM NEW.role_name)
+    EXECUTE FUNCTION role_renamed();
+
+-- Fill the column for the existing users
+UPDATE users u SET roles = COALESCE((
+    SELECT array_agg(r.role_name ORDER BY r.role_name)
+    FROM user_roles ur
+    JOIN roles r ON ur.role_id = r.role_id
+    WHERE ur.user_id = u.user_id
+), '{}');
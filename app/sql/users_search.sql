@@ -0,0 +1,16 @@
+-- Indexes of the user search (GET /users?q=), see search_users in user_controller.py
+-- Run after user_roles_cache.sql, the script can be run again
+
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+-- Substring search: lower(username) LIKE '%term%' OR lower(email) LIKE '%term%'
+-- (a term needs 3 characters for the trigrams to narrow the search)
+CREATE INDEX IF NOT EXISTS users_username_trgm_idx ON users USING GIN (lower(username) gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS users_email_trgm_idx ON users USING GIN (lower(email) gin_trgm_ops);
+
+-- Prefix search: lower(username) LIKE 'term%', usable whatever the length of the term
+CREATE INDEX IF NOT EXISTS users_username_prefix_idx ON users (lower(username) text_pattern_ops);
+CREATE INDEX IF NOT EXISTS users_email_prefix_idx ON users (lower(email) text_pattern_ops);
+
+-- Role filter: roles && '{Admin}'
+CREATE INDEX IF NOT EXISTS users_roles_idx ON users USING GIN (roles);
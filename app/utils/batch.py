@@ -0,0 +1,30 @@
+import os
+from typing import List
+from fastapi import HTTPException, status
+
+# Maximum number of ids that can be requested at once on the batch endpoints
+BATCH_MAX_IDS = int(os.environ.get("BATCH_MAX_IDS", 100))
+
+
+# Function to parse a comma separated list of ids, duplicates are removed and the order is kept
+# Example: "3,1,3,2" -> [3, 1, 2]
+def parse_id_list(ids: str) -> List[int]:
+    try:
+        id_list = [int(part) for part in ids.split(",") if part.strip()]
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail="ids must be a comma separated list of integers"
+        )
+    id_list = list(dict.fromkeys(id_list))
+    if not id_list:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail="At least one id is required"
+        )
+    if len(id_list) > BATCH_MAX_IDS:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f"Too many ids, the maximum is {BATCH_MAX_IDS}"
+        )
+    return id_list
@@ -0,0 +1,24 @@
+import os
+
+from ..database.db import query_timeout, reserved_connections
+
+# Timeout (in seconds) of the queries of the interactive routes (a single post, item or user)
+INTERACTIVE_QUERY_TIMEOUT = float(os.environ.get("INTERACTIVE_QUERY_TIMEOUT", 5))
+
+# Timeout (in seconds) of the queries of the routes returning lists
+LIST_QUERY_TIMEOUT = float(os.environ.get("LIST_QUERY_TIMEOUT", 20))
+
+
+# Function to create a dependency that sets the timeout of every query run by the route
+# Example: @router.get("/{id}", dependencies=[Depends(query_deadline(INTERACTIVE_QUERY_TIMEOUT))])
+def query_deadline(seconds: float):
+    # The dependency must be async, so that it runs in the task of the request
+    async def set_query_timeout():
+        query_timeout.set(seconds)
+    return set_query_timeout
+
+
+# Dependency letting the route use the connections reserved in the pool (DB_POOL_RESERVED_AUTH),
+# so that the users can still log in when the other routes take the rest of the pool
+async def use_reserved_connections():
+    reserved_connections.set(True)
@@ -0,0 +1,114 @@
+import os
+import re
+from email.utils import formatdate
+
+import anyio
+from starlette.background import BackgroundTask
+from starlette.responses import Response
+from starlette.types import Receive, Scope, Send
+
+# Size of the reads of the file
+FILE_CHUNK_SIZE = 256 * 1024
+
+RANGE_PATTERN = re.compile(r"bytes=(\d*)-(\d*)")
+
+
+# Function to parse a Range header for a file of the given size
+# Returns (start, end) with end included, None to send the whole file
+# (no header, several ranges or an If-Range that does not match), or "invalid" if it cannot be satisfied
+# No range of an empty file can be satisfied
+def parse_range(range_header: str | None, size: int):
+    if not range_header:
+        return None
+    match = RANGE_PATTERN.fullmatch(range_header.replace(" ", ""))
+    if not match or not (match[1] or match[2]):
+        return None
+    if size == 0:
+        return "invalid"
+    if not match[1]:
+        # Suffix range: the last n bytes
+        length = int(match[2])
+        if length == 0:
+            return "invalid"
+        return max(size - length, 0), size - 1
+    start = int(match[1])
+    end = min(int(match[2]), size - 1) if match[2] else size - 1
+    if start >= size or start > end:
+        return "invalid"
+    return start, end
+
+
+# Response sending a file from disk, with support of the Range header
+# The file is never loaded in memory, it is read in chunks of FILE_CHUNK_SIZE
+# uvicorn does not offer the zero-copy extension of ASGI (http.response.zerocopysend),
+# so the chunks go through Python: put a proxy serving the files itself in front for sendfile
+class RangeFileResponse(Response):
+
+    def __init__(self, path: str, size: int, media_type: str, etag: str, filename: str | None = None, mtime: float | None = None, background: BackgroundTask | None = None):
+        # The headers depend on the Range of the request, they are built in __call__
+        self.background = background
+        self.path = path
+        self.size = size
+        self.media_type = media_type
+        self.etag = etag
+        self.filename = filename
+        self.mtime = mtime
+
+    def _headers(self, status: int, start: int, end: int) -> list:
+        headers = {
+            "accept-ranges": "bytes",
+            "content-type": self.media_type,
+            "content-length": str(end - start + 1),
+            "etag": self.etag,
+        }
+        if status == 206:
+            headers["content-range"] = f"bytes {start}-{end}/{self.size}"
+        if self.mtime is not None:
+            headers["last-modified"] = formatdate(self.mtime, usegmt=True)
+        if self.filename:
+            quoted = self.filename.replace("\\", "\\\\").replace('"', '\\"')
+            headers["content-disposition"] = f'attachment; filename="{quoted}"'
+        return [(key.encode(), value.encode("latin-1", "replace")) for key, value in headers.items()]
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        await self._send_file(scope, send)
+        if self.background is not None:
+            await self.background()
+
+    async def _send_file(self, scope: Scope, send: Send):
+        request_headers = {key.decode("latin-1").lower(): value.decode("latin-1") for key, value in scope["headers"]}
+        byte_range = parse_range(request_headers.get("range"), self.size)
+        # If-Range: the range is only sent if the client has the same version of the file
+        if_range = request_headers.get("if-range")
+        if if_range is not None and if_range != self.etag:
+            byte_range = None
+
+        if byte_range == "invalid":
+            await send({
+                "type": "http.response.start",
+                "status": 416,
+                "headers": [(b"content-range", f"bytes */{self.size}".encode()), (b"content-length", b"0")],
+            })
+            await send({"type": "http.response.body", "body": b""})
+            return
+
+        status = 206 if byte_range else 200
+        start, end = byte_range or (0, self.size - 1)
+        await send({"type": "http.response.start", "status": status, "headers": self._headers(status, start, end)})
+        if scope["method"] == "HEAD" or self.size == 0:
+            await send({"type": "http.response.body", "body": b""})
+            return
+
+        with open(self.path, "rb") as file:
+            count = end - start + 1
+            offset = start
+            while count > 0:
+                chunk = await anyio.to_thread.run_sync(os.pread, file.fileno(), min(FILE_CHUNK_SIZE, count), offset)
+                if not chunk:
+                    break
+                offset += len(chunk)
+                count -= len(chunk)
+                await send({"type": "http.response.body", "body": chunk, "more_body": count > 0})
+            if count > 0:
+                # The file was truncated while it was sent, the connection must be closed
+                raise RuntimeError(f"File at path {self.path} is shorter than expected")
@@ -0,0 +1,61 @@
+import threading
+from collections import defaultdict
+
+
+# Function to build the key of a metric from its name and its labels
+# Example: metric_key("compression_responses_total", encoding="gzip") -> 'compression_responses_total{encoding="gzip"}'
+def metric_key(name: str, **labels) -> str:
+    if not labels:
+        return name
+    label_str = ",".join(f'{key}="{value}"' for key, value in sorted(labels.items()))
+    return name + "{" + label_str + "}"
+
+
+# Class that holds the in-process metrics of a worker
+# Counters only go up, gauges hold the last value set and summaries keep count, sum and max
+class Metrics:
+
+    def __init__(self):
+        # Metrics can be updated from the threadpool, so writes are guarded
+        self._lock = threading.Lock()
+        self.counters = defaultdict(float)
+        self.gauges = {}
+        self.summaries = {}
+
+    # Function to increment a counter
+    def increment(self, name: str, value: float = 1, **labels):
+        key = metric_key(name, **labels)
+        with self._lock:
+            self.counters[key] += value
+
+    # Function to set a gauge
+    def set_gauge(self, name: str, value: float, **labels):
+        key = metric_key(name, **labels)
+        with self._lock:
+            self.gauges[key] = value
+
+    # Function to record an observation in a summary
+    def observe(self, name: str, value: float, **labels):
+        key = metric_key(name, **labels)
+        with self._lock:
+            summary = self.summaries.setdefault(key, {"count": 0, "sum": 0.0, "max": 0.0})
+            summary["count"] += 1
+            summary["sum"] += value
+            summary["max"] = max(summary["max"], value)
+
+    # Function to get a copy of every metric
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "counters": dict(self.counters),
+                "gauges": dict(self.gauges),
+                "summaries": {key: dict(value) for key, value in self.summaries.items()},
+            }
+
+
+# Create a single instance of the metrics for the whole application
+metrics_instance = Metrics()
+
+# Function to get the metrics instance
+def get_metrics():
+    return metrics_instance
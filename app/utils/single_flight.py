@@ -0,0 +1,68 @@
+import asyncio
+import functools
+import inspect
+
+from .metrics import get_metrics
+
+
+# Class representing a call in progress, shared by every caller asking for the same key
+class _Call:
+
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+
+# Class that makes concurrent identical calls share a single execution
+# The first caller starts the call in its own task, the others wait for the same result
+# Errors are raised to every caller, and the call is only cancelled once every caller has left
+class SingleFlight:
+
+    def __init__(self, name: str):
+        self.name = name
+        self._calls = {}
+
+    # Function to run func(*args, **kwargs) once for all the concurrent callers using the same key
+    async def do(self, key, func, *args, **kwargs):
+        call = self._calls.get(key)
+        if call is None:
+            call = _Call(asyncio.ensure_future(func(*args, **kwargs)))
+            self._calls[key] = call
+            call.task.add_done_callback(functools.partial(self._forget, key, call))
+        else:
+            get_metrics().increment("single_flight_shared_total", function=self.name)
+        call.waiters += 1
+        try:
+            # Shield the shared task, so that a cancelled caller does not cancel it for the others
+            return await asyncio.shield(call.task)
+        finally:
+            call.waiters -= 1
+            if call.waiters == 0 and not call.task.done():
+                # Nobody wants the result anymore, the next caller starts a new call
+                call.task.cancel()
+                if self._calls.get(key) is call:
+                    del self._calls[key]
+
+    # Function called when a call is done, the next caller will start a new one
+    def _forget(self, key, call: _Call, task: asyncio.Task):
+        if self._calls.get(key) is call:
+            del self._calls[key]
+        # Mark the exception as retrieved, it has been raised to the callers (if any are left)
+        if not task.cancelled():
+            task.exception()
+
+
+# Decorator to coalesce the concurrent calls of a coroutine function made with the same arguments
+# The arguments must be hashable, f(1) and f(post_id=1) share the same call
+def single_flight(func):
+    group = SingleFlight(func.__name__)
+    signature = inspect.signature(func)
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        bound = signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+        key = tuple(bound.arguments.items())
+        return await group.do(key, func, *args, **kwargs)
+
+    return wrapper
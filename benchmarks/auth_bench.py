@@ -0,0 +1,159 @@
+# Microbenchmarks of the authentication hot path: python benchmarks/auth_bench.py
+# Each function is measured in isolation (no HTTP, no database) for every bcrypt cost factor,
+# JWT algorithm and token size given on the command line
+# The results are written as JSON in benchmarks/results/, named after the current commit,
+# so that two runs can be compared to choose the cost factor and the algorithm
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import timeit
+from datetime import datetime, timedelta, timezone
+from importlib.metadata import version
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# The controllers read their configuration on import, nothing here talks to a database
+os.environ.setdefault("SECRET_KEY", "0" * 64)
+os.environ.setdefault("ALGORITHM", "HS256")
+os.environ.setdefault("DB_BACKEND", "memory")
+
+from jose import jwt  # noqa: E402
+from passlib.context import CryptContext  # noqa: E402
+
+from app.controllers import auth_controller  # noqa: E402
+from app.models.auth import TokenData, UserAndToken  # noqa: E402
+
+PASSWORD = "correct horse battery staple"
+
+
+# Function to measure a function, returns the timings of one call in microseconds
+# The number of calls per repeat is chosen so that a repeat lasts at least min_time seconds
+def measure(function, repeat: int, min_time: float) -> dict:
+    timer = timeit.Timer(function)
+    number = 1
+    while timer.timeit(number) < min_time:
+        number *= 2
+    timings = [seconds / number * 1e6 for seconds in timer.repeat(repeat=repeat, number=number)]
+    return {
+        "calls_per_repeat": number,
+        "repeat": repeat,
+        "min_us": min(timings),
+        "median_us": statistics.median(timings),
+        "mean_us": statistics.mean(timings),
+        "stdev_us": statistics.stdev(timings) if len(timings) > 1 else 0.0,
+        "ops_per_second": 1e6 / min(timings),
+    }
+
+
+# Function to build the claims of a token, scopes controls its size
+def token_claims(scopes: int) -> dict:
+    return {"sub": "benchmark_user", "scopes": [f"Scope{index}" for index in range(scopes)]}
+
+
+# bcrypt: the hash is measured once per cost factor, the verification on a hash of that cost
+def bench_bcrypt(costs: list[int], repeat: int, min_time: float) -> list[dict]:
+    results = []
+    default_context = auth_controller.pwd_context
+    try:
+        for cost in costs:
+            auth_controller.pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=cost)
+            hashed = auth_controller.get_password_hash(PASSWORD)
+            results.append({"name": "get_password_hash", "bcrypt_cost": cost, **measure(lambda: auth_controller.get_password_hash(PASSWORD), repeat, min_time)})
+            results.append({"name": "verify_password", "bcrypt_cost": cost, **measure(lambda: auth_controller.verify_password(PASSWORD, hashed), repeat, min_time)})
+            print(f"bcrypt cost {cost}: done")
+    finally:
+        auth_controller.pwd_context = default_context
+    return results
+
+
+# JWT: create_token and the decode done by verify_token, for every algorithm and token size
+def bench_jwt(algorithms: list[str], token_scopes: list[int], repeat: int, min_time: float) -> list[dict]:
+    results = []
+    default_algorithm = auth_controller.ALGORITHM
+    secret_key = auth_controller.SECRET_KEY
+    try:
+        for algorithm in algorithms:
+            auth_controller.ALGORITHM = algorithm
+            for scopes in token_scopes:
+                claims = token_claims(scopes)
+                expires = timedelta(minutes=auth_controller.ACCESS_TOKEN_EXPIRE_MINUTES)
+                token = auth_controller.create_token(data=claims, expires_delta=expires)
+                common = {"algorithm": algorithm, "scopes": scopes, "token_bytes": len(token)}
+                results.append({"name": "create_token", **common, **measure(lambda: auth_controller.create_token(data=claims, expires_delta=expires), repeat, min_time)})
+                results.append({"name": "jwt.decode", **common, **measure(lambda: jwt.decode(token, secret_key, algorithms=[algorithm]), repeat, min_time)})
+            print(f"jwt {algorithm}: done")
+    finally:
+        auth_controller.ALGORITHM = default_algorithm
+    return results
+
+
+# Models built on each request: TokenData in verify_token, UserAndToken in the login response
+def bench_models(token_scopes: list[int], repeat: int, min_time: float) -> list[dict]:
+    results = []
+    for scopes in token_scopes:
+        claims = token_claims(scopes)
+        token = "x" * 200
+        results.append({"name": "TokenData", "scopes": scopes, **measure(lambda: TokenData(scopes=claims["scopes"], username=claims["sub"]), repeat, min_time)})
+        results.append({"name": "UserAndToken", "scopes": scopes, **measure(lambda: UserAndToken(username=claims["sub"], roles=claims["scopes"], access_token=token, token_type="bearer"), repeat, min_time)})
+    print("models: done")
+    return results
+
+
+# Function to get the current commit, "unknown" outside of a git checkout
+def current_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def parse_list(value: str, cast=str) -> list:
+    return [cast(part) for part in value.split(",") if part.strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Microbenchmarks of the authentication functions")
+    parser.add_argument("--bcrypt-costs", default="10,12", help="bcrypt cost factors, comma separated (default: 10,12)")
+    parser.add_argument("--algorithms", default="HS256,HS384,HS512", help="JWT algorithms, comma separated")
+    parser.add_argument("--token-scopes", default="1,10,100", help="number of scopes in the tokens, comma separated")
+    parser.add_argument("--repeat", type=int, default=5, help="measures per function (default: 5)")
+    parser.add_argument("--min-time", type=float, default=0.2, help="minimum duration of a measure in seconds")
+    parser.add_argument("--output", help="JSON file to write (default: benchmarks/results/auth-<commit>-<date>.json)")
+    args = parser.parse_args()
+
+    token_scopes = parse_list(args.token_scopes, int)
+    results = []
+    results += bench_bcrypt(parse_list(args.bcrypt_costs, int), args.repeat, args.min_time)
+    results += bench_jwt(parse_list(args.algorithms), token_scopes, args.repeat, args.min_time)
+    results += bench_models(token_scopes, args.repeat, args.min_time)
+
+    commit = current_commit()
+    now = datetime.now(timezone.utc)
+    report = {
+        "commit": commit,
+        "date": now.isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+        "packages": {package: version(package) for package in ("passlib", "bcrypt", "python-jose", "pydantic")},
+        "results": results,
+    }
+    output = args.output or os.path.join(ROOT, "benchmarks", "results", f"auth-{commit}-{now:%Y%m%dT%H%M%S}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as file:
+        json.dump(report, file, indent=2)
+
+    for result in results:
+        parameters = ", ".join(f"{key}={result[key]}" for key in ("bcrypt_cost", "algorithm", "scopes", "token_bytes") if key in result)
+        print(f"{result['name']:<18} {parameters:<45} {result['min_us']:>12.1f} us  {result['ops_per_second']:>12.0f} ops/s")
+    print(f"Results written to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,212 @@
+# Synthetic dataset generator: python benchmarks/generate_data.py --users 1000000 --posts 5000000
+# Loads users (with their roles), posts and items with COPY, in a single transaction
+# The data only depends on the options and on --seed, two runs with the same options give the same dataset
+# The database is the one of the POSTGRES_* environment variables (the .env file is loaded)
+
+import argparse
+import asyncio
+import bisect
+import itertools
+import math
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+import asyncpg
+from dotenv import load_dotenv
+from passlib.context import CryptContext
+
+FIRST_NAMES = ["alice", "bob", "carol", "david", "emma", "felix", "grace", "hugo", "ines", "jules", "karim", "lea", "malik", "nina", "oscar", "paul", "quentin", "rose", "sami", "theo", "ugo", "vera", "william", "yasmine", "zoe"]
+LAST_NAMES = ["martin", "bernard", "dubois", "thomas", "robert", "richard", "petit", "durand", "leroy", "moreau", "simon", "laurent", "lefebvre", "michel", "garcia", "david", "bertrand", "roux", "vincent", "fournier"]
+DOMAINS = ["example.com", "mail.test", "nuitdelinfo.test", "climat.test"]
+WORDS = ("climat environnement energie carbone recyclage velo train solaire eolien foret ocean biodiversite "
+         "sobriete isolation chauffage compost jardin local saison eau plastique dechet emission transport "
+         "renovation empreinte numerique serveur donnees securite sauvegarde chiffrement").split()
+
+# Triggers disabled during the load: users.roles and the post events are written directly
+# (one trigger call per row would make the load hours long and fill post_events)
+DISABLED_TRIGGERS = [("user_roles", "user_roles_cache"), ("post_user", "post_events_created"), ("posts", "post_events_changes")]
+
+
+# Function to draw integers in [0, n) with a Zipf law of exponent skew (0 gives a uniform law)
+# The most drawn values are spread over the range instead of being the first ones
+class SkewedChooser:
+
+    def __init__(self, rng: random.Random, n: int, skew: float):
+        self.rng = rng
+        self.n = n
+        self.skew = skew
+        if skew > 0:
+            self.cumulative = list(itertools.accumulate(1 / (rank ** skew) for rank in range(1, n + 1)))
+            self.permutation = list(range(n))
+            rng.shuffle(self.permutation)
+
+    def choose(self) -> int:
+        if self.skew <= 0:
+            return self.rng.randrange(self.n)
+        rank = bisect.bisect_left(self.cumulative, self.rng.random() * self.cumulative[-1])
+        return self.permutation[min(rank, self.n - 1)]
+
+
+# Function to build the text the contents are cut from, so that each post is a single slice
+def build_corpus(rng: random.Random, size: int) -> str:
+    words = []
+    length = 0
+    while length < size:
+        word = rng.choice(WORDS)
+        words.append(word)
+        length += len(word) + 1
+    return " ".join(words)
+
+
+# Function to draw a content length from a log-normal law, clipped to [1, maximum]
+def content_length(rng: random.Random, mean: float, sigma: float, maximum: int) -> int:
+    # mu is chosen so that the mean of the law is the requested mean
+    mu = math.log(mean) - sigma ** 2 / 2
+    return max(1, min(maximum, int(rng.lognormvariate(mu, sigma))))
+
+
+# Function to cut a generator of records in lists of batch_size records
+def batches(records, batch_size: int):
+    iterator = iter(records)
+    while batch := list(itertools.islice(iterator, batch_size)):
+        yield batch
+
+
+def user_records(args, rng: random.Random, first_id: int, password_hash: str):
+    for index in range(args.users):
+        user_id = first_id + index
+        first, last = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+        username = f"{first}.{last}{user_id}"
+        email = f"{first}.{last}{user_id}@{rng.choice(DOMAINS)}"
+        user_roles = ["User"]
+        if rng.random() < args.admin_ratio:
+            user_roles.append("Admin")
+        disabled = rng.random() < args.disabled_ratio
+        yield (user_id, username, password_hash, email, disabled, sorted(user_roles))
+
+
+def post_records(args, rng: random.Random, first_id: int, corpus: str, now: datetime):
+    for index in range(args.posts):
+        post_id = first_id + index
+        length = content_length(rng, args.content_mean, args.content_sigma, args.content_max)
+        start = rng.randrange(0, len(corpus) - length)
+        title = corpus[start:start + rng.randint(10, 80)].strip() or "post"
+        created_at = now - timedelta(seconds=rng.randrange(args.days * 86400))
+        yield (post_id, title, corpus[start:start + length], created_at)
+
+
+def item_records(args, rng: random.Random, corpus: str):
+    for index in range(args.items):
+        start = rng.randrange(0, len(corpus) - 200)
+        yield (f"item-{index}", corpus[start:start + rng.randint(20, 200)])
+
+
+# Function to COPY the records in batches, printing the progress
+async def copy(con, table: str, columns: list[str], records, batch_size: int, total: int):
+    start = time.perf_counter()
+    done = 0
+    for batch in batches(records, batch_size):
+        await con.copy_records_to_table(table, records=batch, columns=columns)
+        done += len(batch)
+        print(f"\r{table}: {done}/{total} rows ({done / max(time.perf_counter() - start, 1e-9):.0f} rows/s)", end="", flush=True)
+    print()
+
+
+async def generate(args):
+    rng = random.Random(args.seed)
+    now = datetime(2024, 1, 1, tzinfo=timezone.utc) if args.fixed_now else datetime.now(timezone.utc)
+
+    # A single bcrypt hash for every user, hashing millions of passwords would take days
+    start = time.perf_counter()
+    password_hash = CryptContext(schemes=["bcrypt"], bcrypt__rounds=args.bcrypt_cost).hash(args.password)
+    print(f"bcrypt hash computed in {time.perf_counter() - start:.2f}s, shared by every user (password: {args.password})")
+    corpus = build_corpus(rng, max(args.content_max * 4, 1024 * 1024))
+
+    con = await asyncpg.connect(
+        host=os.environ.get("POSTGRES_HOST"),
+        port=os.environ.get("POSTGRES_PORT"),
+        user=os.environ.get("POSTGRES_USER"),
+        password=os.environ.get("POSTGRES_PASSWORD"),
+        database=os.environ.get("POSTGRES_DB"),
+    )
+    try:
+        async with con.transaction():
+            # Nobody else writes these tables during the load, the ids can be chosen here
+            await con.execute("LOCK TABLE users, user_roles, posts, post_user, items IN EXCLUSIVE MODE;")
+            for table, trigger in DISABLED_TRIGGERS:
+                if await con.fetchval("SELECT EXISTS(SELECT 1 FROM pg_trigger WHERE tgname = $1 AND tgrelid = $2::regclass);", trigger, table):
+                    await con.execute(f"ALTER TABLE {table} DISABLE TRIGGER {trigger};")
+            roles = {row["role_name"]: row["role_id"] for row in await con.fetch("SELECT role_id, role_name FROM roles;")}
+            first_user_id = await con.fetchval("SELECT COALESCE(max(user_id), 0) + 1 FROM users;")
+            first_post_id = await con.fetchval("SELECT COALESCE(max(post_id), 0) + 1 FROM posts;")
+
+            # Users and their roles, users.roles is filled as the trigger would
+            users = []
+
+            def users_and_roles():
+                for record in user_records(args, rng, first_user_id, password_hash):
+                    users.append(record[5])
+                    yield record
+
+            await copy(con, "users", ["user_id", "username", "password", "email", "disabled", "roles"], users_and_roles(), args.batch_size, args.users)
+            user_role_records = ((first_user_id + index, roles[role]) for index, names in enumerate(users) for role in names)
+            await copy(con, "user_roles", ["user_id", "role_id"], user_role_records, args.batch_size, sum(len(names) for names in users))
+            del users
+
+            # Posts and their authors, a few authors write most of the posts with a high skew
+            if args.posts:
+                if not args.users:
+                    raise SystemExit("--posts needs --users, every post has an author")
+                # The posts are dated in the past, their monthly partitions must exist (sql/posts_partitions.sql)
+                if await con.fetchval("SELECT to_regproc('create_post_partitions') IS NOT NULL;"):
+                    await con.execute("SELECT create_post_partitions($1, $2);", now - timedelta(days=args.days), now)
+                await copy(con, "posts", ["post_id", "title", "content", "created_at"], post_records(args, rng, first_post_id, corpus, now), args.batch_size, args.posts)
+                authors = SkewedChooser(rng, args.users, args.author_skew)
+                post_user_records = ((first_post_id + index, first_user_id + authors.choose()) for index in range(args.posts))
+                await copy(con, "post_user", ["post_id", "user_id"], post_user_records, args.batch_size, args.posts)
+
+            await copy(con, "items", ["name", "description"], item_records(args, rng, corpus), args.batch_size, args.items)
+
+            # The serial sequences continue after the generated ids
+            await con.execute("SELECT setval(pg_get_serial_sequence('users', 'user_id'), (SELECT max(user_id) FROM users));")
+            await con.execute("SELECT setval(pg_get_serial_sequence('posts', 'post_id'), (SELECT max(post_id) FROM posts));")
+            for table, trigger in DISABLED_TRIGGERS:
+                if await con.fetchval("SELECT EXISTS(SELECT 1 FROM pg_trigger WHERE tgname = $1 AND tgrelid = $2::regclass);", trigger, table):
+                    await con.execute(f"ALTER TABLE {table} ENABLE TRIGGER {trigger};")
+        # Statistics for the planner, the plans of the loaded tables would be wrong without them
+        print("Analyzing the tables")
+        await con.execute("ANALYZE users, user_roles, posts, post_user, items;")
+    finally:
+        await con.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk load a synthetic dataset with COPY")
+    parser.add_argument("--users", type=int, default=10000, help="number of users (default: 10000)")
+    parser.add_argument("--posts", type=int, default=50000, help="number of posts (default: 50000)")
+    parser.add_argument("--items", type=int, default=10000, help="number of items (default: 10000)")
+    parser.add_argument("--seed", type=int, default=42, help="seed of the random generator (default: 42)")
+    parser.add_argument("--author-skew", type=float, default=1.1, help="Zipf exponent of the number of posts per author, 0 for uniform (default: 1.1)")
+    parser.add_argument("--content-mean", type=float, default=400, help="mean length of the post contents in characters (default: 400)")
+    parser.add_argument("--content-sigma", type=float, default=1.0, help="sigma of the log-normal law of the content lengths (default: 1.0)")
+    parser.add_argument("--content-max", type=int, default=20000, help="maximum length of a post content (default: 20000)")
+    parser.add_argument("--days", type=int, default=365, help="the posts are spread over this many days before now (default: 365)")
+    parser.add_argument("--fixed-now", action="store_true", help="date the posts before 2024-01-01 instead of now, for identical datasets")
+    parser.add_argument("--admin-ratio", type=float, default=0.001, help="share of the users having the Admin role (default: 0.001)")
+    parser.add_argument("--disabled-ratio", type=float, default=0.01, help="share of banned users (default: 0.01)")
+    parser.add_argument("--password", default="password", help="password of every generated user (default: password)")
+    parser.add_argument("--bcrypt-cost", type=int, default=12, help="bcrypt cost factor of the password hash (default: 12)")
+    parser.add_argument("--batch-size", type=int, default=50000, help="rows sent per COPY (default: 50000)")
+    args = parser.parse_args()
+
+    load_dotenv()
+    start = time.perf_counter()
+    asyncio.run(generate(args))
+    print(f"Done in {time.perf_counter() - start:.1f}s")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
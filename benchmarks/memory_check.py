@@ -0,0 +1,210 @@
+# Memory backend check: python benchmarks/memory_check.py
+# The in-memory database (DB_BACKEND=memory, see app/database/memory_backend.py) recognizes the queries
+# of the controllers by their text: a query changed in a controller must be changed there too.
+# This script runs every controller path against it and lists the queries it does not handle.
+# The post queries differ when the posts are sharded: run it again with POSTGRES_SHARDS=a,b
+# Exits with 1 if a query is not handled or a controller fails.
+
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+# Before the application is imported: the database is created on import
+os.environ["DB_BACKEND"] = "memory"
+os.environ["OBJECT_STORAGE_DIR"] = tempfile.mkdtemp(prefix="memory_check_")
+
+
+# Function to record the queries a MemoryDatabase does not handle, they still raise NotImplementedError
+def record_unhandled(database, unhandled: list):
+    run = database.run
+
+    def checked_run(query, args):
+        try:
+            return run(query, args)
+        except NotImplementedError as e:
+            unhandled.append(str(e))
+            raise
+
+    database.run = checked_run
+
+
+# Function to build a multipart/form-data request sending content in the file field, for the uploads
+def upload_request(content: bytes):
+    from starlette.requests import Request
+
+    boundary = "memorycheck"
+    body = (
+        f"--{boundary}\r\nContent-Disposition: form-data; name=\"file\"; filename=\"check.txt\"\r\n"
+        f"Content-Type: text/plain\r\n\r\n"
+    ).encode() + content + f"\r\n--{boundary}--\r\n".encode()
+    messages = [{"type": "http.request", "body": body, "more_body": False}]
+
+    async def receive():
+        return messages.pop(0) if messages else {"type": "http.disconnect"}
+
+    headers = [(b"content-type", f"multipart/form-data; boundary={boundary}".encode()), (b"content-length", str(len(body)).encode())]
+    return Request({"type": "http", "method": "PUT", "path": "/", "headers": headers}, receive)
+
+
+# Function to list the checks: name and function running a controller path
+# They run in order on the same data, s holds the ids of what the previous checks created
+def registered_checks():
+    from app.controllers import (
+        idempotency_controller,
+        item_controller,
+        item_object_controller,
+        post_controller,
+        post_event_controller,
+        post_partition_controller,
+        user_controller,
+        view_counter_controller,
+    )
+    from app.database.db_session import get_post_shards
+    from app.models.item import Item
+    from app.models.post import Post
+    from app.models.user import User, UserIdAndUsername
+
+    def author(s):
+        return UserIdAndUsername(user_id=s["user_id"], username="check")
+
+    async def create_users(s):
+        await user_controller.create_user(User(username="check", password="hash", email="check@check.test", roles=["User", "Admin"]))
+        await user_controller.create_user(User(username="other", password="hash", email="other@check.test", roles=["User"]))
+        s["user_id"] = (await user_controller.get_user_id("check")).user_id
+
+    async def create_posts(s):
+        s["post_ids"] = [(await post_controller.create_post(Post(title=f"post {n}", content="content " * 20), author(s))).post_id for n in range(3)]
+
+    async def flush_views(s):
+        counter = view_counter_controller.ViewCounter()
+        for post_id in s["post_ids"]:
+            counter.record(post_id)
+        await counter.flush()
+
+    async def read_events(s):
+        if get_post_shards().enabled:
+            return
+        position = await post_event_controller.find_last_position()
+        await post_event_controller.find_event_position(position[1])
+        async for _ in post_event_controller.read_events(post_event_controller.START_POSITION):
+            pass
+
+    async def create_items(s):
+        s["item_ids"] = [(await item_controller.create_item(Item(name=f"item {n}", description="check"))).item_id for n in range(3)]
+
+    async def create_item_idempotent(s):
+        await idempotency_controller.run_idempotent("items", "check", {"name": "idempotent"}, lambda con: item_controller.create_item(Item(name="idempotent", description="check"), con), in_transaction=True)
+        # The retry gets the stored response
+        await idempotency_controller.run_idempotent("items", "check", {"name": "idempotent"}, lambda con: item_controller.create_item(Item(name="idempotent", description="check"), con), in_transaction=True)
+
+    async def create_post_idempotent(s):
+        await idempotency_controller.run_idempotent("posts:check", "check", {"title": "idempotent"}, lambda: post_controller.create_post(Post(title="idempotent", content="check"), author(s)))
+
+    async def upload_object(s):
+        await item_object_controller.upload_item_object(s["item_ids"][0], upload_request(b"memory check"))
+
+    async def delete_all_items_job(s):
+        job = await item_controller.start_delete_all_items_job("batched", 2)
+        await item_controller.stop_delete_jobs()
+        await item_controller.find_delete_job_by_id(job.job_id)
+
+    return [
+        # Users
+        ("create_user", create_users),
+        ("find_user_by_username", lambda s: user_controller.find_user_by_username("check")),
+        ("find_user_by_email", lambda s: user_controller.find_user_by_email("check@check.test")),
+        ("get_role_id", lambda s: user_controller.get_role_id("Admin")),
+        ("find_all_users", lambda s: user_controller.find_all_users()),
+        ("search_users", lambda s: user_controller.search_users(q="CH", match="prefix", roles=["User"], disabled=False, limit=1)),
+        ("search_users_next_page", lambda s: user_controller.search_users(q="test", limit=1, after="check")),
+        ("count_users", lambda s: user_controller.count_users(q="check", match="substring", roles=["Admin"], disabled=False)),
+        ("ban_user_by_username", lambda s: user_controller.ban_user_by_username("other")),
+
+        # Posts
+        ("create_post", create_posts),
+        ("create_post_idempotent", create_post_idempotent),
+        ("find_all_posts", lambda s: post_controller.find_all_posts()),
+        ("find_all_posts_projected", lambda s: post_controller.find_all_posts_projected(["post_id", "title", "username", "views"], None)),
+        ("find_all_posts_excerpt", lambda s: post_controller.find_all_posts_projected(None, 10)),
+        ("find_one_post", lambda s: post_controller.find_one_post()),
+        ("find_post_by_id", lambda s: post_controller.find_post_by_id(s["post_ids"][0])),
+        ("find_posts_by_ids", lambda s: post_controller.find_posts_by_ids(s["post_ids"] + [10 ** 6])),
+        ("flush_views", flush_views),
+        ("update_post", lambda s: post_controller.update_post(s["post_ids"][0], Post(title="updated", content="check"), author(s))),
+        ("delete_post", lambda s: post_controller.delete_post(s["post_ids"][-1], author(s))),
+        ("read_post_events", read_events),
+        ("prune_post_events", lambda s: post_event_controller.db.execute(post_event_controller.PRUNE_QUERY, post_event_controller.POST_EVENTS_RETENTION_HOURS)),
+        ("maintain_post_partitions", lambda s: post_partition_controller.maintain_post_partitions()),
+
+        # Items
+        ("create_item", create_items),
+        ("create_item_idempotent", create_item_idempotent),
+        ("purge_idempotency_keys", lambda s: idempotency_controller.purge_expired_keys()),
+        ("find_all_items", lambda s: item_controller.find_all_items()),
+        ("find_item_by_id", lambda s: item_controller.find_item_by_id(s["item_ids"][0])),
+        ("find_items_by_ids", lambda s: item_controller.find_items_by_ids(s["item_ids"])),
+        ("upload_item_object", upload_object),
+        ("find_item_object", lambda s: item_object_controller.find_item_object(s["item_ids"][0])),
+        ("download_item_object", lambda s: item_object_controller.download_item_object(s["item_ids"][0])),
+        ("delete_item_object", lambda s: item_object_controller.delete_item_object(s["item_ids"][0])),
+        ("delete_item", lambda s: item_controller.delete_item(s["item_ids"][1])),
+        ("delete_all_items_job", delete_all_items_job),
+        ("fail_orphaned_delete_jobs", lambda s: item_controller.fail_orphaned_delete_jobs()),
+        ("delete_all_items_batched", lambda s: item_controller.delete_all_items("batched", 1)),
+        ("create_item_again", create_items),
+        ("delete_all_items_truncate", lambda s: item_controller.delete_all_items("truncate")),
+    ]
+
+
+async def run_checks(args) -> int:
+    from fastapi import HTTPException
+    from app.database.db_session import get_db, get_post_shards
+
+    unhandled = []
+    databases = [get_db()] + get_post_shards().shards
+    for database in databases:
+        record_unhandled(database, unhandled)
+        await database.connect()
+    failures = 0
+    samples = {}
+    for name, run in registered_checks():
+        if args.only and name not in args.only:
+            continue
+        unhandled.clear()
+        error = None
+        try:
+            await run(samples)
+        except HTTPException as e:
+            # 4xx are answers of the controllers (eg: 404), 5xx are failures
+            if e.status_code >= 500:
+                error = f"HTTP {e.status_code}: {e.detail}"
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+        problems = [f"not handled: {query}" for query in dict.fromkeys(unhandled)]
+        if error and not unhandled:
+            problems.append(error)
+        print(f"{'FAIL' if problems else 'ok  '} {name}")
+        for problem in problems:
+            print(f"       {problem}")
+        failures += bool(problems)
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check that the in-memory database handles every query of the controllers")
+    parser.add_argument("--only", nargs="*", help="names of the checks to run (default: all)")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    failures = asyncio.run(run_checks(args))
+    print(f"{failures} failed check(s) in {time.perf_counter() - start:.1f}s")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
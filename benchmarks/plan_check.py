@@ -0,0 +1,386 @@
+# Query plan checks: python benchmarks/plan_check.py
+# Runs the controller functions against the database of the POSTGRES_* environment variables
+# (the .env file is loaded), with every query replaced by its EXPLAIN, and checks the plans:
+# the indexes they must use, the tables they must not scan sequentially, and ceilings on the
+# estimated cost and number of rows. Exits with 1 if a plan regressed.
+# The ceilings are set for the dataset of benchmarks/generate_data.py with its default options (DATASET_ROWS),
+# the cost ceilings of the queries reading a share of a table grow with the rows of the table (scale_with)
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+
+from dotenv import load_dotenv
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+# Rows of the tables in the default dataset of generate_data.py, for which the ceilings are set
+DATASET_ROWS = {"users": 10000, "posts": 50000, "items": 10000}
+
+
+# Expected plan of a query
+#   - indexes: indexes the plan must use (index scans and ON CONFLICT arbiters)
+#   - no_seq_scan: tables the plan must not read with a sequential scan
+#   - max_cost: ceiling of the estimated total cost
+#   - max_rows: ceiling of the estimated number of rows returned
+#   - scale_with: table of DATASET_ROWS whose size the cost of the query grows with, max_cost is
+#     multiplied by its number of rows over the one of the default dataset (never below 1)
+class Expect:
+
+    def __init__(self, indexes=(), no_seq_scan=(), max_cost: float | None = None, max_rows: float | None = None, scale_with: str | None = None):
+        self.indexes = list(indexes)
+        self.no_seq_scan = list(no_seq_scan)
+        self.max_cost = max_cost
+        self.max_rows = max_rows
+        self.scale_with = scale_with
+
+    # Function to get the cost ceiling for the rows of the tables (table: rows)
+    def cost_ceiling(self, table_rows: dict) -> float | None:
+        if self.max_cost is None or self.scale_with is None:
+            return self.max_cost
+        return self.max_cost * max(1.0, table_rows.get(self.scale_with, 0) / DATASET_ROWS[self.scale_with])
+
+
+# Function to list the nodes of a plan (the plan and its sub-plans)
+def plan_nodes(plan: dict):
+    yield plan
+    for child in plan.get("Plans", []):
+        yield from plan_nodes(child)
+
+
+# Function to get the problems of a plan, an empty list if it is as expected
+# parents maps the partitions (and their indexes) to the partitioned table (and index) they belong to,
+# so that an expectation on posts covers the partitions of posts, table_rows gives the rows of the tables
+def check_plan(plan: dict, expect: Expect, parents: dict | None = None, table_rows: dict | None = None) -> list[str]:
+    parents = parents or {}
+    max_cost = expect.cost_ceiling(table_rows or {})
+    nodes = list(plan_nodes(plan))
+    used = {node["Index Name"] for node in nodes if "Index Name" in node}
+    used.update(index for node in nodes for index in node.get("Conflict Arbiter Indexes", []))
+    used.update([parents[index] for index in used if index in parents])
+    scanned = {node.get("Relation Name") for node in nodes if node["Node Type"] == "Seq Scan"}
+    scanned.update([parents[table] for table in scanned if table in parents])
+    problems = [f"index {index} not used" for index in expect.indexes if index not in used]
+    problems += [f"sequential scan on {table}" for table in expect.no_seq_scan if table in scanned]
+    if max_cost is not None and plan["Total Cost"] > max_cost:
+        problems.append(f"cost {plan['Total Cost']} > {max_cost:g}")
+    if expect.max_rows is not None and plan["Plan Rows"] > expect.max_rows:
+        problems.append(f"rows {plan['Plan Rows']} > {expect.max_rows}")
+    return problems
+
+
+# Function to describe a plan in one line: the top node, its cost and rows, and the indexes used
+def summarize_plan(plan: dict) -> str:
+    indexes = sorted({node["Index Name"] for node in plan_nodes(plan) if "Index Name" in node})
+    return f"{plan['Node Type']} cost={plan['Total Cost']} rows={plan['Plan Rows']} indexes={','.join(indexes) or '-'}"
+
+
+# Row returned to the controllers by the explained queries, so that they go on with the queries that follow
+# Any column can be read: the ids and names of the samples, now for the dates, false for the flags, empty otherwise
+# dict(row) is empty, so the controllers building a model from it stop there
+class StubRow(dict):
+
+    def __init__(self, samples: dict):
+        super().__init__()
+        self.samples = samples
+
+    def __missing__(self, key):
+        if key in self.samples:
+            return self.samples[key]
+        if key.endswith("_id"):
+            return 1
+        if key.endswith("_at"):
+            return datetime.now(timezone.utc)
+        if key.startswith("is_") or key == "disabled":
+            return False
+        if key in ("views", "size", "status_code"):
+            return 0
+        return ""
+
+
+# Connection given by ExplainDatabase.transaction, its queries are explained too
+class ExplainConnection:
+
+    def __init__(self, explainer):
+        self.explainer = explainer
+
+    async def fetch(self, query: str, *args):
+        await self.explainer.explain(query, args)
+        return [self.explainer.row]
+
+    async def fetchrow(self, query: str, *args):
+        await self.explainer.explain(query, args)
+        return self.explainer.row
+
+    async def fetchval(self, query: str, *args):
+        await self.explainer.explain(query, args)
+        return None
+
+    async def execute(self, query: str, *args):
+        await self.explainer.explain(query, args)
+        return ""
+
+
+# Function to build the backend installed in place of the application database
+# Each query is sent as EXPLAIN (FORMAT JSON) to the real database, nothing is read nor written,
+# the row queries return the stub row (one row for fetch_rows), the others None or an empty status
+def make_explain_database(database, row: StubRow):
+    from app.database.backend import DatabaseBackend
+
+    class ExplainDatabase(DatabaseBackend):
+
+        def __init__(self):
+            self.database = database
+            self.row = row
+            # (query, plan) of the queries explained since the last reset, and the errors of EXPLAIN
+            self.explained = []
+            self.errors = []
+
+        async def explain(self, query: str, args):
+            try:
+                result = await self.database.fetch_val("EXPLAIN (FORMAT JSON) " + query, *args)
+            except Exception as e:
+                self.errors.append(f"{' '.join(query.split())}: {e}")
+                raise
+            self.explained.append((" ".join(query.split()), json.loads(result)[0]["Plan"]))
+
+        async def connect(self):
+            await self.database.connect()
+
+        async def close(self, timeout: float | None = None):
+            await self.database.close(timeout)
+
+        def is_connected(self) -> bool:
+            return self.database.is_connected()
+
+        async def fetch_rows(self, query: str, *args):
+            await self.explain(query, args)
+            return [self.row]
+
+        async def fetch_row(self, query: str, *args):
+            await self.explain(query, args)
+            return self.row
+
+        async def fetch_val(self, query: str, *args):
+            await self.explain(query, args)
+            return None
+
+        async def execute(self, query: str, *args):
+            await self.explain(query, args)
+            return ""
+
+        @asynccontextmanager
+        async def transaction(self):
+            yield ExplainConnection(self)
+
+    return ExplainDatabase()
+
+
+# Function to map the partitions and their indexes to their partitioned table and index
+async def load_parents(database) -> dict:
+    query = "SELECT c.relname AS child, p.relname AS parent FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid JOIN pg_class p ON p.oid = i.inhparent;"
+    return {row["child"]: row["parent"] for row in await database.fetch_rows(query)}
+
+
+# Function to get the estimated rows of the tables of DATASET_ROWS, from the statistics (reltuples)
+# The rows of a partitioned table are the ones of its partitions, a table never analyzed counts for 0
+async def load_table_rows(database) -> dict:
+    query = "SELECT COALESCE(sum(GREATEST(reltuples, 0)), 0) FROM pg_class WHERE oid = $1::regclass OR oid IN (SELECT inhrelid FROM pg_inherits WHERE inhparent = $1::regclass);"
+    return {table: float(await database.fetch_val(query, table)) for table in DATASET_ROWS}
+
+
+# Function to pick the rows the checks look up, so that the plans are made for values that exist
+async def load_samples(database) -> dict:
+    user = await database.fetch_row("SELECT user_id, username, email FROM users WHERE cardinality(roles) > 0 ORDER BY user_id DESC LIMIT 1;")
+    post = await database.fetch_row("SELECT post_id, user_id FROM post_user ORDER BY post_id DESC LIMIT 1;")
+    post_ids = [row["post_id"] for row in await database.fetch_rows("SELECT post_id FROM posts ORDER BY post_id DESC LIMIT 100;")]
+    item_ids = [row["item_id"] for row in await database.fetch_rows("SELECT item_id FROM items ORDER BY item_id DESC LIMIT 100;")]
+    if user is None or post is None or not item_ids:
+        raise SystemExit("The database has no users, posts or items, load a dataset with benchmarks/generate_data.py first")
+    return {
+        "user_id": user["user_id"],
+        "username": user["username"],
+        "email": user["email"],
+        "post_id": post["post_id"],
+        "owner_id": post["user_id"],
+        "post_ids": post_ids,
+        "item_id": item_ids[0],
+        "item_ids": item_ids,
+    }
+
+
+# Function to list the checks: name, function running the controller code with the samples,
+# and the expected plan of each query it sends, in order
+def registered_checks():
+    from app.controllers import (
+        idempotency_controller,
+        item_controller,
+        item_object_controller,
+        post_controller,
+        post_event_controller,
+        user_controller,
+        view_counter_controller,
+    )
+    from app.database import db_session
+    from app.models.item import Item
+    from app.models.post import Post
+    from app.models.user import User, UserIdAndUsername
+
+    db = db_session.get_db()
+    point = dict(max_cost=50, max_rows=1)
+    # The feed reads the posts newest first from the index on created_at, never by sorting the table
+    feed = dict(indexes=["posts_created_at_idx"], no_seq_scan=["posts"], max_cost=20000, scale_with="posts")
+
+    async def flush_views(s):
+        counter = view_counter_controller.ViewCounter()
+        counter.pending = {post_id: 1 for post_id in s["post_ids"]}
+        await counter.flush()
+
+    async def read_events(s):
+        async for _ in post_event_controller.read_events(post_event_controller.START_POSITION):
+            pass
+
+    def owner(s):
+        return UserIdAndUsername(user_id=s["owner_id"], username="owner")
+
+    return [
+        # Authentication and users
+        ("find_user_by_username", lambda s: user_controller.find_user_by_username(s["username"]),
+            [Expect(indexes=["users_username_key"], no_seq_scan=["users"], **point)]),
+        ("find_user_by_email", lambda s: user_controller.find_user_by_email(s["email"]),
+            [Expect(indexes=["users_email_key"], no_seq_scan=["users"], **point)]),
+        ("get_user_id", lambda s: user_controller.get_user_id(s["username"]),
+            [Expect(indexes=["users_username_key"], no_seq_scan=["users"], **point)]),
+        ("get_role_id", lambda s: user_controller.get_role_id("Admin"),
+            [Expect(**point)]),
+        ("create_user", lambda s: user_controller.create_user(User(username="plan_check", password="hash", email="plan@check.test", roles=["User"])),
+            [Expect(max_cost=50), Expect(max_cost=50)]),
+        ("ban_user_by_username", lambda s: user_controller.ban_user_by_username(s["username"]),
+            [Expect(indexes=["users_username_key"], no_seq_scan=["users"], max_cost=50)]),
+        ("search_users_prefix", lambda s: user_controller.search_users(q=s["username"], match="prefix"),
+            [Expect(no_seq_scan=["users"], max_cost=2000, max_rows=51, scale_with="users")]),
+        ("search_users_substring", lambda s: user_controller.search_users(q=s["username"][-6:], match="substring"),
+            [Expect(no_seq_scan=["users"], max_cost=2000, max_rows=51, scale_with="users")]),
+        ("search_users_next_page", lambda s: user_controller.search_users(limit=50, after=s["username"]),
+            [Expect(indexes=["users_username_key"], no_seq_scan=["users"], max_cost=2000, max_rows=51, scale_with="users")]),
+        ("find_all_users", lambda s: user_controller.find_all_users(),
+            [Expect()]),
+
+        # Posts
+        ("find_one_post", lambda s: post_controller.find_one_post(),
+            [Expect(indexes=["posts_created_at_idx"], no_seq_scan=["posts"], **point)]),
+        ("find_post_by_id", lambda s: post_controller.find_post_by_id(s["post_id"]),
+            [Expect(indexes=["posts_pkey"], no_seq_scan=["posts", "post_user", "users"], **point)]),
+        ("find_posts_by_ids", lambda s: post_controller.find_posts_by_ids(s["post_ids"]),
+            [Expect(indexes=["posts_pkey"], no_seq_scan=["posts"], max_cost=5000, max_rows=1000)]),
+        ("find_all_posts", lambda s: post_controller.find_all_posts(),
+            [Expect(**feed)]),
+        ("find_all_posts_projected", lambda s: post_controller.find_all_posts_projected(["post_id", "title"], None),
+            [Expect(**feed)]),
+        ("create_post", lambda s: post_controller.create_post(Post(title="plan", content="check"), owner(s)),
+            [Expect(max_cost=50), Expect(max_cost=50)]),
+        ("update_post", lambda s: post_controller.update_post(s["post_id"], Post(title="plan", content="check"), owner(s)),
+            [Expect(indexes=["posts_pkey", "post_user_pkey"], no_seq_scan=["posts", "post_user"], max_cost=100)]),
+        ("delete_post", lambda s: post_controller.delete_post(s["post_id"], owner(s)),
+            [Expect(indexes=["posts_pkey", "post_user_pkey"], no_seq_scan=["posts", "post_user"], max_cost=100)]),
+        ("flush_views", flush_views,
+            [Expect(indexes=["posts_pkey"], no_seq_scan=["posts"], max_cost=5000)]),
+        ("read_post_events", read_events,
+            [Expect(indexes=["post_events_tx_id_idx"], no_seq_scan=["post_events"], max_cost=5000, max_rows=post_event_controller.EVENTS_PAGE_SIZE)]),
+        ("prune_post_events", lambda s: db.execute(post_event_controller.PRUNE_QUERY, post_event_controller.POST_EVENTS_RETENTION_HOURS),
+            [Expect(indexes=["post_events_created_at_idx"], no_seq_scan=["post_events"])]),
+
+        # Items
+        ("create_item", lambda s: item_controller.create_item(Item(name="plan", description="check")),
+            [Expect(max_cost=50)]),
+        ("find_item_by_id", lambda s: item_controller.find_item_by_id(s["item_id"]),
+            [Expect(indexes=["items_pkey"], no_seq_scan=["items"], **point)]),
+        ("find_items_by_ids", lambda s: item_controller.find_items_by_ids(s["item_ids"]),
+            [Expect(indexes=["items_pkey"], no_seq_scan=["items"], max_cost=5000, max_rows=1000)]),
+        ("delete_item", lambda s: item_controller.delete_item(s["item_id"]),
+            [Expect(indexes=["items_pkey"], no_seq_scan=["items"], max_cost=50)]),
+        ("find_item_object", lambda s: item_object_controller.find_item_object(s["item_id"]),
+            [Expect(indexes=["item_objects_pkey"], no_seq_scan=["item_objects"], **point)]),
+        ("item_exists", lambda s: db.fetch_val(item_object_controller.ITEM_EXISTS_QUERY, s["item_id"]),
+            [Expect(indexes=["items_pkey"], no_seq_scan=["items"], **point)]),
+
+        # Idempotency keys
+        ("claim_idempotency_key", lambda s: db.fetch_val(idempotency_controller.CLAIM_QUERY, "posts:1", "plan-check", b"hash", 24),
+            [Expect(indexes=["idempotency_keys_pkey"], max_cost=50)]),
+        ("select_idempotency_key", lambda s: db.fetch_row(idempotency_controller.SELECT_QUERY, "posts:1", "plan-check", 60),
+            [Expect(indexes=["idempotency_keys_pkey"], no_seq_scan=["idempotency_keys"], **point)]),
+        ("purge_idempotency_keys", lambda s: db.execute(idempotency_controller.PURGE_QUERY),
+            [Expect(indexes=["idempotency_keys_expires_at_idx"], no_seq_scan=["idempotency_keys"])]),
+    ]
+
+
+async def run_checks(args) -> int:
+    from app.database import db_session
+    from app.database.db import Database
+
+    database = Database()
+    await database.connect()
+    try:
+        samples = await load_samples(database)
+        parents = await load_parents(database)
+        table_rows = await load_table_rows(database)
+        # Installed before the controllers are imported, so that their module level db is this one
+        explainer = make_explain_database(database, StubRow(samples))
+        db_session.database_instance = explainer
+        db_session.post_shards_instance.main = explainer
+        failures = 0
+        for name, run, expects in registered_checks():
+            if args.only and name not in args.only:
+                continue
+            explainer.explained = []
+            explainer.errors = []
+            try:
+                await run(samples)
+            except Exception:
+                # Controllers answer 401 or 404 (or fail on the stub row) after their queries were explained
+                pass
+            if explainer.errors:
+                print(f"FAIL {name}: EXPLAIN failed")
+                for error in explainer.errors:
+                    print(f"       {error}")
+                failures += 1
+                continue
+            if len(explainer.explained) != len(expects):
+                print(f"FAIL {name}: {len(explainer.explained)} queries sent, {len(expects)} expected")
+                failures += 1
+                continue
+            for number, ((query, plan), expect) in enumerate(zip(explainer.explained, expects), start=1):
+                problems = check_plan(plan, expect, parents, table_rows)
+                print(f"{'FAIL' if problems else 'ok  '} {name}#{number}: {summarize_plan(plan)}")
+                for problem in problems:
+                    print(f"       {problem}")
+                if problems:
+                    failures += 1
+                    if args.verbose:
+                        print(f"       {query}")
+                        print(json.dumps(plan, indent=2))
+        return failures
+    finally:
+        await database.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the query plans of the controllers")
+    parser.add_argument("--only", nargs="*", help="names of the checks to run (default: all)")
+    parser.add_argument("--verbose", action="store_true", help="print the query and the plan of the failed checks")
+    args = parser.parse_args()
+
+    load_dotenv()
+    start = time.perf_counter()
+    failures = asyncio.run(run_checks(args))
+    print(f"{failures} plan regression(s) in {time.perf_counter() - start:.1f}s")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,12 +1,35 @@
-from fastapi import FastAPI
-from fastapi.middleware.cors import CORSMiddleware
-import asyncpg
-from app.database.db_session import get_db
 from dotenv import load_dotenv
 
 # Load the environment variables from the .env file
+# before anything reads its configuration (the database is created on import)
 load_dotenv()
 
+from fastapi import FastAPI, Request
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse
+import asyncio
+import asyncpg
+import os
+from app.database.db_session import get_db, get_post_shards
+from app.database.db import DatabaseUnavailable, QueryTimeout
+from app.middleware.drain import drain_state, DrainMiddleware, DrainingServer, SHUTDOWN_CLOSE_TIMEOUT
+from app.middleware.compression import CompressionMiddleware
+from app.middleware.disconnect import CancelOnDisconnectMiddleware
+from app.middleware.bulkhead import Bulkhead, BulkheadMiddleware
+from app.controllers.post_event_controller import post_event_broker
+from app.controllers.view_counter_controller import view_counter
+from app.controllers.post_partition_controller import partition_maintainer
+from app.controllers.item_controller import fail_orphaned_delete_jobs, stop_delete_jobs
+
+# Responses smaller than this (in bytes) are not compressed
+COMPRESSION_MIN_SIZE = int(os.environ.get("COMPRESSION_MIN_SIZE", 1024))
+COMPRESSION_GZIP_LEVEL = int(os.environ.get("COMPRESSION_GZIP_LEVEL", 6))
+COMPRESSION_BROTLI_QUALITY = int(os.environ.get("COMPRESSION_BROTLI_QUALITY", 4))
+COMPRESSION_ZSTD_LEVEL = int(os.environ.get("COMPRESSION_ZSTD_LEVEL", 3))
+
+# Retry-After (in seconds) of the requests rejected by a full bulkhead
+BULKHEAD_RETRY_AFTER = float(os.environ.get("BULKHEAD_RETRY_AFTER", 1))
+
 # Create a FastAPI app
 app = FastAPI(
     title="My First FastAPI",
@@ -15,6 +38,21 @@ app = FastAPI(
     docs_url="/docs"
 )
 
+# Give each router its own limit of requests in progress and its own queue, so that a slow router
+# (eg: the admin lists of users) cannot take every worker and connection from the others
+# Each one is set with BULKHEAD_<NAME>_CONCURRENCY (0: no limit), BULKHEAD_<NAME>_QUEUE and BULKHEAD_<NAME>_TIMEOUT
+# Added first, so it runs inside CORS and its 503 responses keep the CORS headers
+app.add_middleware(
+    BulkheadMiddleware,
+    bulkheads={
+        "/auth": Bulkhead.from_env("auth", 32, 128, 5),
+        "/posts": Bulkhead.from_env("posts", 64, 256, 5),
+        "/items": Bulkhead.from_env("items", 16, 64, 5),
+        "/users": Bulkhead.from_env("users", 8, 32, 5),
+    },
+    retry_after=BULKHEAD_RETRY_AFTER,
+)
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["http://localhost:3000", "https://climat-secure.onrender.com"],
@@ -24,21 +62,80 @@ app.add_middleware(
     expose_headers=["*"]
 )
 
+# Track in-flight requests so that shutdown can drain them (on SIGTERM, see DrainingServer)
+app.state.drain = drain_state
+# The event streams never end by themselves: they are ended when the drain starts,
+# the browsers reconnect to another worker
+drain_state.on_drain(post_event_broker.stop)
+app.add_middleware(DrainMiddleware, state=app.state.drain)
+
+# Compress the big responses (lists of posts, users, items)
+app.add_middleware(
+    CompressionMiddleware,
+    minimum_size=COMPRESSION_MIN_SIZE,
+    gzip_level=COMPRESSION_GZIP_LEVEL,
+    brotli_quality=COMPRESSION_BROTLI_QUALITY,
+    zstd_level=COMPRESSION_ZSTD_LEVEL,
+)
+
+# Stop working on requests whose client went away, their queries are cancelled on the server
+app.add_middleware(CancelOnDisconnectMiddleware)
+
+
+# Shed the load when the database cannot take more work, the client can retry later
+@app.exception_handler(DatabaseUnavailable)
+async def database_unavailable_handler(request: Request, exc: DatabaseUnavailable):
+    return JSONResponse(
+        content={"detail": exc.message},
+        status_code=exc.status_code,
+        headers={"Retry-After": str(max(1, round(exc.retry_after)))},
+    )
+
+
+# A query that exceeded the timeout of its request is not a sign of overload: 504 without Retry-After
+# More specific than DatabaseUnavailable, this handler is the one used for QueryTimeout
+@app.exception_handler(QueryTimeout)
+async def query_timeout_handler(request: Request, exc: QueryTimeout):
+    return JSONResponse(content={"detail": exc.message}, status_code=exc.status_code)
+
 
 @app.on_event("startup")
 async def on_startup():
     try:
         db = get_db()
         await db.connect()
+        await get_post_shards().connect()
     except Exception as e:
         print("main ERROR while connecting: ", e)
         exit(1)
     app.state.db = db
+    await fail_orphaned_delete_jobs()
+    view_counter.start()
+    partition_maintainer.start()
 
 
+# Runs once uvicorn has stopped serving: the requests have been drained by DrainingServer before
 @app.on_event("shutdown")
 async def on_shutdown():
-    await app.state.db.close()
+    app.state.drain.start_drain()
+    # Already done by the drain, unless uvicorn stopped by itself
+    await post_event_broker.stop()
+    await partition_maintainer.stop()
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + SHUTDOWN_CLOSE_TIMEOUT
+    # Write the views counted since the last flush
+    try:
+        await asyncio.wait_for(view_counter.stop(), max(deadline - loop.time(), 0))
+    except asyncio.TimeoutError:
+        print(f"main WARNING: {len(view_counter.pending)} post view count(s) not written")
+    # Cancel the background deletions, they are recorded as failed while the database is still open
+    try:
+        await asyncio.wait_for(stop_delete_jobs(), max(deadline - loop.time(), 0))
+    except asyncio.TimeoutError:
+        print("main WARNING: background deletion(s) not recorded as failed")
+    # Give the remaining time to the pool to get its connections back
+    await get_post_shards().close(timeout=max(deadline - loop.time(), 0))
+    await app.state.db.close(timeout=max(deadline - loop.time(), 0))
 
 # Define a root endpoint
 @app.get("/")
@@ -50,15 +147,23 @@ from app.routers.user_router import user_router
 from app.routers.auth_router import auth_router
 from app.routers.items_router import item_router
 from app.routers.post_router import post_router
+from app.routers.health_router import health_router
+from app.routers.metrics_router import metrics_router
 
 app.include_router(user_router)
 app.include_router(auth_router)
 app.include_router(item_router)
 app.include_router(post_router)
+app.include_router(health_router)
+app.include_router(metrics_router)
 
 
 if __name__ == "__main__":
-    import uvicorn
+    from uvicorn import Config
+    from uvicorn.supervisors import ChangeReload
 
-    # Run the application using Uvicorn
-    uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True)
+    # Run the application using Uvicorn, with auto reload
+    # DrainingServer replaces uvicorn.run so that the requests are drained on reload and on CTRL+C
+    config = Config("main:app", host="0.0.0.0", port=8000, reload=True)
+    server = DrainingServer(config)
+    ChangeReload(config, target=server.run, sockets=[config.bind_socket()]).run()
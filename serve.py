@@ -0,0 +1,163 @@
+# Production entry point: python serve.py
+# Starts one uvicorn worker per core on a shared socket, and restarts the workers that crash
+# For development use python main.py (single process with auto reload)
+
+import multiprocessing
+import os
+import signal
+import threading
+import time
+from importlib.util import find_spec
+
+from dotenv import load_dotenv
+from uvicorn import Config
+
+# Load the environment variables from the .env file, the workers inherit them
+load_dotenv()
+
+from app.middleware.drain import DrainingServer, SHUTDOWN_DRAIN_TIMEOUT, SHUTDOWN_CLOSE_TIMEOUT
+
+HOST = os.environ.get("HOST", "0.0.0.0")
+PORT = int(os.environ.get("PORT", 8000))
+
+# Number of worker processes, one per core by default
+WORKERS = int(os.environ.get("WEB_CONCURRENCY", os.cpu_count() or 1))
+
+# Postgres max_connections, and the connections kept for anything else (admin, migrations, psql)
+# The pool of each worker is sized so that all the workers together stay within the limit
+PG_MAX_CONNECTIONS = int(os.environ.get("PG_MAX_CONNECTIONS", 100))
+PG_RESERVED_CONNECTIONS = int(os.environ.get("PG_RESERVED_CONNECTIONS", 10))
+
+# Seconds an idle keep-alive connection is kept open, should be above the load balancer idle timeout
+KEEP_ALIVE_TIMEOUT = int(os.environ.get("KEEP_ALIVE_TIMEOUT", 75))
+# Maximum number of connections waiting to be accepted
+BACKLOG = int(os.environ.get("BACKLOG", 2048))
+# Seconds uvicorn waits for the connections once the drain is over (see app/middleware/drain.py),
+# the requests still running after it are cancelled
+GRACEFUL_SHUTDOWN_TIMEOUT = int(os.environ.get("GRACEFUL_SHUTDOWN_TIMEOUT", 5))
+# Seconds given to a worker to stop before it is killed: the drain, the wait of uvicorn,
+# then the lifespan shutdown of main.py (view counts, pools), with a margin
+SHUTDOWN_MARGIN = 5
+WORKER_SHUTDOWN_TIMEOUT = float(os.environ.get("WORKER_SHUTDOWN_TIMEOUT", SHUTDOWN_DRAIN_TIMEOUT + GRACEFUL_SHUTDOWN_TIMEOUT + SHUTDOWN_CLOSE_TIMEOUT + SHUTDOWN_MARGIN))
+
+# Delay before restarting a worker that crashed right after starting, doubled on each crash
+RESTART_DELAY = 1
+MAX_RESTART_DELAY = 30
+
+# The workers are started in a fresh interpreter, nothing of the supervisor (signal handlers, threads) is inherited
+spawn = multiprocessing.get_context("spawn")
+
+
+# Function to size the database pool of each worker from the Postgres connection limit
+# Each worker also holds one connection outside of its pool, for the listener of GET /posts/stream
+# An explicit DB_POOL_MAX_SIZE is kept if it fits
+def configure_pool_size(workers: int):
+    per_worker = max(1, (PG_MAX_CONNECTIONS - PG_RESERVED_CONNECTIONS) // workers - 1)
+    max_size = min(int(os.environ.get("DB_POOL_MAX_SIZE", per_worker)), per_worker)
+    min_size = min(int(os.environ.get("DB_POOL_MIN_SIZE", 1)), max_size)
+    os.environ["DB_POOL_MAX_SIZE"] = str(max_size)
+    os.environ["DB_POOL_MIN_SIZE"] = str(min_size)
+    return max_size
+
+
+# Function to get the time uvicorn waits for the connections after the drain
+# It must end well before the worker is killed, so that the lifespan shutdown still runs
+def graceful_shutdown_timeout() -> int:
+    left = WORKER_SHUTDOWN_TIMEOUT - SHUTDOWN_DRAIN_TIMEOUT - SHUTDOWN_CLOSE_TIMEOUT - SHUTDOWN_MARGIN
+    if left < 1:
+        print(f"serve WARNING: WORKER_SHUTDOWN_TIMEOUT ({WORKER_SHUTDOWN_TIMEOUT}s) is too short for SHUTDOWN_DRAIN_TIMEOUT + SHUTDOWN_CLOSE_TIMEOUT + {SHUTDOWN_MARGIN}s, the workers may be killed before they close the database connections")
+    return max(1, min(GRACEFUL_SHUTDOWN_TIMEOUT, int(left)))
+
+
+# Function to build the uvicorn configuration, uvloop and httptools are used when installed
+def build_config() -> Config:
+    return Config(
+        "main:app",
+        host=HOST,
+        port=PORT,
+        workers=WORKERS,
+        loop="uvloop" if find_spec("uvloop") else "asyncio",
+        http="httptools" if find_spec("httptools") else "h11",
+        backlog=BACKLOG,
+        timeout_keep_alive=KEEP_ALIVE_TIMEOUT,
+        timeout_graceful_shutdown=graceful_shutdown_timeout(),
+        proxy_headers=True,
+        # Access logs are a significant cost per request, they are off unless asked for
+        access_log=os.environ.get("ACCESS_LOG", "false").lower() == "true",
+    )
+
+
+# Function run in each worker process
+def run_worker(config: Config, sockets: list):
+    config.configure_logging()
+    DrainingServer(config=config).run(sockets=sockets)
+
+
+# Class that starts the workers, restarts them when they die, and stops them on SIGINT / SIGTERM
+class Supervisor:
+
+    def __init__(self, config: Config):
+        self.config = config
+        self.socket = config.bind_socket()
+        self.should_exit = threading.Event()
+        self.processes = [None] * config.workers
+        self.started_at = [0.0] * config.workers
+        self.restart_delays = [RESTART_DELAY] * config.workers
+
+    # Function called on SIGINT / SIGTERM
+    def signal_handler(self, sig, frame):
+        self.should_exit.set()
+
+    # Function to start the worker in the given slot
+    def start_worker(self, index: int):
+        process = spawn.Process(target=run_worker, args=(self.config, [self.socket]))
+        process.start()
+        self.processes[index] = process
+        self.started_at[index] = time.monotonic()
+        print(f"serve: worker {index} started with pid {process.pid}")
+
+    # Function to restart the workers that have died
+    # A worker dying quickly after its start is restarted with an increasing delay
+    def check_workers(self):
+        for index, process in enumerate(self.processes):
+            if process.is_alive():
+                continue
+            print(f"serve WARNING: worker {index} (pid {process.pid}) exited with code {process.exitcode}")
+            if time.monotonic() - self.started_at[index] < MAX_RESTART_DELAY:
+                if self.should_exit.wait(self.restart_delays[index]):
+                    return
+                self.restart_delays[index] = min(self.restart_delays[index] * 2, MAX_RESTART_DELAY)
+            else:
+                self.restart_delays[index] = RESTART_DELAY
+            self.start_worker(index)
+
+    # Function to stop the workers, they drain their requests before exiting
+    def stop_workers(self):
+        for process in self.processes:
+            if process.is_alive():
+                process.terminate()
+        deadline = time.monotonic() + WORKER_SHUTDOWN_TIMEOUT
+        for process in self.processes:
+            process.join(max(deadline - time.monotonic(), 0))
+            if process.is_alive():
+                print(f"serve WARNING: worker pid {process.pid} did not stop in time, killing it")
+                process.kill()
+                process.join()
+
+    def run(self):
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(sig, self.signal_handler)
+        for index in range(self.config.workers):
+            self.start_worker(index)
+        while not self.should_exit.wait(0.5):
+            self.check_workers()
+        print("serve: stopping the workers")
+        self.stop_workers()
+        self.socket.close()
+
+
+if __name__ == "__main__":
+    config = build_config()
+    pool_size = configure_pool_size(config.workers)
+    print(f"serve: {config.workers} worker(s) on {HOST}:{PORT}, loop={config.loop}, http={config.http}, {pool_size} database connection(s) per worker")
+    Supervisor(config).run()